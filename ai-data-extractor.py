@@ -3,42 +3,109 @@
 import os
 import json
 import pandas as pd
-import docx
-from docx.document import Document as DocxDocument 
-from docx.table import Table as DocxTable 
 import datetime
 from config import * 
 import re
 import vertexai
-from vertexai.generative_models import GenerativeModel
 import time 
 import sys
+import argparse
 from google.api_core import exceptions as google_exceptions 
+import hashlib
+from dedup_index import ContentDedupIndex
+from prompt_compiler import PromptCompiler, TokenLedger, SYSTEM_INSTRUCTION
+from evidence_selection import select_evidence, estimate_tokens, EvidenceSelectionMetrics
+from content_store import DocumentContentStore
+from docx_parser import docx_table_to_markdown, parse_document, ParsePrefetcher, new_parse_pool
+from call_policy import HedgedCaller, CallDeadlineExceeded, call_deadline_seconds
+from dead_letter import DeadLetterQueue, DocumentProcessingError, StageFailure
+from run_planner import RunPlanner, RunBudget, estimate_cost
+from profiling import StageProfiler
+from results_store import ResultsStore, EXCEL_COLUMNS, file_sha256, new_run_id
+from output_writer import StreamingResultsWriter
+from endpoint_pool import EndpointPool, ModelEndpoint, vertex_model_factory
+from document_watcher import DocumentWatcher, JobServer
+from extraction_planner import plan_extraction_groups, ExtractionMergeMetrics
+import signal
+import sqlite3
+import bisect
+from work_queue import FileLeaseQueue, default_worker_id, append_shard_rows, read_shard_rows
+
+# Stage profiler; enabled by the --profile flag, otherwise its hooks are no-ops
+stage_profiler = StageProfiler()
+
+
+def build_endpoint_pool(model_factory=None) -> 'EndpointPool':
+    """
+    Builds the pool of (project, location, model) endpoints that serves every model call, from MODEL_ENDPOINTS
+    (or the single PROJECT_ID/LOCATION/GEMINI_MODEL endpoint if it is empty).
 
-
-# Helper function to convert a python-docx Table object to GitHub Flavored Markdown
-def docx_table_to_markdown(table_obj: DocxTable) -> str:
-    """Converts a python-docx Table object to a GitHub Flavored Markdown string."""
-    md_rows = []
-    for i, row in enumerate(table_obj.rows):
-        # Escape pipe characters within cell text to avoid breaking Markdown table structure
-        cells_text = [cell.text.strip().replace("|", "\\|") for cell in row.cells]
-        md_rows.append("| " + " | ".join(cells_text) + " |")
-        if i == 0:  # After header row, add separator
-            separator = ["---"] * len(cells_text)
-            md_rows.append("| " + " | ".join(separator) + " |")
-    return "\n".join(md_rows)
+    Args:
+        model_factory (callable, optional): (project, location, model_name) -> model object. Defaults to Vertex AI
+                                            GenerativeModels; tests can pass local stand-ins.
+    """
+    endpoint_specs = MODEL_ENDPOINTS or [{"project": PROJECT_ID, "location": LOCATION, "model": GEMINI_MODEL}]
+    endpoints = [
+        ModelEndpoint(spec.get("project", PROJECT_ID), spec.get("location", LOCATION), spec.get("model", GEMINI_MODEL),
+                      weight=spec.get("weight", 1.0), requests_per_minute=spec.get("requests_per_minute", 0))
+        for spec in endpoint_specs]
+    if model_factory is None:
+        # Each model is bound to its endpoint by resource name; the SDK defaults only need to resolve, so they
+        # come from the first endpoint rather than a PROJECT_ID/LOCATION that may not be in the pool
+        vertexai.init(project=endpoints[0].project, location=endpoints[0].location)
+    return EndpointPool(endpoints, model_factory or vertex_model_factory(SYSTEM_INSTRUCTION),
+                        cooldown_seconds=ENDPOINT_COOLDOWN_SECONDS, max_cooldown_seconds=ENDPOINT_MAX_COOLDOWN_SECONDS)
 
 
 class ParagraphClassifierClient:
-    def __init__(self):
-        vertexai.init(project=PROJECT_ID, location=LOCATION)
-        self.model = GenerativeModel(GEMINI_MODEL,
-            system_instruction="""You are a meticulous research assistant with expertise in natural language processing. Your primary focus will be on analyzing the methodologies, findings, and details of **the main, current research study being reported in the provided academic articles.** You will be assigned two main tasks:
-            1. **Paragraph Classification:** Given a research paper section heading and its paragraphs (which may include text paragraphs or tables formatted as Markdown), you will classify each paragraph/table based on a set of predefined labels, along with your confidence in each label. You will be provided with descriptions of these labels to guide your classification.
-            2. **Variable Extraction:** Given a research paper section heading, paragraphs (which may include text paragraphs or tables formatted as Markdown), and a list of target variables, you will extract the values of these variables from the paragraphs/tables. For each extracted value, you will provide a justification explaining how you derived it from the text, referencing the most relevant paragraph(s)/table(s). You will be provided with detailed descriptions of the target variables to help you accurately identify and extract them."""
-            )
+    def __init__(self, model_factory=None):
+        # Every call (classification, extraction, token counting) is routed through the endpoint pool
+        self.model = build_endpoint_pool(model_factory)
+        # Static prompt parts (instructions, label descriptions, variable definitions) are rendered once per run
+        self.prompt_compiler = PromptCompiler(PARAGRAPH_TAG_DESCRIPTIONS, TARGET_VARIABLES, CLUSTER_TARGET_VARIABLES)
+        self.token_ledger = TokenLedger(
+            lambda text: self.model.count_tokens(text).total_tokens,
+            system_instruction=SYSTEM_INSTRUCTION,
+            enabled=ENABLE_TOKEN_ACCOUNTING)
+        self.evidence_metrics = EvidenceSelectionMetrics() # Pass-2 pruning statistics for the whole run
+        self.extraction_merge_metrics = ExtractionMergeMetrics() # Pass-2 calls and evidence tokens saved by merging tags
+        self.run_budget = RunBudget(RUN_TOKEN_BUDGET, RUN_COST_BUDGET, MODEL_INPUT_PRICE_PER_1M_TOKENS,
+                                    MODEL_OUTPUT_PRICE_PER_1M_TOKENS, PRICE_CURRENCY)
+        self.call_policy = HedgedCaller(
+            enable_hedging=ENABLE_HEDGED_REQUESTS,
+            hedge_percentile=HEDGE_LATENCY_PERCENTILE,
+            min_samples=HEDGE_MIN_LATENCY_SAMPLES,
+            usage_tokens_fn=lambda response_obj: response_obj.usage_metadata.total_token_count,
+            discarded_response_fn=lambda response_obj: self.run_budget.add_usage(response_obj, discarded=True))
         
+    def _record_token_usage(self, task_kind: str, compiled_prompt: 'CompiledPrompt', response_obj):
+        """Adds a call's token usage to the run's ledger and prints the per-component breakdown."""
+        call_counts = self.token_ledger.record(task_kind, compiled_prompt, response_obj)
+        if call_counts:
+            print("Tokens: " + ", ".join(f"{name}={count}" for name, count in call_counts.items()))
+
+    def _generate(self, task_kind: str, compiled_prompt: 'CompiledPrompt'):
+        """
+        Sends a compiled prompt to the model with a deadline scaled by prompt size (and a hedged duplicate
+        request if the call is slower than usual), then records its token usage.
+
+        Raises:
+            CallDeadlineExceeded: If the call did not return within its deadline (retried by the caller).
+            google_exceptions.GoogleAPIError: For API-level failures.
+        """
+        prompt_text = compiled_prompt.text
+        deadline = call_deadline_seconds(len(prompt_text), CALL_DEADLINE_BASE_SECONDS, CALL_DEADLINE_SECONDS_PER_1K_PROMPT_TOKENS)
+        response_obj = self.call_policy.call(
+            lambda: self.model.generate_content(
+                [prompt_text], 
+                generation_config=GENERATION_CONFIGURATION, 
+                safety_settings=SAFETY_SETTINGS
+            ),
+            task_kind, deadline)
+        self._record_token_usage(task_kind, compiled_prompt, response_obj)
+        self.run_budget.add_usage(response_obj)
+        return response_obj
+
     def _handle_llm_response_issues(self, response_obj, task_description):
         """
         Checks for issues like MAX_TOKENS or SAFETY in the response candidate.
@@ -117,7 +184,7 @@ class ParagraphClassifierClient:
             dict: Classifications keyed by global paragraph/content index (as strings), 
                   or an empty dict if no content or if a persistent error occurs after retries.
         Raises:
-            RuntimeError: If classification fails after all retry attempts.
+            StageFailure: If classification fails after all retry attempts.
         """
         task_description = f"Classification for section '{heading}'"
         print(f"\n{task_description} (Content pieces: {len(section_content_strings)}, Global start idx: {section_global_start_idx})")
@@ -134,58 +201,49 @@ class ParagraphClassifierClient:
             print(f"No non-empty content to classify in section: {heading}")
             return {}
 
-        payload = {
-            "heading": heading,
-            "paragraphs": payload_paragraphs # Keys are global indices as strings
-        }
-        json_payload_for_prompt = json.dumps(payload, indent=2) # For inclusion in the prompt
+        compiled_prompt = self.prompt_compiler.classification_prompt(heading, payload_paragraphs)
+        return self._classify("classification", task_description, f'section: "{heading}"', compiled_prompt)
 
-        # Prepare prompt components
-        valid_label_names = list(PARAGRAPH_TAG_DESCRIPTIONS.keys())
-        
-        formatted_descriptions = "\n\nAvailable Labels and What They Cover:\n"
-        for label_name, description_list in PARAGRAPH_TAG_DESCRIPTIONS.items():
-            joined_descriptions = "; ".join(description_list) 
-            formatted_descriptions += f"- **{label_name}**: This label pertains to content about: {joined_descriptions}\n"
-
-        # Construct the full prompt
-        prompt = (
-            "The following is a JSON object containing a section heading and its associated content pieces (paragraphs or tables formatted as Markdown) from a research paper. For the 'paragraphs' dictionary, the keys are unique content piece indices (as strings), and the values are the content string (text or Markdown table):\n\n"
-            f"{json_payload_for_prompt}\n\n"
-            "Your task is to classify each content piece. You MUST ONLY use label names from the following predefined list:\n"
-            f"VALID LABEL NAMES: [{', '.join(valid_label_names)}]\n\n" 
-            f"To help you understand what each valid label name means, refer to these descriptions:\n"
-            f"{formatted_descriptions}\n\n"
-            "If a content piece is relevant to multiple labels, assign multiple labels using ONLY names from the VALID LABEL NAMES list. "
-            "For each relevant content piece, provide a list containing pairs of [\"exact_label_name_from_valid_list\", confidence_score_0_to_1]. "
-            "If a content piece is not relevant to any of the listed VALID LABEL NAMES, do not include that content piece index in your response's 'classifications' object.\n\n"
-            "The response MUST be a single JSON object with the following format. Pay EXTREMELY close attention to JSON syntax, especially commas between list items and object properties:\n\n"
-            "```json\n"
-            "{\n"
-            "  \"classifications\": {\n"
-            "    \"[Content Piece Index String]\": [\n"
-            "      [\"exact_label_name_from_valid_list_1\", 0.0],\n"
-            "      [\"exact_label_name_from_valid_list_2\", 0.0]\n"
-            "    ],\n"
-            "    \"[Another Content Piece Index String]\": [\n"
-            "      [\"exact_label_name_from_valid_list_3\", 0.0]\n"
-            "    ]\n"
-            "  }\n"
-            "}\n"
-            "```\n\n"
-            "CRITICAL: Ensure every label name you output in the 'classifications' is an exact match to one of the names in the 'VALID LABEL NAMES' list provided above. Do not use descriptions or other phrases as label names. "
-            "The entire response MUST be only the valid JSON object, without any surrounding text or markdown fences in the final output. Ensure all strings are double-quoted, and all lists and objects are correctly structured with necessary commas.\n"
-        )
+    def classify_document(self, document_name: str, section_payloads: list) -> dict:
+        """
+        Classifies every content piece of a document in a single call (whole-document classification mode).
+
+        Args:
+            document_name (str): Name of the document (for messages).
+            section_payloads (list): [(heading, {global_idx_str: content_string})] for each section, in document
+                                     order. Blank content (e.g., reused duplicates) is left out of the prompt.
+        Returns:
+            dict: Classifications keyed by global content index (as strings), in the same format as classify_section.
+        Raises:
+            StageFailure: If classification fails after all retry attempts.
+        """
+        section_payloads = [
+            (heading, {global_idx_str: content_str for global_idx_str, content_str in payload_paragraphs.items()
+                       if content_str and not content_str.isspace()})
+            for heading, payload_paragraphs in section_payloads]
+        section_payloads = [(heading, payload_paragraphs) for heading, payload_paragraphs in section_payloads if payload_paragraphs]
+        task_description = f"Whole-document classification for '{document_name}'"
+        print(f"\n{task_description} (Sections: {len(section_payloads)}, "
+              f"Content pieces: {sum(len(payload_paragraphs) for _heading, payload_paragraphs in section_payloads)})")
+        if not section_payloads:
+            print(f"No non-empty content to classify in document: {document_name}")
+            return {}
+
+        compiled_prompt = self.prompt_compiler.document_classification_prompt(section_payloads)
+        return self._classify("document_classification", task_description, f'document: "{document_name}"', compiled_prompt)
 
+    def _classify(self, task_kind: str, task_description: str, subject: str, compiled_prompt: 'CompiledPrompt') -> dict:
+        """
+        Sends a classification prompt with retries and returns its 'classifications' object.
+
+        Raises:
+            StageFailure: If classification fails after all retry attempts.
+        """
         for attempt in range(MAX_API_RETRIES + 1): # Total attempts = 1 initial + MAX_API_RETRIES
             try:
-                print(f"Classification attempt {attempt + 1}/{MAX_API_RETRIES + 1} for section: \"{heading}\"")
+                print(f"Classification attempt {attempt + 1}/{MAX_API_RETRIES + 1} for {subject}")
                 
-                response_obj = self.model.generate_content(
-                    [prompt], 
-                    generation_config=GENERATION_CONFIGURATION, 
-                    safety_settings=SAFETY_SETTINGS
-                )
+                response_obj = self._generate(task_kind, compiled_prompt)
                 
                 # Will raise ValueError if candidate is empty/problematic (e.g. due to MAX_TOKENS, SAFETY)
                 response_text = self._handle_llm_response_issues(response_obj, task_description)
@@ -193,12 +251,12 @@ class ParagraphClassifierClient:
                 clean_response = remove_json_markdown(response_text)
                 response_dict = json.loads(clean_response) # Can raise JSONDecodeError
                 
-                print(f"Classification successful for section: \"{heading}\" on attempt {attempt + 1}.")
+                print(f"Classification successful for {subject} on attempt {attempt + 1}.")
                 return response_dict.get("classifications", {})
 
-            except (json.JSONDecodeError, ValueError, google_exceptions.GoogleAPIError) as e:
+            except (json.JSONDecodeError, ValueError, google_exceptions.GoogleAPIError, CallDeadlineExceeded) as e:
                 # ValueError can come from _handle_llm_response_issues or direct .text access if candidate is malformed
-                # GoogleAPIError for API-level issues (network, quota, server error)
+                # GoogleAPIError for API-level issues (network, quota, server error); CallDeadlineExceeded for hung calls
                 error_type = type(e).__name__
                 error_message = str(e)
                 print(f"Error during {task_description} on attempt {attempt + 1}/{MAX_API_RETRIES + 1}: {error_type} - {error_message}")
@@ -215,90 +273,89 @@ class ParagraphClassifierClient:
                 else:
                     final_error_message = f"{task_description} failed after {MAX_API_RETRIES + 1} attempts: {error_type} - {error_message}"
                     print(final_error_message)
-                    raise RuntimeError(final_error_message) from e
+                    raise StageFailure(final_error_message) from e
         
-        # This part should ideally not be reached if RuntimeError is raised on final attempt failure.
+        # This part should ideally not be reached if StageFailure is raised on final attempt failure.
         # However, to satisfy linters or very specific control flows, returning {} is a fallback.
-        print(f"Classification for section '{heading}' failed all retries and did not raise exception as expected (should not happen).")
+        print(f"{task_description} failed all retries and did not raise exception as expected (should not happen).")
         return {}
 
 
-    def extract_target_variables(self, classified_paragraphs_data: dict) -> dict:
+    def extract_target_variables(self, classified_paragraphs_data: dict, content_store: 'DocumentContentStore') -> dict:
         """
-        Extracts target variables based on classified content for each relevant tag.
+        Extracts target variables based on classified content for each relevant tag. With
+        MERGE_EXTRACTION_CALLS, tags whose selected evidence largely overlaps share one call (the union of their
+        target variables, each content piece sent once); results are split back per variable.
 
         Args:
             classified_paragraphs_data (dict): Data structure from classification.
-                Format: { 'tag_label': { 'heading_text': [(confidence, global_idx, content_string), ...] } }
+                Format: { 'tag_label': { 'heading_text': [(confidence, global_idx), ...] } }
+            content_store (DocumentContentStore): The document's content pieces, looked up by global_idx.
 
         Returns:
             dict: Aggregated extraction results. Format: { 'variable_name': { 'value': ..., ... } }
         
         Raises:
-            RuntimeError: If extraction fails for any tag_label after all retry attempts.
+            StageFailure: If extraction fails for any tag_label after all retry attempts.
         """
         extraction_results = {} # This will store results across all tags
+        document_evidence_metrics = EvidenceSelectionMetrics()
         print(f"\nStarting target variable extraction...")
         # print(f"Classified data for extraction (condensed): { {k: list(v.keys()) for k,v in classified_paragraphs_data.items()} }")
 
-
+        # 1. Select each tag's evidence
+        tag_requests = [] # (tag_label, target_vars, content_payload_by_heading)
         for tag_label, headings_map in classified_paragraphs_data.items():
-            task_description_for_tag = f"Extraction for tag_label '{tag_label}'"
-            print(f"\nProcessing {task_description_for_tag}")
+            print(f"\nProcessing Extraction for tag_label '{tag_label}'")
 
-            current_target_vars_for_extraction = {} # Placeholder for your logic
-            if tag_label in TARGET_VARIABLES: current_target_vars_for_extraction = {tag_label: TARGET_VARIABLES[tag_label]}
-            elif tag_label in CLUSTER_TARGET_VARIABLES:
-                current_target_vars_for_extraction = { var_name: TARGET_VARIABLES[var_name] for var_name in CLUSTER_TARGET_VARIABLES.get(tag_label, []) if var_name in TARGET_VARIABLES }
+            current_target_vars_for_extraction = self.prompt_compiler.target_variables_for_tag(tag_label)
             if not current_target_vars_for_extraction: print(f"No target variables for tag '{tag_label}'. Skipping."); continue
+            # Apply CONFIDENCE_THRESHOLD and cap the payload to the per-call token budget
+            selected_headings_map, selection_stats = select_evidence(
+                headings_map, content_store, CONFIDENCE_THRESHOLD, EVIDENCE_TOKEN_BUDGET_PER_CALL,
+                context_window=EVIDENCE_CONTEXT_WINDOW, min_pieces=EVIDENCE_MIN_PIECES_PER_TAG)
+            document_evidence_metrics.add(selection_stats)
+            self.evidence_metrics.add(selection_stats)
+            if selection_stats["selected"] < selection_stats["candidates"]:
+                print(f"Evidence for tag '{tag_label}': kept {selection_stats['selected']}/{selection_stats['candidates']} content pieces "
+                      f"(~{selection_stats['selected_tokens']}/{selection_stats['candidate_tokens']} estimated tokens).")
+
             content_payload_by_heading = {}; has_content_for_this_tag = False
-            for heading_text, content_tuples_list in headings_map.items():
+            for heading_text, content_tuples_list in selected_headings_map.items():
                 if heading_text not in content_payload_by_heading: content_payload_by_heading[heading_text] = {}
-                for _confidence, global_idx, content_string in content_tuples_list:
+                for _confidence, global_idx in content_tuples_list:
+                    content_string = content_store[global_idx]
                     if content_string and not content_string.isspace():
                         content_payload_by_heading[heading_text][str(global_idx)] = content_string; has_content_for_this_tag = True
             if not has_content_for_this_tag: print(f"No relevant content for tag '{tag_label}'. Skipping."); continue
-            payload_for_extraction_prompt = { "target_variables_to_extract": current_target_vars_for_extraction, "headings_with_relevant_content": content_payload_by_heading }
-            json_payload_for_prompt = json.dumps(payload_for_extraction_prompt, indent=2)
-            prompt_start = (
-    "You are an expert data extractor for systematic reviews. You are given the following JSON object. It contains:\n"
-    "1. 'target_variables_to_extract': A dictionary of variables you need to extract. For each variable (the key), the value is an object containing:\n"
-    "   - 'description': A detailed description of what this variable represents.\n"
-    "   - 'examples': (Optional) A list of example values to guide you.\n"
-    "   - 'notes_questions': (Optional) Specific notes, context, or guiding questions related to extracting this variable. You MUST consider these carefully if provided.\n"
-    "2. 'headings_with_relevant_content': A dictionary where keys are section headings from a research paper. The values for each heading are dictionaries where keys are unique content piece indices (as strings) and values are the content strings (these can be text paragraphs or tables formatted as GitHub Flavored Markdown) that have been deemed relevant to the 'target_variables_to_extract' under that heading.\n\n"
-    f"JSON INPUT DATA:\n```json\n{json_payload_for_prompt}\n```\n\n"
-    "**CRUCIAL INSTRUCTION FOR DATA SCOPE:**\n"
-    "When extracting values for the 'target_variables_to_extract', you MUST focus *exclusively* on information that describes the **primary research study** being conducted and reported in the provided content. "
-    "Do NOT extract data or values that pertain to **other studies, previous work, or background literature** that are merely cited or discussed. "
-    "If a target variable's specific value or detail is only found within the description of a cited study and not for the primary study's own methodology, sample, or results, then you should consider that value as 'Not Found' for the primary study.\n\n"
-    "Please extract the values for the specified target variables from the provided 'headings_with_relevant_content', adhering strictly to the data scope instruction above.\n"
-    "If a value cannot be found for the primary study with high confidence, set the \"value\" to 'Not Found'.\n\n"
-    "For each target variable you were asked to extract (from 'target_variables_to_extract'), provide:\n"
-    "- \"value\": The extracted value (string, number, boolean Y/N as appropriate, or 'Not Found').\n"
-    "- \"confidence\": Your confidence in the extraction (a float from 0.0 to 1.0).\n"
-    "- \"indices\": A list of a few (typically 1-5) unique content piece indices (strings, as provided in 'headings_with_relevant_content') that are **most directly relevant** to supporting your extracted 'value' and 'justification'. If the 'value' is 'Not Found' because the information is absent from the primary study, this list should ideally be empty `[]` or contain at most 1-2 indices that broadly confirm this absence.\n"
-    "- \"justification\": A **very brief** explanation (preferably a single concise sentence) of how you deduced the value for the primary study, referencing specific information from the content found at the provided indices.\n\n"
-    "Return your results as a single JSON object where keys are the exact variable names from the 'target_variables_to_extract' section of the input. Example format for the output JSON object structure:\n"
-    "```json\n"
-    "{\n"
-)
-            prompt_end = "\n}\n```\nYOUR ENTIRE RESPONSE MUST BE ONLY THIS VALID JSON OBJECT...\n"
-            variable_output_examples = [f'  "{var_name_example}": {{"value": "[extracted value or \'Not Found\']", "confidence": 0.0, "indices": ["string_index_1"], "justification": "[brief explanation]"}}' for var_name_example in current_target_vars_for_extraction.keys()]
-            prompt_middle_examples = ",\n".join(variable_output_examples)
-            full_extraction_prompt = prompt_start + prompt_middle_examples + prompt_end
-
+            content_payload_by_heading = {heading_text: payload for heading_text, payload in content_payload_by_heading.items() if payload}
+            tag_requests.append((tag_label, current_target_vars_for_extraction, content_payload_by_heading))
+
+        # 2. Group tags with overlapping evidence into shared calls (min_overlap above 1 keeps one call per tag)
+        extraction_groups = plan_extraction_groups(
+            tag_requests, EXTRACTION_MERGE_MIN_OVERLAP if MERGE_EXTRACTION_CALLS else 2.0,
+            EVIDENCE_TOKEN_BUDGET_PER_CALL, EXTRACTION_MERGE_MAX_VARIABLES)
+        document_merge_metrics = ExtractionMergeMetrics()
+        document_merge_metrics.add(extraction_groups)
+        self.extraction_merge_metrics.add(extraction_groups)
+
+        # 3. One call per group; each response is split back per variable
+        for extraction_group in extraction_groups:
+            tag_names = ", ".join(extraction_group.tag_labels)
+            quoted_tag_names = ", ".join(f"'{tag_label}'" for tag_label in extraction_group.tag_labels)
+            task_description_for_tag = f"Extraction for tag_label{'s' if len(extraction_group.tag_labels) > 1 else ''} {quoted_tag_names}"
+            if len(extraction_group.tag_labels) > 1:
+                print(f"\nMerged extraction call for tags {quoted_tag_names}: {len(extraction_group.target_variables)} variables, "
+                      f"~{extraction_group.evidence_tokens} evidence tokens instead of ~{extraction_group.separate_evidence_tokens}.")
+            current_target_vars_for_extraction = extraction_group.target_variables
+            compiled_prompt = self.prompt_compiler.extraction_prompt(current_target_vars_for_extraction, extraction_group.ordered_payload())
 
             for attempt in range(MAX_API_RETRIES + 1):
                 try:
                     if attempt > 0: # Only print attempt number for retries
-                        print(f"Extraction attempt {attempt + 1}/{MAX_API_RETRIES + 1} for tag: \"{tag_label}\"")
+                        print(f"Extraction attempt {attempt + 1}/{MAX_API_RETRIES + 1} for tag: \"{tag_names}\"")
                     
-                    response_obj = self.model.generate_content(
-                        [full_extraction_prompt], 
-                        generation_config=GENERATION_CONFIGURATION, 
-                        safety_settings=SAFETY_SETTINGS
-                    )
+                    response_obj = self._generate("extraction", compiled_prompt)
                     response_text = self._handle_llm_response_issues(response_obj, task_description_for_tag)
                     clean_response = remove_json_markdown(response_text)
                     response_dict = json.loads(clean_response)
@@ -312,17 +369,17 @@ class ParagraphClassifierClient:
                                     result_data['indices'] = [] 
                             else: 
                                 if 'indices' not in result_data:
-                                     print(f"Warning: 'indices' field missing for variable '{var_name_from_response}' under tag '{tag_label}'. Defaulting to empty list.")
+                                     print(f"Warning: 'indices' field missing for variable '{var_name_from_response}' under tag '{tag_names}'. Defaulting to empty list.")
                                 result_data['indices'] = []
                             extraction_results[var_name_from_response] = result_data
                     
                     if attempt == 0:
-                        print(f"Extraction successful for tag: \"{tag_label}\".")
+                        print(f"Extraction successful for tag: \"{tag_names}\".")
                     else:
-                        print(f"Extraction successful for tag: \"{tag_label}\" on attempt {attempt + 1}/{MAX_API_RETRIES + 1}.")
+                        print(f"Extraction successful for tag: \"{tag_names}\" on attempt {attempt + 1}/{MAX_API_RETRIES + 1}.")
                     break 
 
-                except (json.JSONDecodeError, ValueError, google_exceptions.GoogleAPIError) as e:
+                except (json.JSONDecodeError, ValueError, google_exceptions.GoogleAPIError, CallDeadlineExceeded) as e:
                     error_type = type(e).__name__
                     error_message = str(e)
                     attempt_msg_suffix = f" on attempt {attempt + 1}/{MAX_API_RETRIES + 1}" if attempt > 0 else " on initial attempt"
@@ -335,8 +392,11 @@ class ParagraphClassifierClient:
                     else:
                         final_error_message = f"{task_description_for_tag} failed after {MAX_API_RETRIES + 1} attempts: {error_type} - {error_message}"
                         print(final_error_message)
-                        raise RuntimeError(final_error_message) from e
+                        raise StageFailure(final_error_message) from e
         
+        print(document_evidence_metrics.summary("this document"))
+        if MERGE_EXTRACTION_CALLS:
+            print(document_merge_metrics.summary("this document"))
         print(f"\nCompleted extraction phase. Total variables extracted: {len(extraction_results)}")
         return extraction_results
 
@@ -351,12 +411,14 @@ def remove_json_markdown(text: str) -> str:
 
 
 def update_classified_data(
-    indexed_content_strings: list[str],
+    content_store: 'DocumentContentStore',
     par_classifier_client: 'ParagraphClassifierClient', # Use forward reference if class is defined later
     classified_paragraphs_data: dict,
     current_heading: str,
     section_content_strings_for_classification: list[str],
-    section_global_start_idx: int
+    section_global_start_idx: int,
+    dedup_index: 'ContentDedupIndex' = None,
+    document_name: str = ""
 ) -> int: # Returns the count of invalid label warnings for this section
     """
     Calls the classification client for a section's content, updates the
@@ -364,57 +426,126 @@ def update_classified_data(
     "invalid label" warnings encountered during this section's processing.
 
     Args:
-        indexed_content_strings (list[str]): The master list of all processed content strings
-                                             (paragraphs or Markdown tables) for the entire document,
-                                             used for looking up content by global index.
+        content_store (DocumentContentStore): All processed content pieces (paragraphs or Markdown tables)
+                                              of the document, used for looking up content by global index.
         par_classifier_client (ParagraphClassifierClient): The client object to call the
                                                            LLM for classification.
         classified_paragraphs_data (dict): The main dictionary (accumulating results for the
                                            entire document) to update with new classifications.
-                                           Format: {tag_label: {heading: [(confidence, global_idx, content_str)]}}
+                                           Format: {tag_label: {heading: [(confidence, global_idx)]}}
         current_heading (str): The text of the heading for the current section being processed.
         section_content_strings_for_classification (list[str]): The list of content strings
                                                                (paragraphs/tables) for the current section.
-        section_global_start_idx (int): The global starting index in indexed_content_strings
+        section_global_start_idx (int): The global starting index in content_store
                                         that corresponds to the first item in
                                         section_content_strings_for_classification.
+        dedup_index (ContentDedupIndex, optional): Corpus-wide near-duplicate index. Pieces with a known
+                                                   duplicate reuse its classification instead of being sent
+                                                   to the LLM, and newly classified pieces are recorded in it.
+        document_name (str): Name of the document being processed (for dedup statistics).
 
     Returns:
         int: The number of "invalid label" warnings generated for this section.
     """
-    invalid_label_warnings_this_section = 0
-
     if not section_content_strings_for_classification:
         print(f"No content strings provided for classification under heading: '{current_heading}'")
-        return invalid_label_warnings_this_section
+        return 0
+
+    strings_to_classify, cached_classifications = reuse_duplicate_classifications(
+        section_content_strings_for_classification, section_global_start_idx, dedup_index, document_name)
 
     # Get classifications from the LLM.
     # classify_section is expected to return a dictionary like:
     # {"global_idx_str": [["label1", conf1], ["label2", conf2]], ...}
-    classifications = par_classifier_client.classify_section(
-        current_heading,
-        section_content_strings_for_classification,
-        section_global_start_idx
-    )
+    classifications = {}
+    if any(content_string and not content_string.isspace() for content_string in strings_to_classify):
+        classifications = par_classifier_client.classify_section(
+            current_heading,
+            strings_to_classify,
+            section_global_start_idx
+        )
+    else:
+        print(f"All {len(cached_classifications)} content pieces under heading '{current_heading}' reused previous classifications.")
+
+    return merge_section_classifications(
+        content_store, classified_paragraphs_data, current_heading, section_global_start_idx,
+        strings_to_classify, classifications, cached_classifications, dedup_index, document_name)
+
+
+def reuse_duplicate_classifications(
+    section_content_strings: list[str],
+    section_global_start_idx: int,
+    dedup_index: 'ContentDedupIndex' = None,
+    document_name: str = ""
+) -> tuple[list[str], dict]:
+    """
+    Reuses the classification of exact duplicates, and skips near duplicates of known-irrelevant boilerplate.
+    Duplicates are blanked out rather than removed so the remaining pieces keep their global indices;
+    the classification prompts drop blank content from the payload.
+
+    Returns:
+        tuple: (strings_to_classify, cached_classifications) where cached_classifications is
+               {"global_idx_str": [[label, confidence], ...]} for the pieces found in the index.
+    """
+    if dedup_index is None:
+        return section_content_strings, {}
+    cached_classifications = {}
+    strings_to_classify = []
+    for local_idx, content_string in enumerate(section_content_strings):
+        cached_labels = dedup_index.lookup(content_string, document_name)
+        if cached_labels is None:
+            strings_to_classify.append(content_string)
+        else:
+            cached_classifications[str(section_global_start_idx + local_idx)] = cached_labels
+            strings_to_classify.append("")
+    return strings_to_classify, cached_classifications
+
+
+def merge_section_classifications(
+    content_store: 'DocumentContentStore',
+    classified_paragraphs_data: dict,
+    current_heading: str,
+    section_global_start_idx: int,
+    strings_to_classify: list[str],
+    classifications: dict,
+    cached_classifications: dict,
+    dedup_index: 'ContentDedupIndex' = None,
+    document_name: str = ""
+) -> int:
+    """
+    Validates a section's classifications (from the LLM, plus those reused from duplicates), adds them to
+    classified_paragraphs_data under current_heading and records the LLM's decisions in the dedup index.
+
+    Returns:
+        int: The number of "invalid label" warnings generated for this section.
+    """
+    invalid_label_warnings_this_section = 0
+    classifications = dict(classifications)
+    classified_by_llm = set(classifications.keys())
+    classifications.update(cached_classifications)
 
     if not classifications:
         print(f"No classifications returned from LLM for section: '{current_heading}'")
+        if dedup_index is not None:
+            for content_string in strings_to_classify:
+                dedup_index.record(content_string, [], document_name)
         return invalid_label_warnings_this_section
 
+    valid_labels_by_idx = {} # {global_idx: [[label, confidence], ...]} of labels that passed validation
+
     for global_idx_str, labels_with_confidences in classifications.items():
         try:
             global_idx = int(global_idx_str)
 
             # Validate the global index
-            if not (0 <= global_idx < len(indexed_content_strings)):
+            if not (0 <= global_idx < len(content_store)):
                 print(f"Warning: Classified global index {global_idx} (from string '{global_idx_str}') is out of bounds "
-                      f"for indexed_content_strings (length: {len(indexed_content_strings)}). Skipping this index.")
+                      f"for the document's content store (length: {len(content_store)}). Skipping this index.")
                 # Incrementing warning here might be too aggressive if it's an LLM indexing error.
                 # Let's assume for now this is a rare case and doesn't count towards "invalid label" warnings,
                 # but rather a structural issue in the LLM response for indices.
                 continue
-            
-            actual_content_string = indexed_content_strings[global_idx]
+
 
             if not labels_with_confidences: # If the list of labels for this index is empty
                 continue
@@ -437,10 +568,11 @@ def update_classified_data(
                         if current_heading not in classified_paragraphs_data[label]:
                             classified_paragraphs_data[label][current_heading] = []
                         
-                        # Append (confidence, global_idx, actual_content_string)
+                        # Append (confidence, global_idx); the content itself stays in content_store
                         classified_paragraphs_data[label][current_heading].append(
-                            (confidence_float, global_idx, actual_content_string)
+                            (confidence_float, global_idx)
                         )
+                        valid_labels_by_idx.setdefault(global_idx, []).append([label, confidence_float])
                     else:
                         # This is the specific warning the user is interested in tracking
                         print(f"Warning: Classified label '{label}' (confidence: {confidence_float}) for content index {global_idx} "
@@ -461,227 +593,459 @@ def update_classified_data(
             invalid_label_warnings_this_section += 1
 
 
+    # Record what the LLM decided for newly classified pieces; pieces it left out are not relevant to any label.
+    if dedup_index is not None:
+        for local_idx, content_string in enumerate(strings_to_classify):
+            global_idx = section_global_start_idx + local_idx
+            if content_string and str(global_idx) not in cached_classifications:
+                if str(global_idx) in classified_by_llm and global_idx not in valid_labels_by_idx:
+                    continue # The LLM returned only invalid labels for this piece; do not cache that
+                dedup_index.record(content_string, valid_labels_by_idx.get(global_idx, []), document_name)
+
     if invalid_label_warnings_this_section > 0:
         print(f"Section '{current_heading}' generated {invalid_label_warnings_this_section} 'invalid label' related warnings.")
         
     return invalid_label_warnings_this_section
 
     
-def process_document(file_path: str, par_classifier_client: 'ParagraphClassifierClient'):
+def whole_document_fallback_reason(content_store: 'DocumentContentStore') -> str:
+    """
+    Returns why a document is too large for whole-document classification (estimated prompt tokens over
+    WHOLE_DOCUMENT_MAX_INPUT_TOKENS, or expected output over the model's max_output_tokens), or "" if it fits.
+    """
+    estimated_input_tokens = content_store.total_characters() // 4
+    if estimated_input_tokens > WHOLE_DOCUMENT_MAX_INPUT_TOKENS:
+        return f"~{estimated_input_tokens} content tokens exceed WHOLE_DOCUMENT_MAX_INPUT_TOKENS ({WHOLE_DOCUMENT_MAX_INPUT_TOKENS})."
+    estimated_output_tokens = len(content_store) * PLAN_CLASSIFICATION_OUTPUT_TOKENS_PER_PIECE
+    max_output_tokens = GENERATION_CONFIGURATION.get("max_output_tokens", 0)
+    if max_output_tokens and estimated_output_tokens > max_output_tokens:
+        return f"~{estimated_output_tokens} expected output tokens for {len(content_store)} content pieces exceed max_output_tokens ({max_output_tokens})."
+    return ""
+
+
+def split_classifications_by_section(classifications: dict, sections: list) -> list[dict]:
+    """
+    Distributes a whole-document classification response ({"global_idx_str": labels}) over sections
+    [(heading, start_idx, end_idx)]. Keys that are not an index of any section go to the last section,
+    where merge_section_classifications reports them like any malformed or out-of-bounds index.
+    """
+    section_starts = [section_start_idx for _heading, section_start_idx, _end in sections]
+    classifications_by_section = [{} for _section in sections]
+    for global_idx_str, labels_with_confidences in classifications.items():
+        position = len(sections) - 1
+        try:
+            global_idx = int(global_idx_str)
+            candidate = bisect.bisect_right(section_starts, global_idx) - 1
+            if candidate >= 0 and global_idx < sections[candidate][2]:
+                position = candidate
+        except ValueError:
+            pass
+        classifications_by_section[position][global_idx_str] = labels_with_confidences
+    return classifications_by_section
+
+
+def classify_document_sections(
+    content_store: 'DocumentContentStore',
+    par_classifier_client: 'ParagraphClassifierClient',
+    classified_paragraphs_data: dict,
+    sections: list,
+    dedup_index: 'ContentDedupIndex' = None,
+    document_name: str = ""
+):
+    """
+    Whole-document classification: reuses duplicate classifications for every section, classifies all
+    remaining content pieces in one call and merges the results section by section, producing the same
+    classified_paragraphs_data as per-section classification.
+
+    Yields:
+        tuple: (heading, invalid label warnings) per section, in document order.
+    """
+    section_filters = [
+        reuse_duplicate_classifications(
+            [content_store[global_idx] for global_idx in range(section_start_idx, section_end_idx)],
+            section_start_idx, dedup_index, document_name)
+        for _heading, section_start_idx, section_end_idx in sections]
+    section_payloads = [
+        (heading, {str(section_start_idx + local_idx): content_string for local_idx, content_string in enumerate(strings_to_classify)})
+        for (heading, section_start_idx, _end), (strings_to_classify, _cached) in zip(sections, section_filters)]
+
+    document_classifications = {}
+    if any(content_string and not content_string.isspace()
+           for strings_to_classify, _cached in section_filters for content_string in strings_to_classify):
+        document_classifications = par_classifier_client.classify_document(document_name, section_payloads)
+    else:
+        print(f"All content pieces of {document_name} reused previous classifications.")
+
+    classifications_by_section = split_classifications_by_section(document_classifications, sections)
+    for (heading, section_start_idx, _end), (strings_to_classify, cached_classifications), section_classifications in zip(
+            sections, section_filters, classifications_by_section):
+        yield heading, merge_section_classifications(
+            content_store, classified_paragraphs_data, heading, section_start_idx,
+            strings_to_classify, section_classifications, cached_classifications, dedup_index, document_name)
+
+
+def process_document(file_path: str, par_classifier_client: 'ParagraphClassifierClient', dedup_index: 'ContentDedupIndex' = None,
+                     parsed_document: 'ParsedDocument' = None):
     """
     Reads a Word document, converts tables to Markdown, processes content into sections
-    up to (but not including) a 'Heading 2' titled 'REFERENCES', classifies them,
+    (dropping references, acknowledgements, appendices etc. as set by SECTION_SKIP_RULES, detecting headings
+    and splitting oversized sections if the document has no heading styles), classifies them,
     and prepares data for extraction. Stops if too many invalid label warnings occur.
 
     Args:
         file_path (str): The path to the Word document.
         par_classifier_client (ParagraphClassifierClient): The client for classifying content.
+        dedup_index (ContentDedupIndex, optional): Corpus-wide near-duplicate index used to skip
+                                                   already classified content pieces.
+        parsed_document (ParsedDocument, optional): The document already parsed and sectioned (e.g., by a
+                                                    ParsePrefetcher worker). Parsed here if not given.
 
     Returns:
-        tuple: (classified_paragraphs_data, final_indexed_content_strings, final_document_content_pieces_info)
-               Returns ({}, [], []) if critical error like file not found or initial processing fails.
-               Can raise RuntimeError if MAX_INVALID_LABEL_WARNINGS_PER_DOC is exceeded.
+        tuple: (classified_paragraphs_data, content_store, content_store.pieces)
+               where content_store is the DocumentContentStore holding the processed (non-heading) content
+               pieces by global index and content_store.pieces their ContentPiece metadata (type, style).
+               Returns ({}, empty store, []) if critical error like file not found or initial processing fails.
+               Can raise StageFailure if MAX_INVALID_LABEL_WARNINGS_PER_DOC is exceeded.
     """
     print(f"Processing document: {file_path}")
-    try:
-        doc = docx.Document(file_path)
-    except Exception as e:
-        print(f"Error opening document {file_path}: {e}")
-        return {}, [], [] # Return empty structures on open failure
-
-    # 1. Populate raw_document_content_pieces (all pieces from the doc with type, content, style)
-    raw_document_content_pieces = []
-    # Ensure access to python-docx objects for ._element comparison
-    all_paragraphs_in_doc = list(doc.paragraphs)
-    all_tables_in_doc = list(doc.tables)
-    
-    iter_paragraphs = iter(all_paragraphs_in_doc)
-    iter_tables = iter(all_tables_in_doc)
-
-    current_para_obj = next(iter_paragraphs, None)
-    current_table_obj = next(iter_tables, None)
-
-    # Iterate through the top-level block elements in the document body
-    for block_xml_element in doc.element.body:
-        if block_xml_element.tag.endswith('p'): # It's a paragraph
-            if current_para_obj and block_xml_element == current_para_obj._element:
-                raw_document_content_pieces.append({
-                    "type": "paragraph", 
-                    "content": current_para_obj.text, 
-                    "style": current_para_obj.style.name
-                })
-                current_para_obj = next(iter_paragraphs, None)
-        elif block_xml_element.tag.endswith('tbl'): # It's a table
-            if current_table_obj and block_xml_element == current_table_obj._element:
-                markdown_table = docx_table_to_markdown(current_table_obj)
-                raw_document_content_pieces.append({
-                    "type": "table_markdown", 
-                    "content": markdown_table, 
-                    "style": "Table" # Conceptual style name for tables
-                })
-                current_table_obj = next(iter_tables, None)
-    
-    if not raw_document_content_pieces:
+    document_name = os.path.basename(file_path)
+
+    # 1. Parse and section the document (paragraphs and Markdown tables, without sections matched by skip rules)
+    if parsed_document is None:
+        parsed_document = parse_document(file_path, **document_parse_options())
+    if parsed_document.error:
+        print(parsed_document.error)
+        return {}, DocumentContentStore(), [] # Return empty structures on open failure
+    for note in parsed_document.notes:
+        print(note)
+    if parsed_document.skip_report():
+        print(parsed_document.skip_report())
+    if not parsed_document.raw_piece_count:
         print(f"No content (paragraphs or tables) could be parsed from {file_path}.")
-        return {}, [], []
+        return {}, DocumentContentStore(), []
 
-    # 2. Process pieces up to "References", managing warnings
-    final_indexed_content_strings = []       # List of content strings (no headings) actually processed
-    final_document_content_pieces_info = [] # List of dicts for these processed content strings (for type info)
+    # 2. Classify each section, managing warnings
+    content_store = parsed_document.content_store
 
     # Assumes PARAGRAPH_TAG_DESCRIPTIONS and MAX_INVALID_LABEL_WARNINGS_PER_DOC are imported from config
     classified_paragraphs_data = {par_tag: {} for par_tag in PARAGRAPH_TAG_DESCRIPTIONS.keys()}
-    current_heading_text = "Default Heading (Document Start)" 
-    section_content_strings_for_classification = [] 
-    current_section_actual_start_idx = 0 
-    stop_processing_flag = False
     total_invalid_label_warnings_for_this_doc = 0
 
-    for raw_piece_data in raw_document_content_pieces:
-        content_string = raw_piece_data["content"]
-        style_name = raw_piece_data["style"]
-        
-        is_heading_1 = style_name == 'Heading 1'
-        is_heading_2 = style_name == 'Heading 2'
-        is_any_heading = is_heading_1 or is_heading_2
-
-        # Check for the "References" stop condition
-        if is_heading_2 and content_string.strip().upper() == 'REFERENCES':
-            print(f"Found '{content_string}' (Heading 2). Processing any preceding content and then stopping.")
-            if section_content_strings_for_classification:
-                warnings_in_section = update_classified_data(
-                    final_indexed_content_strings, par_classifier_client, classified_paragraphs_data,
-                    current_heading_text, section_content_strings_for_classification,
-                    current_section_actual_start_idx)
-                total_invalid_label_warnings_for_this_doc += warnings_in_section
-                
-                # Check warning threshold immediately after processing the section
-                if MAX_INVALID_LABEL_WARNINGS_PER_DOC >= 0 and \
-                   total_invalid_label_warnings_for_this_doc > MAX_INVALID_LABEL_WARNINGS_PER_DOC:
-                    print(f"Exceeded maximum allowed invalid label warnings ({total_invalid_label_warnings_for_this_doc} > {MAX_INVALID_LABEL_WARNINGS_PER_DOC}) for document {file_path} before 'REFERENCES'.")
-                    raise RuntimeError(f"Too many invalid label warnings for document {os.path.basename(file_path)}. Processing stopped.")
-
-            stop_processing_flag = True
-            break # Exit loop, do not process "References" heading or anything after
-
-        if is_any_heading:
-            # Process the previously accumulated section under the *old* heading
-            if section_content_strings_for_classification:
-                warnings_in_section = update_classified_data(
-                    final_indexed_content_strings, par_classifier_client, classified_paragraphs_data,
-                    current_heading_text, section_content_strings_for_classification,
-                    current_section_actual_start_idx)
-                total_invalid_label_warnings_for_this_doc += warnings_in_section
-
-                if MAX_INVALID_LABEL_WARNINGS_PER_DOC >= 0 and \
-                   total_invalid_label_warnings_for_this_doc > MAX_INVALID_LABEL_WARNINGS_PER_DOC:
-                    print(f"Exceeded maximum allowed invalid label warnings ({total_invalid_label_warnings_for_this_doc} > {MAX_INVALID_LABEL_WARNINGS_PER_DOC}) for document {file_path}.")
-                    raise RuntimeError(f"Too many invalid label warnings for document {os.path.basename(file_path)}. Processing stopped.")
-            
-            # Reset for new section, with the current piece being the new heading
-            current_heading_text = content_string 
-            section_content_strings_for_classification = []
-            # The content for this new heading will start at the current length of final_indexed_content_strings
-            current_section_actual_start_idx = len(final_indexed_content_strings)
+    classification_mode = CLASSIFICATION_MODE
+    if classification_mode == "document":
+        fallback_reason = whole_document_fallback_reason(content_store)
+        if fallback_reason:
+            print(f"Using per-section classification for {document_name}: {fallback_reason}")
+            classification_mode = "section"
+    run_budget = par_classifier_client.run_budget
+    classification_started = time.monotonic()
+    calls_before = par_classifier_client.call_policy.telemetry["calls"]
+    input_tokens_before, output_tokens_before = run_budget.input_tokens, run_budget.output_tokens
+
+    # (heading, warnings) per section; sections are classified lazily so a warning overflow stops further calls
+    if classification_mode == "document":
+        section_warnings = classify_document_sections(
+            content_store, par_classifier_client, classified_paragraphs_data,
+            parsed_document.sections, dedup_index, document_name)
+    else:
+        section_warnings = (
+            (current_heading_text, update_classified_data(
+                content_store, par_classifier_client, classified_paragraphs_data,
+                current_heading_text, [content_store[global_idx] for global_idx in range(section_start_idx, section_end_idx)],
+                section_start_idx, dedup_index, document_name))
+            for current_heading_text, section_start_idx, section_end_idx in parsed_document.sections)
+
+    with stage_profiler.stage("classification", document_name):
+        for current_heading_text, warnings_in_section in section_warnings:
+            total_invalid_label_warnings_for_this_doc += warnings_in_section
+
+            # Check warning threshold immediately after processing the section
+            if MAX_INVALID_LABEL_WARNINGS_PER_DOC >= 0 and \
+               total_invalid_label_warnings_for_this_doc > MAX_INVALID_LABEL_WARNINGS_PER_DOC:
+                print(f"Exceeded maximum allowed invalid label warnings ({total_invalid_label_warnings_for_this_doc} > {MAX_INVALID_LABEL_WARNINGS_PER_DOC}) for document {file_path} in section '{current_heading_text}'.")
+                raise StageFailure(f"Too many invalid label warnings for document {document_name}. Processing stopped.")
+    
+    input_tokens = run_budget.input_tokens - input_tokens_before
+    output_tokens = run_budget.output_tokens - output_tokens_before
+    print(f"Classification of {document_name} ({classification_mode} mode): "
+          f"{par_classifier_client.call_policy.telemetry['calls'] - calls_before} call(s), {time.monotonic() - classification_started:.1f}s, "
+          f"{input_tokens} input / {output_tokens} output tokens "
+          f"(~{estimate_cost(input_tokens, output_tokens, MODEL_INPUT_PRICE_PER_1M_TOKENS, MODEL_OUTPUT_PRICE_PER_1M_TOKENS):.4f} {PRICE_CURRENCY}).")
+
+    if not content_store: # Had raw pieces but none made it to final processing
+        print(f"Content processing may have stopped very early (e.g., a stop rule such as 'References' at document start or all content skipped) in {file_path}.")
+
+    if dedup_index is not None:
+        print(dedup_index.document_report(document_name))
+
+    return classified_paragraphs_data, content_store, content_store.pieces
+
+
+def document_parse_options() -> dict:
+    """
+    Keyword arguments of parse_document (and ParsePrefetcher) from config: skip rules and fallback segmentation.
+    Sections of styled documents are only split when their expected classification output exceeds max_output_tokens.
+    """
+    max_output_tokens = GENERATION_CONFIGURATION.get("max_output_tokens", 0)
+    return {"skip_rules": SECTION_SKIP_RULES, "detect_headings": DETECT_HEADINGS_WITHOUT_STYLES,
+            "max_section_pieces": MAX_SECTION_CONTENT_PIECES, "max_section_tokens": MAX_SECTION_CONTENT_TOKENS,
+            "max_heading_characters": HEADING_DETECTION_MAX_CHARACTERS,
+            "max_styled_section_pieces": max_output_tokens // max(PLAN_CLASSIFICATION_OUTPUT_TOKENS_PER_PIECE, 1)}
+
+
+def codebook_signature() -> str:
+    """Hashes the paragraph tags and model so cached classifications are only reused with the same codebook."""
+    signature_source = json.dumps({"model": GEMINI_MODEL, "tags": PARAGRAPH_TAG_DESCRIPTIONS}, sort_keys=True)
+    return hashlib.sha256(signature_source.encode("utf-8")).hexdigest()
+
+
+def list_input_documents(input_dir: str = INPUT_DIR) -> list[str]:
+    """Returns the DOCX filenames in input_dir (skipping Word lock files), sorted so every worker sees the same order."""
+    return sorted(f for f in os.listdir(input_dir)
+                  if os.path.isfile(os.path.join(input_dir, f)) and f.lower().endswith(".docx") and not f.startswith("~"))
+
+
+def load_dedup_index(filepath: str = DEDUP_INDEX_FILEPATH):
+    """Loads the persistent near-duplicate index from filepath, or returns None if ENABLE_CONTENT_DEDUP is off."""
+    if not ENABLE_CONTENT_DEDUP:
+        return None
+    return ContentDedupIndex.load(
+        filepath, codebook_signature(),
+        similarity_threshold=DEDUP_SIMILARITY_THRESHOLD,
+        min_characters=DEDUP_MIN_CHARACTERS)
+
+
+def open_results_store():
+    """Opens the cross-run results database, or returns None if ENABLE_RESULTS_STORE is off or it cannot be opened."""
+    if not ENABLE_RESULTS_STORE:
+        return None
+    try:
+        return ResultsStore(RESULTS_DB_FILEPATH)
+    except sqlite3.Error as e:
+        print(f"Warning: Could not open results database {RESULTS_DB_FILEPATH} ({e}). Results will only be written to Excel.")
+        return None
+
+
+def store_document_results(results_store: 'ResultsStore', run_id: str, file_path: str, document_rows: list[dict],
+                           input_tokens: int = 0, output_tokens: int = 0, document_hash: str = None):
+    """Upserts one document's rows into the results database; a database error is reported but does not stop the run."""
+    if results_store is None:
+        return
+    try:
+        results_store.upsert_document(run_id, document_hash or file_sha256(file_path), os.path.basename(file_path), document_rows,
+                                      GEMINI_MODEL, input_tokens, output_tokens)
+    except (sqlite3.Error, OSError) as e:
+        print(f"Warning: Could not store results of {os.path.basename(file_path)} in {RESULTS_DB_FILEPATH}: {e}")
+
+
+def finish_results_run(results_store: 'ResultsStore', run_id: str, status: str, par_classifier_client: 'ParagraphClassifierClient' = None):
+    """Records a run's final status and token usage, writes its Parquet partition if configured and closes the database."""
+    if results_store is None:
+        return
+    try:
+        run_budget = par_classifier_client.run_budget if par_classifier_client is not None else None
+        results_store.finish_run(run_id, status,
+                                 run_budget.input_tokens if run_budget else 0,
+                                 run_budget.output_tokens if run_budget else 0)
+        print(f"Results of run '{run_id}' stored in {RESULTS_DB_FILEPATH}.")
+        if RESULTS_PARQUET_DIR:
+            written = results_store.export_parquet(RESULTS_PARQUET_DIR, run_id)
+            print(f"Wrote {written} rows to {RESULTS_PARQUET_DIR} (partition run_id={run_id}).")
+    except (sqlite3.Error, OSError, RuntimeError) as e:
+        print(f"Warning: Could not finalize run '{run_id}' in the results database: {e}")
+    finally:
+        results_store.close()
+
+
+def process_single_document(file_path: str, par_classifier_client: 'ParagraphClassifierClient', dedup_index: 'ContentDedupIndex' = None,
+                            parsed_document: 'ParsedDocument' = None) -> tuple[list[dict], dict]:
+    """
+    Classifies and extracts one document and returns its output rows (one per extracted variable).
+    parsed_document is the prefetched parse of file_path, if available.
+
+    Returns:
+        tuple: (document_rows, referenced_content) where referenced_content is {global_idx: content text}
+               of the content pieces cited by the rows (for a separate content sheet).
+
+    Raises:
+        DocumentProcessingError: If any stage fails for this document (e.g., StageFailure from the client after
+                                 retries, or too many invalid label warnings). Carries the failed stage.
+    """
+    filename = os.path.basename(file_path)
+
+    # Functions called here (process_document, which calls client methods) raise StageFailure after their
+    # internal retries fail. Only expected failures are dead-lettered; anything else is a bug and propagates.
+    stage = "classification"
+    try:
+        classified_paragraph_data, content_store, document_content_pieces_info = \
+            process_document(file_path, par_classifier_client, dedup_index, parsed_document) 
+        if dedup_index is not None:
+            dedup_index.save() # Appends this document's new entries, so a later halt keeps what was learned
         
-        else: # It's a content piece (paragraph or table markdown)
-            # If this is the first content piece for the current_heading_text
-            if not section_content_strings_for_classification: 
-                # Set/Confirm the starting global index for this batch of content pieces
-                current_section_actual_start_idx = len(final_indexed_content_strings)
-            
-            section_content_strings_for_classification.append(content_string)
+        if not content_store: # Check if process_document yielded any content
+            print(f"No processable content found in {filename} or processing stopped early within it. Skipping extraction for this file.")
+            return [], {}
+
+        stage = "extraction"
+        with stage_profiler.stage("extraction", filename):
+            extracted_results = par_classifier_client.extract_target_variables(classified_paragraph_data, content_store)
+    except (StageFailure, google_exceptions.GoogleAPIError, CallDeadlineExceeded) as e:
+        raise DocumentProcessingError(filename, stage, e) from e
+    
+    document_rows = []
+    referenced_content = {}
+    for var_name, extraction_info in extracted_results.items():
+        relevant_paragraphs_output = []
+        if 'indices' in extraction_info and isinstance(extraction_info["indices"], list):
+            valid_indices = [idx for idx in extraction_info["indices"] 
+                             if isinstance(idx, int) and 0 <= idx < len(content_store)]
+            if len(valid_indices) != len(extraction_info.get("indices", [])): # Use .get for safety
+                print(f"Warning: Some indices for variable '{var_name}' in '{filename}' were invalid or out of bounds.")
             
-            # Add this content piece to the lists that will be returned and used for global indexing
-            final_indexed_content_strings.append(content_string)
-            final_document_content_pieces_info.append(raw_piece_data) 
-
-    # After the loop, if we didn't stop early (e.g., "References" not found),
-    # process the very last accumulated section.
-    if not stop_processing_flag and section_content_strings_for_classification:
-        warnings_in_section = update_classified_data(
-            final_indexed_content_strings, par_classifier_client, classified_paragraphs_data,
-            current_heading_text, section_content_strings_for_classification,
-            current_section_actual_start_idx)
-        total_invalid_label_warnings_for_this_doc += warnings_in_section
-
-        if MAX_INVALID_LABEL_WARNINGS_PER_DOC >= 0 and \
-           total_invalid_label_warnings_for_this_doc > MAX_INVALID_LABEL_WARNINGS_PER_DOC:
-            print(f"Exceeded maximum allowed invalid label warnings ({total_invalid_label_warnings_for_this_doc} > {MAX_INVALID_LABEL_WARNINGS_PER_DOC}) for document {file_path} after processing final section.")
-            raise RuntimeError(f"Too many invalid label warnings for document {os.path.basename(file_path)}. Processing stopped.")
+            for global_idx in valid_indices:
+                if 0 <= global_idx < len(document_content_pieces_info): # Additional check
+                    content_prefix = "[Table MD] " if document_content_pieces_info[global_idx].type == "table_markdown" else ""
+                    referenced_content[global_idx] = f"{content_prefix}{content_store[global_idx]}"
+                    relevant_paragraphs_output.append(f"Index {global_idx}: {referenced_content[global_idx]}")
+                else:
+                    relevant_paragraphs_output.append(f"Index {global_idx}: [Error retrieving content piece info - index out of bounds]")
+
+        document_rows.append({
+            "filename": filename,
+            "variable": var_name,
+            "relevant_paragraphs_or_tables": "\n---\n".join(relevant_paragraphs_output),
+            "extracted_value": extraction_info.get("value", "Not Found"),
+            "confidence": extraction_info.get("confidence", 0.0),
+            "justification": extraction_info.get("justification", ""),
+            "human_verified_response": "",
+            "indices": valid_indices if 'indices' in extraction_info and isinstance(extraction_info["indices"], list) else []
+        })
+    return document_rows, referenced_content
+
+
+def save_results(all_results_for_excel: list[dict], status_suffix: str):
+    """Writes the result rows to a timestamped workbook in OUTPUT_DIR, falling back to CSV if the Excel save fails."""
+    with stage_profiler.stage("output"):
+        df = pd.DataFrame(all_results_for_excel)
+        df = df[[column for column in EXCEL_COLUMNS if column in df.columns]] # Drop internal fields (indices, document_hash, ...)
+        if df.empty:
+            print("DataFrame is empty, not saving an empty file.")
+            return
+
+        now = datetime.datetime.now()
+        timestamp = now.strftime("%Y-%m-%d_%H-%M-%S")
+        output_file = os.path.join(OUTPUT_DIR, f"extracted_data_{timestamp}{status_suffix}.xlsx")
     
-    if not final_indexed_content_strings and raw_document_content_pieces: # Had raw pieces but none made it to final processing
-        print(f"Content processing may have stopped very early (e.g., 'REFERENCES' at document start or all content filtered out) in {file_path}.")
-    elif not raw_document_content_pieces: # Already handled this at the start, but as a final check.
-        pass # Initial message about no content parsed would have been printed.
+        try:
+            df.to_excel(output_file, index=False)
+            print(f"Results saved to: {output_file}")
+        except Exception as e_save:
+            print(f"CRITICAL: Failed to save results to Excel: {e_save}")
+            # Fallback CSV save attempt
+            csv_output_file = os.path.join(OUTPUT_DIR, f"extracted_data_{timestamp}{status_suffix}.csv")
+            try:
+                df.to_csv(csv_output_file, index=False)
+                print(f"Successfully saved results as CSV to: {csv_output_file}")
+            except Exception as e_csv_save:
+                print(f"CRITICAL: Failed to save results to CSV as fallback: {e_csv_save}")
+
+
+def print_run_summaries(par_classifier_client: 'ParagraphClassifierClient', dedup_index: 'ContentDedupIndex'):
+    """Prints the end-of-run token and evidence reports and persists (and compacts) the dedup index."""
+    print(par_classifier_client.token_ledger.summary())
+    print(par_classifier_client.evidence_metrics.summary("run"))
+    if MERGE_EXTRACTION_CALLS:
+        print(par_classifier_client.extraction_merge_metrics.summary("run"))
+    print(par_classifier_client.call_policy.summary())
+    print(par_classifier_client.model.summary())
+    print(par_classifier_client.run_budget.summary())
+    if dedup_index is not None:
+        try:
+            dedup_index.compact()
+        except OSError as e_dedup_save:
+            print(f"Warning: Failed to save dedup index: {e_dedup_save}")
 
-    return classified_paragraphs_data, final_indexed_content_strings, final_document_content_pieces_info
 
+def main(files_to_process: list[str] = None):
+    """
+    Processes documents in this process and writes one workbook. A document that fails is recorded in the
+    dead-letter file and skipped, so the rest of the run continues (unless HALT_ON_DOCUMENT_ERROR is set).
 
-def main():
+    Args:
+        files_to_process (list[str], optional): Filenames in INPUT_DIR to process (e.g., the dead-lettered ones
+                                                for 'retry-failed'). Defaults to every DOCX in INPUT_DIR.
+    """
     os.makedirs(OUTPUT_DIR, exist_ok=True)
     par_classifier_client = ParagraphClassifierClient()
+    dedup_index = load_dedup_index()
+    dead_letter_queue = DeadLetterQueue(DEAD_LETTER_FILEPATH)
+    run_id = new_run_id()
+    results_store = open_results_store()
+    if results_store is not None:
+        results_store.start_run(run_id, "run" if files_to_process is None else "retry-failed", GEMINI_MODEL, codebook_signature())
     
-    all_results_for_excel = []
+    # Rows are written as each document completes (rolling over into parts for large corpora)
+    results_writer = StreamingResultsWriter(
+        OUTPUT_DIR, f"extracted_data_{datetime.datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}",
+        file_format=OUTPUT_FILE_FORMAT, max_rows_per_part=OUTPUT_MAX_ROWS_PER_PART,
+        max_characters_per_part=OUTPUT_MAX_CHARACTERS_PER_PART, content_sheet=OUTPUT_CONTENT_SHEET)
+    failed_documents = []   # DocumentProcessingError per failed document
+    succeeded_documents = []
     processing_halted_early = False
     halt_message = "" # To store the reason for halting
+    budget_message = "" # Set if the run budget stopped scheduling new documents
+    unscheduled_documents = []
 
     try:
         print("Starting document processing. Press Control+C to interrupt and attempt to save progress.")
-        files_to_process = [f for f in os.listdir(INPUT_DIR) if os.path.isfile(os.path.join(INPUT_DIR, f)) and f.lower().endswith(".docx") and not f.startswith("~")]
+        if files_to_process is None:
+            files_to_process = list_input_documents()
         
         if not files_to_process:
-            print(f"No DOCX files found in the input directory: {INPUT_DIR}")
+            print(f"No DOCX files found to process in the input directory: {INPUT_DIR}")
         
-        for filename in files_to_process:
-            file_path = os.path.join(INPUT_DIR, filename)
-            print(f"\n>>> Starting processing for document: {filename}")
-            
-            # Functions called here (process_document, which calls client methods)
-            # can raise RuntimeError after their internal retries fail.
-            classified_paragraph_data, indexed_content_strings, document_content_pieces_info = \
-                process_document(file_path, par_classifier_client) 
-            
-            if not indexed_content_strings: # Check if process_document yielded any content
-                print(f"No processable content found in {filename} or processing stopped early within it. Skipping extraction for this file.")
-                continue
-
-            extracted_results = par_classifier_client.extract_target_variables(classified_paragraph_data)
-            
-            # Append results for the current successfully processed document
-            for var_name, extraction_info in extracted_results.items():
-                relevant_paragraphs_output = []
-                if 'indices' in extraction_info and isinstance(extraction_info["indices"], list):
-                    valid_indices = [idx for idx in extraction_info["indices"] 
-                                     if isinstance(idx, int) and 0 <= idx < len(indexed_content_strings)]
-                    if len(valid_indices) != len(extraction_info.get("indices", [])): # Use .get for safety
-                        print(f"Warning: Some indices for variable '{var_name}' in '{filename}' were invalid or out of bounds.")
-                    
-                    for global_idx in valid_indices:
-                        if 0 <= global_idx < len(document_content_pieces_info): # Additional check
-                            content_piece_data = document_content_pieces_info[global_idx]
-                            content_prefix = "[Table MD] " if content_piece_data.get("type") == "table_markdown" else "" # Use .get for safety
-                            relevant_paragraphs_output.append(f"Index {global_idx}: {content_prefix}{indexed_content_strings[global_idx]}")
-                        else:
-                            relevant_paragraphs_output.append(f"Index {global_idx}: [Error retrieving content piece info - index out of bounds]")
-
-                all_results_for_excel.append({
-                    "filename": filename,
-                    "variable": var_name,
-                    "relevant_paragraphs_or_tables": "\n---\n".join(relevant_paragraphs_output),
-                    "extracted_value": extraction_info.get("value", "Not Found"),
-                    "confidence": extraction_info.get("confidence", 0.0),
-                    "justification": extraction_info.get("justification", ""),
-                    "human_verified_response": "" 
-                })
-            print(f"<<< Successfully processed and extracted from {filename}")
+        # Upcoming documents are parsed in background processes while the current one is in LLM calls
+        file_paths = [os.path.join(INPUT_DIR, filename) for filename in files_to_process]
+        # When profiling, parse in this process so the "parse" stage is captured
+        parse_workers = 0 if stage_profiler.enabled else PARSE_WORKERS
+        with ParsePrefetcher(file_paths, max_workers=parse_workers, prefetch_window=PARSE_PREFETCH_WINDOW,
+                             profiler=stage_profiler, **document_parse_options()) as prefetcher:
+            for position, (file_path, parsed_document) in enumerate(prefetcher):
+                filename = os.path.basename(file_path)
+                budget_message = par_classifier_client.run_budget.exhausted() or ""
+                if budget_message:
+                    unscheduled_documents = files_to_process[position:]
+                    print(f"\n!!! {budget_message} Not starting the remaining {len(unscheduled_documents)} document(s). !!!")
+                    break
+                print(f"\n>>> Starting processing for document: {filename}")
+                
+                run_budget = par_classifier_client.run_budget
+                input_tokens_before, output_tokens_before = run_budget.input_tokens, run_budget.output_tokens
+                try:
+                    document_rows, referenced_content = process_single_document(file_path, par_classifier_client, dedup_index, parsed_document)
+                except DocumentProcessingError as e:
+                    print(f"\n!!! Document failed: {e} !!!")
+                    dead_letter_queue.record(filename, e.stage, e.original_error)
+                    failed_documents.append(e)
+                    if HALT_ON_DOCUMENT_ERROR:
+                        raise
+                    print("Continuing with the next document.")
+                    continue
+
+                # Append results for the current successfully processed document
+                store_document_results(results_store, run_id, file_path, document_rows,
+                                       run_budget.input_tokens - input_tokens_before, run_budget.output_tokens - output_tokens_before)
+                with stage_profiler.stage("output", filename):
+                    results_writer.write_document(document_rows, referenced_content)
+                succeeded_documents.append(filename)
+                print(f"<<< Successfully processed and extracted from {filename}")
 
     except KeyboardInterrupt:
         print("\n\n!!! Control+C detected by user! Interrupting processing. Attempting to save progress... !!!")
         processing_halted_early = True
         halt_message = "Processing interrupted by user (Control+C)."
     except RuntimeError as e:
-        # This catches errors from classify_section or extract_target_variables after retries
+        # With HALT_ON_DOCUMENT_ERROR, a DocumentProcessingError ends the run here
         print(f"\n\n!!! RUNTIME ERROR! Halting processing. Last error: {e} !!!")
         processing_halted_early = True
         halt_message = f"Critical Error: {e}"
@@ -694,46 +1058,56 @@ def main():
     
     finally:
         print("\n--- Finalizing run ---")
+        print_run_summaries(par_classifier_client, dedup_index)
+        dead_letter_queue.remove(succeeded_documents) # Documents that succeeded (e.g., on retry) are no longer dead-lettered
+        if failed_documents:
+            print(f"{len(failed_documents)} document(s) failed and were recorded in {DEAD_LETTER_FILEPATH}:")
+            for failure in failed_documents:
+                print(f"  - {failure.filename} (stage: {failure.stage}): {type(failure.original_error).__name__}")
+            print("Run 'python3 ai-data-extractor.py retry-failed' to reprocess only these documents.")
         save_file = False
         status_suffix = ""
 
+        if budget_message:
+            print(f"Run budget reached; {len(unscheduled_documents)} document(s) were not started: {', '.join(unscheduled_documents)}")
         if processing_halted_early:
             print(f"Processing was halted: {halt_message}")
-            if all_results_for_excel: # If there's any data accumulated before halt
+            if results_writer.rows_written: # If there's any data written before halt
                 status_suffix = "_USER_INTERRUPTED_PARTIAL" if processing_halted_early and "Control+C" in halt_message else "_ERROR_INCOMPLETE"
                 print(f"Saving partial results with suffix '{status_suffix}'.")
                 save_file = True
             else: # Halted, but no results were accumulated yet
                 print("No results accumulated to save.")
                 # Optionally, create an empty marker file if desired, but typically not needed if no data.
-        elif not all_results_for_excel: # Normal completion, but no results from any file
+        elif not results_writer.rows_written: # Normal completion, but no results from any file
             print("Processing complete. No data was extracted from any document.")
+        elif budget_message: # Stopped by the run budget; results so far are complete per document
+            status_suffix = "_BUDGET_REACHED"
+            print(f"Saving results of the documents processed within budget with suffix '{status_suffix}'.")
+            save_file = True
         else: # Normal completion with results
-            print("Processing completed successfully for all documents (or documents processed before any halt).")
-            status_suffix = "_COMPLETE"
+            if failed_documents:
+                print("Processing completed; the failed documents above are missing from the results.")
+                status_suffix = "_COMPLETE_WITH_FAILURES"
+            else:
+                print("Processing completed successfully for all documents.")
+                status_suffix = "_COMPLETE"
             save_file = True
 
-        if save_file:
-            df = pd.DataFrame(all_results_for_excel)
-            if df.empty and not (processing_halted_early and all_results_for_excel): # Avoid saving an empty df unless it was an error with some data
-                 print("DataFrame is empty and no error halt with data, not saving an empty file.")
-            else:
-                now = datetime.datetime.now()
-                timestamp = now.strftime("%Y-%m-%d_%H-%M-%S")
-                output_file = os.path.join(OUTPUT_DIR, f"extracted_data_{timestamp}{status_suffix}.xlsx")
-                
-                try:
-                    df.to_excel(output_file, index=False)
-                    print(f"Results saved to: {output_file}")
-                except Exception as e_save:
-                    print(f"CRITICAL: Failed to save results to Excel: {e_save}")
-                    # Fallback CSV save attempt
-                    csv_output_file = os.path.join(OUTPUT_DIR, f"extracted_data_{timestamp}{status_suffix}.csv")
-                    try:
-                        df.to_csv(csv_output_file, index=False)
-                        print(f"Successfully saved results as CSV to: {csv_output_file}")
-                    except Exception as e_csv_save:
-                        print(f"CRITICAL: Failed to save results to CSV as fallback: {e_csv_save}")
+        try:
+            with stage_profiler.stage("output"):
+                output_paths = results_writer.close(status_suffix)
+            if save_file:
+                for output_path in output_paths:
+                    print(f"Results saved to: {output_path}")
+        except Exception as e_save:
+            print(f"CRITICAL: Failed to save results to {OUTPUT_FILE_FORMAT.upper()}: {e_save}")
+            if results_store is not None:
+                print(f"The results of completed documents are in {RESULTS_DB_FILEPATH}; run 'python3 ai-data-extractor.py export' to rebuild the workbook.")
+        finish_results_run(results_store, run_id, status_suffix.lstrip("_").lower() or ("halted" if processing_halted_early else "complete"),
+                           par_classifier_client)
+        if stage_profiler.enabled:
+            print(stage_profiler.summary())
         
         if processing_halted_early:
             print(f"Script exited due to: {halt_message}")
@@ -741,8 +1115,397 @@ def main():
         else:
             print("Script finished.")
 
+
+def retry_failed():
+    """Reprocesses only the documents recorded in the dead-letter file."""
+    dead_lettered = DeadLetterQueue(DEAD_LETTER_FILEPATH).entries()
+    if not dead_lettered:
+        print(f"No dead-lettered documents in {DEAD_LETTER_FILEPATH}. Nothing to retry.")
+        return
+    files_to_process = []
+    for entry in dead_lettered:
+        if os.path.isfile(os.path.join(INPUT_DIR, entry["filename"])):
+            print(f"Retrying '{entry['filename']}' (failed at stage '{entry['stage']}' on {entry['failed_at']}: {entry['error_type']})")
+            files_to_process.append(entry["filename"])
+        else:
+            print(f"Warning: Dead-lettered document '{entry['filename']}' is no longer in {INPUT_DIR}. Skipping it.")
+    main(files_to_process)
+
+
+def run_worker(worker_id: str, queue_dir: str, dedup_index_filepath: str = DEDUP_INDEX_FILEPATH):
+    """
+    Distributed mode: claims documents from INPUT_DIR through file leases in queue_dir (shared by all workers),
+    processes them and appends their rows to this worker's shard file in SHARD_OUTPUT_DIR. Run the 'merge'
+    command once all workers are finished to build the workbook. Workers share the dedup index only if
+    dedup_index_filepath is on the shared filesystem.
+    """
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+    par_classifier_client = ParagraphClassifierClient()
+    dedup_index = load_dedup_index(dedup_index_filepath)
+    work_queue = FileLeaseQueue(queue_dir, worker_id, LEASE_TTL_SECONDS, LEASE_HEARTBEAT_INTERVAL_SECONDS)
+    shard_filepath = os.path.join(SHARD_OUTPUT_DIR, f"shard_{worker_id}.jsonl")
+
+    dead_letter_queue = DeadLetterQueue(DEAD_LETTER_FILEPATH)
+    processing_halted_early = False
+    halt_message = ""
+    budget_message = None
+    current_filename = None
+    documents_completed = 0
+    documents_failed = 0
+
+    print(f"Worker '{worker_id}' starting. Queue: {queue_dir}. Shard: {shard_filepath}")
+    work_queue.start_heartbeat()
+    try:
+        while True:
+            budget_message = par_classifier_client.run_budget.exhausted()
+            if budget_message:
+                print(f"\n!!! {budget_message} Worker '{worker_id}' is not claiming further documents. !!!")
+                break
+            files_to_process = list_input_documents()
+            current_filename = work_queue.claim_next(files_to_process)
+            if current_filename is None:
+                if not work_queue.has_pending(files_to_process):
+                    break # Everything is done or failed
+                # Remaining documents are leased by other workers; wait in case one of them dies
+                time.sleep(LEASE_HEARTBEAT_INTERVAL_SECONDS)
+                continue
+
+            print(f"\n>>> Worker '{worker_id}' claimed document: {current_filename}")
+            try:
+                document_rows, _referenced_content = process_single_document(os.path.join(INPUT_DIR, current_filename), par_classifier_client, dedup_index)
+            except DocumentProcessingError as e:
+                print(f"\n!!! Document failed: {e} !!!")
+                dead_letter_queue.record(current_filename, e.stage, e.original_error)
+                work_queue.fail(current_filename, e.stage, str(e.original_error))
+                documents_failed += 1
+                current_filename = None
+                if HALT_ON_DOCUMENT_ERROR:
+                    raise
+                continue
+            completed_at = time.time()
+            document_hash = file_sha256(os.path.join(INPUT_DIR, current_filename))
+            for row in document_rows:
+                row["completed_at"] = completed_at # Lets 'merge' keep the latest result if a document ran twice
+                row["document_hash"] = document_hash # Identifies the document in the results database after 'merge'
+            append_shard_rows(shard_filepath, document_rows)
+            work_queue.complete(current_filename)
+            documents_completed += 1
+            print(f"<<< Successfully processed and extracted from {current_filename}")
+            current_filename = None
+
+    except KeyboardInterrupt:
+        print("\n\n!!! Control+C detected by user! Releasing the current lease and stopping this worker. !!!")
+        processing_halted_early = True
+        halt_message = "Processing interrupted by user (Control+C)."
+        if current_filename:
+            work_queue.release(current_filename)
+    except RuntimeError as e:
+        print(f"\n\n!!! RUNTIME ERROR! Halting worker. Last error: {e} !!!")
+        processing_halted_early = True
+        halt_message = f"Critical Error: {e}"
+        if current_filename:
+            work_queue.release(current_filename)
+    finally:
+        work_queue.stop_heartbeat()
+        print(f"\n--- Finalizing worker '{worker_id}' ({documents_completed} documents completed, {documents_failed} dead-lettered) ---")
+        print_run_summaries(par_classifier_client, dedup_index)
+        if stage_profiler.enabled:
+            print(stage_profiler.summary())
+        if processing_halted_early:
+            print(f"Worker exited due to: {halt_message}")
+            sys.exit(1)
+        if budget_message:
+            print("Worker finished: run budget reached. Unclaimed documents remain in the queue for other workers or a later run.")
+        else:
+            print("Worker finished: no unclaimed documents remain.")
+
+
+def _raise_keyboard_interrupt(signum, frame):
+    raise KeyboardInterrupt # Lets SIGTERM (e.g., from a service manager) shut the service down like Control+C
+
+
+def serve(poll_interval_seconds: float = SERVE_POLL_INTERVAL_SECONDS, http_port: int = SERVE_HTTP_PORT, once: bool = False):
+    """
+    Service mode: keeps the model client, compiled prompts and dedup index warm and processes documents as they
+    arrive in INPUT_DIR (or are submitted to the local job API), instead of a cold batch run per corpus. Documents
+    are identified by content hash; those already in the results database for the current codebook and model are
+    skipped, and new or changed ones are appended to the database as one 'serve' run.
+    Use 'export --latest-per-document' to render the combined results.
+
+    Args:
+        poll_interval_seconds (float): Pause between checks of INPUT_DIR when there is nothing to do.
+        http_port (int): Port of the local job API (0 = disabled).
+        once (bool): Process the current backlog and exit instead of watching.
+    """
+    results_store = open_results_store()
+    if results_store is None:
+        print(f"Service mode appends to the results database; enable ENABLE_RESULTS_STORE (and check {RESULTS_DB_FILEPATH}).")
+        return
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+    par_classifier_client = ParagraphClassifierClient()
+    dedup_index = load_dedup_index()
+    dead_letter_queue = DeadLetterQueue(DEAD_LETTER_FILEPATH)
+    signature = codebook_signature()
+    run_id = new_run_id("serve")
+    results_store.start_run(run_id, "serve", GEMINI_MODEL, signature)
+    watcher = DocumentWatcher(INPUT_DIR, list_input_documents, results_store.document_hashes(signature), SERVE_SETTLE_SECONDS)
+    status = {"run_id": run_id, "started_at": datetime.datetime.now().isoformat(timespec="seconds"),
+              "documents_completed": 0, "documents_failed": 0, "current_document": None, "last_completed": None}
+    job_server = None
+    if http_port:
+        job_server = JobServer(SERVE_HTTP_HOST, http_port, watcher, INPUT_DIR,
+                               lambda: dict(status, pending_jobs=watcher.pending_submissions()))
+        job_server.start()
+    previous_sigterm_handler = signal.signal(signal.SIGTERM, _raise_keyboard_interrupt)
+    halt_message = ""
+    budget_message = None
+    # One parser pool for the whole service run, rather than starting processes for every batch
+    parse_workers = 0 if stage_profiler.enabled else PARSE_WORKERS
+    parse_pool = new_parse_pool(parse_workers) if parse_workers > 0 else None
+
+    print(f"Serving: watching {INPUT_DIR} every {poll_interval_seconds:g}s ({len(watcher.seen_hashes)} documents already "
+          f"in {RESULTS_DB_FILEPATH}). Press Control+C to stop.")
+    try:
+        while True:
+            ready_documents = watcher.poll()
+            if not ready_documents:
+                if once:
+                    break
+                time.sleep(poll_interval_seconds)
+                continue
+            print(f"\n{len(ready_documents)} new or changed document(s) to process.")
+            document_hashes = dict(ready_documents)
+            with ParsePrefetcher(list(document_hashes), max_workers=parse_workers, prefetch_window=PARSE_PREFETCH_WINDOW,
+                                 profiler=stage_profiler, executor=parse_pool, **document_parse_options()) as prefetcher:
+                for file_path, parsed_document in prefetcher:
+                    budget_message = par_classifier_client.run_budget.exhausted()
+                    if budget_message:
+                        break
+                    filename = os.path.basename(file_path)
+                    status["current_document"] = filename
+                    print(f"\n>>> Starting processing for document: {filename}")
+                    run_budget = par_classifier_client.run_budget
+                    input_tokens_before, output_tokens_before = run_budget.input_tokens, run_budget.output_tokens
+                    try:
+                        document_rows, _referenced_content = process_single_document(file_path, par_classifier_client, dedup_index, parsed_document)
+                    except DocumentProcessingError as e:
+                        # The document is retried when its content changes (or with a forced job), not on every poll
+                        print(f"\n!!! Document failed: {e} !!!")
+                        dead_letter_queue.record(filename, e.stage, e.original_error)
+                        status["documents_failed"] += 1
+                        continue
+                    finally:
+                        status["current_document"] = None
+                    store_document_results(results_store, run_id, file_path, document_rows,
+                                           run_budget.input_tokens - input_tokens_before, run_budget.output_tokens - output_tokens_before,
+                                           document_hashes[file_path])
+                    dead_letter_queue.remove([filename])
+                    status["documents_completed"] += 1
+                    status["last_completed"] = filename
+                    print(f"<<< Successfully processed and extracted from {filename} ({len(document_rows)} rows stored)")
+            if budget_message:
+                print(f"\n!!! {budget_message} Stopping the service. !!!")
+                break
+    except KeyboardInterrupt:
+        halt_message = "Service stopped by user or signal."
+        print(f"\n\n!!! {halt_message} !!!")
+    finally:
+        signal.signal(signal.SIGTERM, previous_sigterm_handler)
+        if job_server is not None:
+            job_server.stop()
+        if parse_pool is not None:
+            parse_pool.shutdown(wait=False, cancel_futures=True)
+        print(f"\n--- Finalizing service run ({status['documents_completed']} documents completed, {status['documents_failed']} failed) ---")
+        print_run_summaries(par_classifier_client, dedup_index)
+        finish_results_run(results_store, run_id, "budget_reached" if budget_message else ("stopped" if halt_message else "complete"),
+                           par_classifier_client)
+        if stage_profiler.enabled:
+            print(stage_profiler.summary())
+        print("Run 'python3 ai-data-extractor.py export --latest-per-document' to render the results.")
+
+
+def merge_shards(shard_dir: str):
+    """Combines all worker shard files into one workbook, keeping the latest result for documents processed twice."""
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+    merged_rows = read_shard_rows(shard_dir)
+    if not merged_rows:
+        print(f"No shard rows found in {shard_dir}. Nothing to merge.")
+        return
+    for row in merged_rows:
+        row.pop("completed_at", None)
+    print(f"Merging {len(merged_rows)} rows from {len({row['filename'] for row in merged_rows})} documents.")
+    save_results(merged_rows, "_MERGED")
+
+    results_store = open_results_store()
+    if results_store is not None:
+        run_id = new_run_id("merge")
+        results_store.start_run(run_id, "merge", GEMINI_MODEL, codebook_signature())
+        rows_by_document = {}
+        rehashed = {} # {filename: content hash, or None if the file is not in INPUT_DIR}
+        for row in merged_rows:
+            document_hash = row.get("document_hash")
+            if not document_hash:
+                # Shards written before rows carried a content hash: hash the document itself, never its name
+                if row["filename"] not in rehashed:
+                    file_path = os.path.join(INPUT_DIR, row["filename"])
+                    rehashed[row["filename"]] = file_sha256(file_path) if os.path.isfile(file_path) else None
+                document_hash = rehashed[row["filename"]]
+                if document_hash is None:
+                    continue
+            rows_by_document.setdefault((document_hash, row["filename"]), []).append(row)
+        skipped = sorted(filename for filename, document_hash in rehashed.items() if document_hash is None)
+        if skipped:
+            print(f"Warning: {len(skipped)} merged document(s) have no content hash and are no longer in {INPUT_DIR}; "
+                  f"they are in the workbook but not imported into {RESULTS_DB_FILEPATH}: {', '.join(skipped)}")
+        try:
+            for (document_hash, filename), document_rows in rows_by_document.items():
+                results_store.upsert_document(run_id, document_hash, filename, document_rows, GEMINI_MODEL)
+        except sqlite3.Error as e:
+            print(f"Warning: Could not import merged results into {RESULTS_DB_FILEPATH}: {e}")
+        finish_results_run(results_store, run_id, "merged")
+
+
+def export_results(run_id: str = None, latest_per_document: bool = False, output_format: str = "xlsx", list_runs: bool = False):
+    """
+    Renders results from the results database: the Excel view of one run (default: the latest run) or of the
+    latest result of every document across runs, and/or Parquet partitioned by run.
+    """
+    if not os.path.isfile(RESULTS_DB_FILEPATH):
+        print(f"No results database at {RESULTS_DB_FILEPATH}. Nothing to export.")
+        return
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+    results_store = ResultsStore(RESULTS_DB_FILEPATH)
+    try:
+        if list_runs:
+            for run in results_store.runs():
+                print(f"{run['run_id']}: {run['command']}, {run['status']}, {run['documents']} documents, "
+                      f"{run['input_tokens']} input / {run['output_tokens']} output tokens, model {run['model']}, started {run['started_at']}")
+            return
+        if not latest_per_document and run_id is None:
+            run_id = results_store.latest_run_id()
+            if run_id is None:
+                print("The results database contains no runs. Nothing to export.")
+                return
+        scope = "latest result per document across runs" if latest_per_document else f"run '{run_id}'"
+        if output_format in ("xlsx", "both"):
+            rows = results_store.rows(None if latest_per_document else run_id)
+            print(f"Exporting {len(rows)} rows ({scope}) to Excel.")
+            save_results(rows, "_EXPORT_LATEST" if latest_per_document else f"_EXPORT_{run_id}")
+        if output_format in ("parquet", "both"):
+            parquet_dir = RESULTS_PARQUET_DIR or os.path.join(OUTPUT_DIR, "results_parquet")
+            try:
+                written = results_store.export_parquet(parquet_dir, None if latest_per_document else run_id)
+                print(f"Wrote {written} rows to {parquet_dir} (partitioned by run_id).")
+            except RuntimeError as e:
+                print(f"Parquet export skipped: {e}")
+    finally:
+        results_store.close()
+
+
+def plan_run(concurrency_levels: list[int], estimate_only: bool = False):
+    """
+    Dry run: parses every document in INPUT_DIR, builds its classification prompts, counts their tokens and
+    estimates the extraction calls, then prints per-document and total calls, tokens, cost and time at each
+    concurrency level. No generation requests are made.
+
+    Args:
+        concurrency_levels (list[int]): Numbers of concurrent workers to estimate wall-clock time for.
+        estimate_only (bool): Estimate tokens from character counts instead of the model's token counter
+                              (no Vertex AI access needed).
+    """
+    prompt_compiler = PromptCompiler(PARAGRAPH_TAG_DESCRIPTIONS, TARGET_VARIABLES, CLUSTER_TARGET_VARIABLES)
+    if estimate_only:
+        count_tokens_fn = estimate_tokens
+    else:
+        model = build_endpoint_pool()
+        count_tokens_fn = lambda text: model.count_tokens(text).total_tokens if text else 0
+    planner = RunPlanner(
+        prompt_compiler, count_tokens_fn, SYSTEM_INSTRUCTION, list(PARAGRAPH_TAG_DESCRIPTIONS.keys()),
+        EVIDENCE_TOKEN_BUDGET_PER_CALL, PLAN_EVIDENCE_SHARE_PER_TAG,
+        PLAN_CLASSIFICATION_OUTPUT_TOKENS_PER_PIECE, PLAN_EXTRACTION_OUTPUT_TOKENS_PER_VARIABLE,
+        PLAN_CALL_OVERHEAD_SECONDS, PLAN_OUTPUT_TOKENS_PER_SECOND,
+        MODEL_INPUT_PRICE_PER_1M_TOKENS, MODEL_OUTPUT_PRICE_PER_1M_TOKENS,
+        merge_extraction_calls=MERGE_EXTRACTION_CALLS, merge_max_variables=EXTRACTION_MERGE_MAX_VARIABLES)
+
+    files_to_process = list_input_documents()
+    if not files_to_process:
+        print(f"No DOCX files found to plan in the input directory: {INPUT_DIR}")
+        return
+    print(f"Planning {len(files_to_process)} documents ({'estimated' if estimate_only else 'counted'} prompt tokens, "
+          f"{CLASSIFICATION_MODE} classification mode)...")
+    file_paths = [os.path.join(INPUT_DIR, filename) for filename in files_to_process]
+    with ParsePrefetcher(file_paths, max_workers=PARSE_WORKERS, prefetch_window=PARSE_PREFETCH_WINDOW,
+                         **document_parse_options()) as prefetcher:
+        for file_path, parsed_document in prefetcher:
+            if parsed_document.error:
+                print(f"  {os.path.basename(file_path)}: skipped ({parsed_document.error})")
+                continue
+            whole_document = CLASSIFICATION_MODE == "document" and not whole_document_fallback_reason(parsed_document.content_store)
+            document_plan = planner.plan_document(parsed_document, whole_document)
+            merged_note = f" (as few as {document_plan['merged_extraction_calls']} merged)" if "merged_extraction_calls" in document_plan else ""
+            print(f"  {os.path.basename(file_path)}: {document_plan['content_pieces']} content pieces, "
+                  f"{document_plan['classification_calls']} classification + {document_plan['extraction_calls']} extraction calls{merged_note}, "
+                  f"{document_plan['input_tokens']} input / ~{document_plan['output_tokens']} output tokens, "
+                  f"~{document_plan['cost']:.2f} {PRICE_CURRENCY}, ~{document_plan['seconds'] / 60:.1f} min")
+    print(planner.report(concurrency_levels, PLAN_QUOTA_REQUESTS_PER_MINUTE, PLAN_QUOTA_TOKENS_PER_MINUTE, PRICE_CURRENCY))
+    if RUN_TOKEN_BUDGET > 0 or RUN_COST_BUDGET > 0:
+        print(f"Configured run budget: {RUN_TOKEN_BUDGET or 'no'} token limit, {RUN_COST_BUDGET or 'no'} {PRICE_CURRENCY} cost limit.")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Classify and extract data from DOCX research papers with Gemini.")
+    parser.add_argument("--profile", action="store_true",
+                        help="Profile each stage (parse, classification, extraction, output) with cProfile and tracemalloc.")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.add_parser("run", help="Process every document in INPUT_DIR in this process (default).")
+    worker_parser = subparsers.add_parser("worker", help="Claim documents from a shared queue and write a per-worker shard.")
+    worker_parser.add_argument("--worker-id", default=default_worker_id(), help="Unique id of this worker (default: host-pid).")
+    worker_parser.add_argument("--queue-dir", default=SHARED_QUEUE_DIR, help="Shared directory holding leases and done markers.")
+    worker_parser.add_argument("--dedup-index", default=WORKER_DEDUP_INDEX_FILEPATH or DEDUP_INDEX_FILEPATH,
+                               help="Dedup index file; put it on the shared filesystem so workers share it "
+                                    "(default: WORKER_DEDUP_INDEX_FILEPATH, else DEDUP_INDEX_FILEPATH).")
+    subparsers.add_parser("retry-failed", help="Reprocess only the documents recorded in the dead-letter file.")
+    plan_parser = subparsers.add_parser("plan", help="Estimate calls, tokens, cost and time for INPUT_DIR without processing it.")
+    plan_parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 2, 4, 8],
+                             help="Concurrent workers to estimate wall-clock time for (default: 1 2 4 8).")
+    plan_parser.add_argument("--estimate-only", action="store_true",
+                             help="Estimate tokens from character counts instead of calling the model's token counter.")
+    serve_parser = subparsers.add_parser("serve", help="Keep running and process new or changed documents in INPUT_DIR as they arrive.")
+    serve_parser.add_argument("--poll-interval", type=float, default=SERVE_POLL_INTERVAL_SECONDS,
+                              help="Seconds between checks of INPUT_DIR (default: SERVE_POLL_INTERVAL_SECONDS).")
+    serve_parser.add_argument("--port", type=int, default=SERVE_HTTP_PORT,
+                              help="Port of the local job API (POST /jobs, GET /status); 0 disables it.")
+    serve_parser.add_argument("--once", action="store_true", help="Process the current backlog of new or changed documents and exit.")
+    merge_parser = subparsers.add_parser("merge", help="Combine worker shard files into the final workbook.")
+    merge_parser.add_argument("--shard-dir", default=SHARD_OUTPUT_DIR, help="Directory containing shard_*.jsonl files.")
+    export_parser = subparsers.add_parser("export", help="Render results from the results database (Excel and/or Parquet).")
+    export_parser.add_argument("--run-id", default=None, help="Run to export (default: the latest run).")
+    export_parser.add_argument("--latest-per-document", action="store_true",
+                               help="Export the most recent result of every document across all runs (merges partial runs).")
+    export_parser.add_argument("--format", dest="output_format", choices=["xlsx", "parquet", "both"], default="xlsx")
+    export_parser.add_argument("--list-runs", action="store_true", help="List the runs in the database and exit.")
+    args = parser.parse_args(argv)
+    if args.command is None:
+        args.command = "run"
+    return args
+
+
 if __name__ == "__main__":
-    # Ensure necessary imports from config are available, e.g.,
-    # from config import INPUT_DIR, OUTPUT_DIR, PARAGRAPH_TAG_DESCRIPTIONS, TARGET_VARIABLES, CLUSTER_TARGET_VARIABLES, MAX_INVALID_LABEL_WARNINGS_PER_DOC, MAX_API_RETRIES, RETRY_DELAY_SECONDS, RETRY_BACKOFF_FACTOR, GENERATION_CONFIGURATION, SAFETY_SETTINGS, PROJECT_ID, LOCATION, GEMINI_MODEL
     # This script assumes config variables are globally available after `from config import *`
-    main()
\ No newline at end of file
+    args = parse_args()
+    if args.profile:
+        stage_profiler.enable(os.path.join(PROFILE_OUTPUT_DIR, datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")), PROFILE_TOP_N)
+    if args.command == "worker":
+        run_worker(args.worker_id, args.queue_dir, args.dedup_index)
+    elif args.command == "merge":
+        merge_shards(args.shard_dir)
+    elif args.command == "retry-failed":
+        retry_failed()
+    elif args.command == "export":
+        export_results(args.run_id, args.latest_per_document, args.output_format, args.list_runs)
+    elif args.command == "plan":
+        plan_run(args.concurrency, args.estimate_only)
+    elif args.command == "serve":
+        serve(args.poll_interval, args.port, args.once)
+    else:
+        main()
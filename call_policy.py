@@ -0,0 +1,184 @@
+# call_policy.py
+import time
+import threading
+from collections import deque
+from concurrent.futures import Future, wait, FIRST_COMPLETED
+
+
+class CallDeadlineExceeded(TimeoutError):
+    """Raised when a model call (including any hedge) does not return within its deadline."""
+
+
+def call_deadline_seconds(prompt_characters: int, base_seconds: float, seconds_per_1k_tokens: float) -> float:
+    """Deadline for one call, scaled by the (estimated, ~4 characters per token) prompt size."""
+    return base_seconds + seconds_per_1k_tokens * (prompt_characters / 4) / 1000
+
+
+class LatencyTracker:
+    """Keeps a sliding window of successful call latencies per task kind ("classification", "extraction")."""
+
+    def __init__(self, window_size: int = 200):
+        self.window_size = window_size
+        self._latencies = {} # {task_kind: deque of seconds}
+        self._lock = threading.Lock()
+
+    def add(self, task_kind: str, latency_seconds: float):
+        with self._lock:
+            self._latencies.setdefault(task_kind, deque(maxlen=self.window_size)).append(latency_seconds)
+
+    def percentile(self, task_kind: str, fraction: float, min_samples: int):
+        """Returns the latency at the given fraction (e.g., 0.95), or None with fewer than min_samples observations."""
+        with self._lock:
+            samples = sorted(self._latencies.get(task_kind, ()))
+        if len(samples) < max(1, min_samples):
+            return None
+        return samples[min(len(samples) - 1, int(fraction * len(samples)))]
+
+
+class HedgedCaller:
+    """
+    Runs model calls on worker threads so each one can be given a deadline, and optionally hedges slow calls:
+    if a call has not returned after the observed latency percentile for its task kind, an identical duplicate
+    is issued and whichever returns first is used. The losing call is cancelled if it has not started yet;
+    otherwise its result is discarded when it arrives and its tokens are counted as hedge cost.
+
+    Hung threads cannot be killed and the SDK's generate_content takes no request timeout, so a call that
+    misses its deadline is abandoned (its thread finishes in the background) and CallDeadlineExceeded is raised
+    for the caller's retry loop. Every attempt runs on its own daemon thread rather than in a bounded pool,
+    so abandoned calls never hold up new ones; the number still running is reported in the summary.
+    """
+
+    def __init__(self, enable_hedging: bool = False, hedge_percentile: float = 0.95, min_samples: int = 20,
+                 usage_tokens_fn=None, discarded_response_fn=None):
+        """
+        Args:
+            enable_hedging (bool): Issue duplicate requests for calls slower than the latency percentile.
+            hedge_percentile (float): Latency percentile (0 to 1) after which a hedge is issued.
+            min_samples (int): Successful calls of a task kind needed before hedging it.
+            usage_tokens_fn (callable): Returns the total tokens of a response (for hedge cost accounting).
+            discarded_response_fn (callable): Called (on the call's thread) with every response that completed but was
+                                              discarded (hedge losers, calls abandoned at the deadline), e.g. to bill it.
+        """
+        self.enable_hedging = enable_hedging
+        self.hedge_percentile = hedge_percentile
+        self.min_samples = min_samples
+        self.usage_tokens_fn = usage_tokens_fn
+        self.discarded_response_fn = discarded_response_fn
+        self.latency_tracker = LatencyTracker()
+        self._lock = threading.Lock()
+        self.telemetry = {"calls": 0, "deadline_exceeded": 0, "hedges_issued": 0, "hedges_won": 0,
+                          "hedge_wasted_calls": 0, "hedge_wasted_tokens": 0, "abandoned_in_flight": 0}
+
+    def _count(self, key: str, amount: int = 1):
+        with self._lock:
+            self.telemetry[key] += amount
+
+    def _submit(self, fn) -> Future:
+        """Runs fn() on a new daemon thread and returns a Future for its result."""
+        future = Future()
+
+        def run():
+            if not future.set_running_or_notify_cancel():
+                return
+            try:
+                future.set_result(fn())
+            except BaseException as e:
+                future.set_exception(e)
+        threading.Thread(target=run, name="model-call", daemon=True).start()
+        return future
+
+    def _discard_loser(self, future, abandoned: bool = False):
+        """
+        Cancels a losing call, or counts its cost once it completes if it is already running. Calls abandoned at
+        the deadline are counted as in flight until their thread finishes.
+        """
+        if future.cancel():
+            return
+        in_flight = abandoned and not future.done()
+        if in_flight:
+            self._count("abandoned_in_flight")
+
+        def on_done(done_future):
+            if in_flight:
+                self._count("abandoned_in_flight", -1)
+            if done_future.cancelled() or done_future.exception() is not None:
+                return
+            self._count("hedge_wasted_calls")
+            if self.usage_tokens_fn is not None:
+                try:
+                    self._count("hedge_wasted_tokens", int(self.usage_tokens_fn(done_future.result())))
+                except Exception:
+                    pass
+            if self.discarded_response_fn is not None:
+                try:
+                    self.discarded_response_fn(done_future.result())
+                except Exception as e:
+                    print(f"Warning: Could not account for a discarded response: {e}")
+        future.add_done_callback(on_done)
+
+    def call(self, fn, task_kind: str, deadline_seconds: float):
+        """
+        Calls fn() with a deadline (and a hedge if enabled) and returns its result.
+
+        Raises:
+            CallDeadlineExceeded: If no attempt returned within deadline_seconds.
+            Exception: Whatever fn raised, if every attempt failed.
+        """
+        self._count("calls")
+        start = time.monotonic()
+        deadline_at = start + deadline_seconds
+        futures = [self._submit(fn)]
+        hedge_future = None
+
+        hedge_after = None
+        if self.enable_hedging:
+            hedge_after = self.latency_tracker.percentile(task_kind, self.hedge_percentile, self.min_samples)
+            if hedge_after is not None and hedge_after >= deadline_seconds:
+                hedge_after = None # A hedge would only start after the deadline
+
+        if hedge_after is not None:
+            done, _pending = wait(futures, timeout=hedge_after)
+            if not done:
+                print(f"{task_kind.capitalize()} call exceeded p{self.hedge_percentile * 100:.0f} latency ({hedge_after:.1f}s). Issuing hedged request.")
+                hedge_future = self._submit(fn)
+                futures.append(hedge_future)
+                self._count("hedges_issued")
+
+        winner = None
+        first_error = None
+        pending = set(futures)
+        while pending:
+            remaining = deadline_at - time.monotonic()
+            if remaining <= 0:
+                break
+            done, pending = wait(pending, timeout=remaining, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    winner = future
+                    break
+                first_error = first_error or future.exception()
+            if winner is not None:
+                break
+
+        if winner is None:
+            for future in futures:
+                self._discard_loser(future, abandoned=True)
+            if first_error is not None and not pending:
+                raise first_error # Every attempt failed before the deadline
+            self._count("deadline_exceeded")
+            raise CallDeadlineExceeded(f"{task_kind.capitalize()} call did not return within its {deadline_seconds:.1f}s deadline.")
+
+        for future in futures:
+            if future is not winner:
+                self._discard_loser(future)
+        if winner is hedge_future:
+            self._count("hedges_won")
+        self.latency_tracker.add(task_kind, time.monotonic() - start)
+        return winner.result()
+
+    def summary(self) -> str:
+        t = self.telemetry
+        return (f"Call policy: {t['calls']} calls, {t['deadline_exceeded']} missed their deadline; "
+                f"{t['hedges_issued']} hedged requests issued, {t['hedges_won']} won, "
+                f"{t['hedge_wasted_calls']} duplicate or late responses discarded ({t['hedge_wasted_tokens']} tokens of hedge cost); "
+                f"{t['abandoned_in_flight']} abandoned calls still running.")
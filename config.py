@@ -1,4 +1,5 @@
 import os
+import json
 from dotenv import load_dotenv
 from utils import validate_excel_spreadsheet, create_target_variables, domain_variable_mapping
 from vertexai.generative_models import SafetySetting
@@ -10,10 +11,68 @@ PROJECT_ID = os.getenv("PROJECT_ID")
 LOCATION = os.getenv("LOCATION")
 GEMINI_MODEL = os.getenv("GEMINI_MODEL")
 
+# Model Endpoint Pool (spreads calls over several projects/regions; empty = the single endpoint above)
+# JSON list in the environment, e.g. MODEL_ENDPOINTS='[{"project": "p1", "location": "us-central1", "model": "gemini-2.5-pro",
+#   "weight": 2, "requests_per_minute": 60}, {"project": "p2", "location": "europe-west4"}]' (omitted keys default to the values above)
+MODEL_ENDPOINTS = json.loads(os.getenv("MODEL_ENDPOINTS") or "[]")
+ENDPOINT_COOLDOWN_SECONDS = 30 # An endpoint answering 429/503 is skipped this long (doubled per consecutive failure)
+ENDPOINT_MAX_COOLDOWN_SECONDS = 600
+
 # Directory Setup
 INPUT_DIR = "input_docs"
 OUTPUT_DIR = "output_xlsx"
 
+# Distributed Runs (several workers sharing INPUT_DIR on a shared filesystem; see the 'worker' and 'merge' commands)
+SHARED_QUEUE_DIR = os.path.join(INPUT_DIR, ".queue") # Lease files and done markers; must be on the shared filesystem
+SHARD_OUTPUT_DIR = os.path.join(OUTPUT_DIR, "shards") # One shard_<worker_id>.jsonl result file per worker
+LEASE_TTL_SECONDS = 900 # A lease without heartbeat for this long is taken over by another worker
+LEASE_HEARTBEAT_INTERVAL_SECONDS = 60 # How often a worker refreshes the leases it holds
+
+# Output Files (written as each document completes)
+OUTPUT_FILE_FORMAT = "xlsx" # "xlsx" (streamed in openpyxl write-only mode) or "csv"
+OUTPUT_MAX_ROWS_PER_PART = 50000 # Result rows per output file before a new part is started (0 = one file)
+OUTPUT_MAX_CHARACTERS_PER_PART = 100_000_000 # Approximate text per output file before a new part is started (0 = no limit)
+OUTPUT_CONTENT_SHEET = False # If True, cited content pieces go to a "content" sheet once per document and rows reference them by index
+
+# Cross-Run Results Database (see the 'export' command)
+ENABLE_RESULTS_STORE = True # Also write every document's results to an indexed SQLite database
+RESULTS_DB_FILEPATH = os.path.join(OUTPUT_DIR, "results.sqlite")
+RESULTS_PARQUET_DIR = "" # If set, each run's results are also written there as Parquet partitioned by run_id (requires pyarrow)
+
+# Fallback Segmentation (documents without Heading 1/Heading 2 styles, e.g., converted from PDF)
+DETECT_HEADINGS_WITHOUT_STYLES = True # Detect headings from numbering, common section titles, font size, capitals and bold lines
+HEADING_DETECTION_MAX_CHARACTERS = 120 # Longer paragraphs are never treated as detected headings
+MAX_SECTION_CONTENT_PIECES = 60 # Larger sections of documents without heading styles are split into balanced chunks (one classification call each); 0 = no limit
+MAX_SECTION_CONTENT_TOKENS = 8000 # Same, by estimated content tokens; 0 = no limit
+
+# Service Mode (see the 'serve' command)
+SERVE_POLL_INTERVAL_SECONDS = 10 # How often INPUT_DIR is checked for new or changed documents
+SERVE_SETTLE_SECONDS = 5 # A file is picked up only once unmodified for this long (so half-copied files are not parsed)
+SERVE_HTTP_HOST = "127.0.0.1" # Interface of the optional local job API (no authentication; keep it on localhost)
+SERVE_HTTP_PORT = 0 # Port of the local job API (POST /jobs, GET /status); 0 = disabled
+
+# Background Parsing (DOCX parsing of upcoming documents overlaps with LLM calls for the current one)
+PARSE_WORKERS = 2 # Parser processes; 0 parses each document in the main process when it is reached
+PARSE_PREFETCH_WINDOW = 4 # Maximum documents parsed ahead of the current one (bounds memory)
+
+# Section Skip Rules (applied while parsing, so skipped content is never sent for classification)
+# Each rule: "name"; "heading_pattern" (regex, case-insensitive, leading section numbers ignored) and/or "styles"
+# (paragraph styles; default "Heading 1"/"Heading 2"); "action": "skip" drops the section up to the next heading of
+# the same or a higher level, "stop" drops it and everything after; optional "min_position"/"max_position" (0-1)
+# limit where in the document the rule applies. The first matching rule wins.
+SECTION_SKIP_RULES = [
+    {"name": "references", "heading_pattern": r"^(references?|reference list|bibliography|works cited|literature cited)$", "action": "stop"},
+    {"name": "acknowledgements", "heading_pattern": r"^acknowledge?ments?$", "action": "skip"},
+    {"name": "author biographies", "heading_pattern": r"^(about the authors?|authors? biograph(y|ies)|biographical notes?)$", "action": "skip"},
+    {"name": "appendices", "heading_pattern": r"^(appendix|appendices|supplementa(ry|l) (materials?|tables?|information|data)|supporting information)\b",
+     "action": "skip", "min_position": 0.5},
+    {"name": "bibliography entries", "styles": ["Bibliography"], "action": "skip"}, # Word's built-in style for reference lists
+]
+
+# Profiling (see the --profile flag)
+PROFILE_OUTPUT_DIR = os.path.join(OUTPUT_DIR, "profiles") # Per-document .pstats and .tracemalloc dumps, one folder per run
+PROFILE_TOP_N = 15 # Functions and allocation sites listed per stage in the end-of-run profile summary
+
 # Codebook Filepath
 CODEBOOK_FILEPATH = "./codebook.xlsx"
 
@@ -23,6 +82,41 @@ RETRY_DELAY_SECONDS = 5  # Initial delay in seconds for the first retry
 RETRY_BACKOFF_FACTOR = 2 # Factor for exponential backoff (e.g., 5s, 10s, 20s)
 MAX_INVALID_LABEL_WARNINGS_PER_DOC = 0 # Set to 0 to stop on the first warning for a document
 
+# Per-Document Failure Isolation
+DEAD_LETTER_FILEPATH = os.path.join(OUTPUT_DIR, "dead_letter.jsonl") # Failed documents (filename, stage, error); see the 'retry-failed' command
+HALT_ON_DOCUMENT_ERROR = False # If True, the first failed document halts the whole run (the previous behaviour)
+
+# Per-Call Deadlines and Hedged Requests (tail latency)
+CALL_DEADLINE_BASE_SECONDS = 180 # Deadline for any model call; a missed deadline counts as a failed attempt and is retried
+CALL_DEADLINE_SECONDS_PER_1K_PROMPT_TOKENS = 2 # Added to the base deadline per 1,000 (estimated) prompt tokens
+ENABLE_HEDGED_REQUESTS = False # If True, a duplicate request is issued when a call is slower than the latency percentile below
+HEDGE_LATENCY_PERCENTILE = 0.95 # Observed latency percentile (per task kind) after which a call is hedged
+HEDGE_MIN_LATENCY_SAMPLES = 20 # Successful calls of a task kind observed before hedging starts
+
+# Pricing, Run Budget and Dry-Run Planning (see the 'plan' command)
+MODEL_INPUT_PRICE_PER_1M_TOKENS = 1.25 # Check current Vertex AI pricing for GEMINI_MODEL
+MODEL_OUTPUT_PRICE_PER_1M_TOKENS = 10.00 # Output pricing also applies to thinking tokens
+PRICE_CURRENCY = "USD"
+RUN_TOKEN_BUDGET = 0 # Input + output tokens after which no new document is started (0 = no limit); applies per process
+RUN_COST_BUDGET = 0 # Cost (in PRICE_CURRENCY) after which no new document is started (0 = no limit); applies per process
+PLAN_CLASSIFICATION_OUTPUT_TOKENS_PER_PIECE = 20 # Assumed output tokens per classified content piece
+PLAN_EXTRACTION_OUTPUT_TOKENS_PER_VARIABLE = 150 # Assumed output tokens per extracted variable (value, indices, justification)
+PLAN_EVIDENCE_SHARE_PER_TAG = 0.2 # Assumed share of a document's content selected as evidence for each tag
+PLAN_CALL_OVERHEAD_SECONDS = 3 # Assumed fixed latency per call
+PLAN_OUTPUT_TOKENS_PER_SECOND = 60 # Assumed generation speed
+PLAN_QUOTA_REQUESTS_PER_MINUTE = 0 # Project quota used to bound estimated time at high concurrency (0 = not limited)
+PLAN_QUOTA_TOKENS_PER_MINUTE = 0 # Project quota in tokens per minute (0 = not limited)
+
+# Near-Duplicate Content Detection (reuses classifications of repeated boilerplate across the corpus and across runs)
+ENABLE_CONTENT_DEDUP = True
+DEDUP_INDEX_FILEPATH = "./cache/dedup_index.jsonl"
+WORKER_DEDUP_INDEX_FILEPATH = "" # Index used by 'worker' mode; set to a path on the shared filesystem so workers share it ("" = DEDUP_INDEX_FILEPATH)
+DEDUP_SIMILARITY_THRESHOLD = 0.8 # Estimated Jaccard similarity (0 to 1) above which a piece counts as a near duplicate (only reused for known-irrelevant boilerplate)
+DEDUP_MIN_CHARACTERS = 80 # Shorter content pieces (e.g., "Table 1") are always classified in context
+
+
+# Token Accounting (reports input tokens per prompt component: system instruction, instructions, codebook, content)
+ENABLE_TOKEN_ACCOUNTING = True # Static components are counted once per run with the model's token counter
 
 # Model configurations
 GENERATION_CONFIGURATION = {
@@ -56,9 +150,23 @@ if not validate_excel_spreadsheet(CODEBOOK_FILEPATH):
 # Data Extraction Targets (using your function)
 TARGET_VARIABLES = create_target_variables(CODEBOOK_FILEPATH)
 
+# Classification Mode (pass 1)
+CLASSIFICATION_MODE = "section" # "section": one call per heading; "document": one call per document for long-context models
+WHOLE_DOCUMENT_MAX_INPUT_TOKENS = 200000 # Estimated content tokens above which "document" mode falls back to per-section calls
+
 # Confidence Threshold for Tagging (0 to 1)
 CONFIDENCE_THRESHOLD = 0.7  # Adjust as needed
 
+# Evidence Selection for Extraction Payloads (pass 2)
+EVIDENCE_TOKEN_BUDGET_PER_CALL = 12000 # Estimated content tokens per extraction call; set to 0 to disable the cap
+EVIDENCE_CONTEXT_WINDOW = 1 # Below-threshold pieces this many indices from a selected piece are added as context while budget remains
+EVIDENCE_MIN_PIECES_PER_TAG = 1 # Best pieces always kept (regardless of threshold/budget) so every tag is still extracted
+
+# Merged Extraction Calls (pass 2)
+MERGE_EXTRACTION_CALLS = True # Tags whose evidence largely overlaps share one extraction call (each content piece sent once)
+EXTRACTION_MERGE_MIN_OVERLAP = 0.5 # Minimum token-weighted overlap (Jaccard) of a tag's evidence with a call's evidence to join it
+EXTRACTION_MERGE_MAX_VARIABLES = 20 # Maximum target variables per merged call, so its output stays within max_output_tokens; 0 = no limit
+
 # List of extraction variables
 TARGET_VARIABLE_NAMES = [TARGET_VARIABLES.keys()]
 
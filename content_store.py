@@ -0,0 +1,72 @@
+# content_store.py
+
+
+class ContentPiece:
+    """Metadata for one content piece in a DocumentContentStore. The text itself lives in the store's buffer."""
+
+    __slots__ = ("type", "style", "start", "end")
+
+    def __init__(self, piece_type: str, style: str, start: int, end: int):
+        self.type = piece_type   # "paragraph" or "table_markdown"
+        self.style = style       # python-docx style name ("Table" for tables)
+        self.start = start       # Offset of the first character in the store's buffer
+        self.end = end           # Offset one past the last character
+
+    def __repr__(self):
+        return f"ContentPiece(type={self.type!r}, style={self.style!r}, start={self.start}, end={self.end})"
+
+
+class DocumentContentStore:
+    """
+    Holds every processed content piece (paragraph text or Markdown table) of one document in a single
+    text buffer, addressed by global index. Everything else (classification results, evidence selection,
+    extraction payloads, output rows) refers to pieces by index and reads the text from here on demand.
+
+    The store behaves like a read-only list of strings: len(store), store[global_idx] and iteration work
+    as they did for the former indexed_content_strings list. Reading a piece returns a slice (a copy) of the
+    buffer, so callers keep such strings only while building a prompt or a row.
+
+    Until finalize() (called by the parser once a document is read), appended strings are kept as separate
+    parts; afterwards the document's text is held once, in the buffer.
+    """
+
+    def __init__(self):
+        self.pieces = []              # [ContentPiece], one per global index
+        self._buffer = ""             # All piece texts concatenated
+        self._pending_parts = []      # Texts appended since the buffer was last joined
+        self._length = 0              # Total characters, including pending parts
+
+    def append(self, content_string: str, piece_type: str, style: str) -> int:
+        """Adds a content piece and returns its global index."""
+        start = self._length
+        self._length += len(content_string)
+        self._pending_parts.append(content_string)
+        self.pieces.append(ContentPiece(piece_type, style, start, self._length))
+        return len(self.pieces) - 1
+
+    def _flush(self):
+        if self._pending_parts:
+            self._buffer = self._buffer + "".join(self._pending_parts)
+            self._pending_parts = []
+
+    def finalize(self):
+        """Joins the appended pieces into the buffer, releasing the strings they were appended from."""
+        self._flush()
+
+    def __len__(self) -> int:
+        return len(self.pieces)
+
+    def __getitem__(self, global_idx: int) -> str:
+        piece = self.pieces[global_idx]
+        self._flush()
+        return self._buffer[piece.start:piece.end]
+
+    def __iter__(self):
+        for global_idx in range(len(self.pieces)):
+            yield self[global_idx]
+
+    def piece_type(self, global_idx: int) -> str:
+        return self.pieces[global_idx].type
+
+    def total_characters(self) -> int:
+        return self._length
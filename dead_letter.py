@@ -0,0 +1,79 @@
+# dead_letter.py
+import os
+import json
+import datetime
+
+
+class StageFailure(RuntimeError):
+    """
+    An expected, document-specific failure of a pipeline stage: an LLM call that failed all its retries, or too
+    many invalid labels. Unlike programming errors, these dead-letter the document instead of ending the run.
+    """
+
+
+class DocumentProcessingError(RuntimeError):
+    """A document failed at a given pipeline stage; the run records it and continues with the next document."""
+
+    def __init__(self, filename: str, stage: str, original_error: Exception):
+        self.filename = filename
+        self.stage = stage
+        self.original_error = original_error
+        super().__init__(f"File: {filename}, Stage: {stage}, Error: {type(original_error).__name__} - {original_error}")
+
+
+class DeadLetterQueue:
+    """
+    A JSON Lines file of documents that failed (filename, stage, error, time). Appending one line per failure
+    keeps it safe to share between distributed workers; the latest entry per filename is the one that counts.
+    Documents are removed by appending a resolution entry (filename, resolved_at) rather than rewriting the
+    file, so removals cannot drop failures another worker appends at the same time.
+    """
+
+    def __init__(self, filepath: str):
+        self.filepath = filepath
+
+    def _append(self, entry: dict):
+        directory = os.path.dirname(self.filepath)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(self.filepath, "a", encoding="utf-8") as f:
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+    def record(self, filename: str, stage: str, error: Exception):
+        """Appends a failure record for a document."""
+        self._append({
+            "filename": filename,
+            "stage": stage,
+            "error_type": type(error).__name__,
+            "error": str(error),
+            "failed_at": datetime.datetime.now().isoformat(timespec="seconds"),
+        })
+        print(f"Dead-lettered '{filename}' (stage: {stage}) to {self.filepath}.")
+
+    def entries(self) -> list[dict]:
+        """Returns the latest failure record of each dead-lettered document, in order of first failure."""
+        latest_by_filename = {}
+        if not os.path.isfile(self.filepath):
+            return []
+        with open(self.filepath, "r", encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue # Partial line from an interrupted write
+                if "resolved_at" in entry:
+                    latest_by_filename.pop(entry["filename"], None)
+                else:
+                    latest_by_filename[entry["filename"]] = entry
+        return list(latest_by_filename.values())
+
+    def filenames(self) -> list[str]:
+        return [entry["filename"] for entry in self.entries()]
+
+    def remove(self, filenames):
+        """Marks dead-lettered documents as resolved (e.g., after a successful retry)."""
+        resolved_at = datetime.datetime.now().isoformat(timespec="seconds")
+        for filename in set(filenames) & set(self.filenames()): # Only documents that are currently dead-lettered
+            self._append({"filename": filename, "resolved_at": resolved_at})
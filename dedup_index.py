@@ -0,0 +1,340 @@
+# dedup_index.py
+import os
+import re
+import json
+import time
+import uuid
+import hashlib
+import random
+from contextlib import contextmanager
+
+# Large Mersenne prime used for the MinHash permutation family (h(x) = (a*x + b) mod p)
+_MERSENNE_PRIME = (1 << 61) - 1
+_MAX_HASH = (1 << 32) - 1
+_INDEX_FORMAT_VERSION = 2 # JSON Lines: a header line, then one line per entry (version 1 was a single JSON document)
+_LOCK_STALE_SECONDS = 120 # A save lock older than this was left by a crashed process and is broken
+
+
+def normalize_content(content_string: str) -> str:
+    """Lowercases a content piece and collapses whitespace so trivial formatting differences do not matter."""
+    return re.sub(r"\s+", " ", content_string.lower()).strip()
+
+
+def _shingles(normalized_text: str, shingle_size: int) -> set:
+    """Returns the set of word n-gram shingles (or a single shingle for very short texts)."""
+    words = normalized_text.split(" ")
+    if len(words) <= shingle_size:
+        return {normalized_text}
+    return {" ".join(words[i:i + shingle_size]) for i in range(len(words) - shingle_size + 1)}
+
+
+@contextmanager
+def _save_lock(filepath: str, poll_seconds: float = 0.05):
+    """
+    Holds <filepath>.lock (created atomically with O_CREAT | O_EXCL) while the index file is appended to or
+    compacted, so processes sharing the file cannot interleave or overwrite each other's entries.
+    """
+    lock_path = f"{filepath}.lock"
+    while True:
+        try:
+            fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            try:
+                if time.time() - os.path.getmtime(lock_path) > _LOCK_STALE_SECONDS:
+                    # rename() is atomic: exactly one process moves the stale lock out of the way
+                    stale_path = f"{lock_path}.stale-{uuid.uuid4().hex}"
+                    os.rename(lock_path, stale_path)
+                    os.remove(stale_path)
+                    continue
+            except FileNotFoundError:
+                continue # Released or broken in the meantime
+            time.sleep(poll_seconds)
+    os.close(fd)
+    try:
+        yield
+    finally:
+        try:
+            os.remove(lock_path)
+        except FileNotFoundError:
+            pass
+
+
+class ContentDedupIndex:
+    """
+    A persistent MinHash/LSH index of content pieces (paragraphs or Markdown tables) seen across the corpus,
+    storing the validated classification result of each piece so duplicates (copyright notices, funding
+    statements, journal templates, a paper submitted twice, ...) can reuse it instead of being sent to the
+    LLM again. Pieces stored with an empty label list are known-irrelevant boilerplate.
+
+    Exact duplicates (same normalized text) reuse any classification. Near duplicates only reuse the "not
+    relevant" decision of boilerplate: pieces that differ in a few words often differ in numbers, sample
+    sizes or dates, which is exactly the data to extract, so a near duplicate of a relevant piece is classified again.
+
+    The index is persisted as JSON Lines (a header with the codebook signature, then one line per entry).
+    save() only appends the entries recorded since the previous save and reads the lines other processes
+    appended in the meantime, so saving after every document costs time proportional to the new entries;
+    compact() rewrites the file without duplicate lines once per run.
+    """
+
+    def __init__(self, filepath: str, codebook_signature: str, num_permutations: int = 64, num_bands: int = 16,
+                 similarity_threshold: float = 0.8, min_characters: int = 80, shingle_size: int = 3):
+        """
+        Args:
+            filepath (str): JSON file the index is loaded from and saved to.
+            codebook_signature (str): Hash of the labels/model the cached classifications were produced with.
+                                      A persisted index with a different signature is discarded.
+            num_permutations (int): Length of each MinHash signature.
+            num_bands (int): Number of LSH bands (must divide num_permutations).
+            similarity_threshold (float): Minimum estimated Jaccard similarity for a near-duplicate match.
+            min_characters (int): Pieces shorter than this are never indexed (they are too context dependent).
+            shingle_size (int): Number of words per shingle.
+        """
+        if num_permutations % num_bands != 0:
+            raise ValueError(f"num_permutations ({num_permutations}) must be divisible by num_bands ({num_bands}).")
+
+        self.filepath = filepath
+        self.codebook_signature = codebook_signature
+        self.num_permutations = num_permutations
+        self.num_bands = num_bands
+        self.rows_per_band = num_permutations // num_bands
+        self.similarity_threshold = similarity_threshold
+        self.min_characters = min_characters
+        self.shingle_size = shingle_size
+
+        # Fixed seed so signatures stay comparable across runs
+        rng = random.Random(1729)
+        self._permutations = [(rng.randint(1, _MERSENNE_PRIME - 1), rng.randint(0, _MERSENNE_PRIME - 1))
+                              for _ in range(num_permutations)]
+
+        self.entries = []          # [{"digest": str, "minhash": [int], "labels": [[label, conf]], "documents": [str]}]
+                                   # ("documents" is persisted as it was when the entry was first saved)
+        self._digest_to_entry = {} # Exact-match lookup: digest of normalized text -> entry position
+        self._band_buckets = {}    # LSH buckets: (band_number, band_hash) -> [entry positions]
+
+        self.document_stats = {}   # {document_name: {"pieces": n, "exact": n, "near": n, "irrelevant": n}}
+        self._saved_count = 0      # Entries [0, _saved_count) are in the file
+        self._file_offset = 0      # Bytes of the file already read (complete lines only)
+        self._file_id = None       # (device, inode) of the file read so far; compaction by another process replaces it
+
+    def _header(self) -> dict:
+        return {"version": _INDEX_FORMAT_VERSION, "codebook_signature": self.codebook_signature,
+                "num_permutations": self.num_permutations}
+
+    def _read_new_lines(self, f):
+        """Adds the entries of the complete lines from self._file_offset on, skipping digests already indexed."""
+        f.seek(self._file_offset)
+        for line in f:
+            if not line.endswith(b"\n"):
+                break # Partial line from an interrupted write
+            self._file_offset += len(line)
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            if entry.get("digest") not in self._digest_to_entry:
+                self._add_entry(entry)
+
+    def _sync(self, f) -> bool:
+        """
+        Reads the entries appended to the index file (opened in binary mode) since it was last read; the whole
+        file if it was replaced in the meantime. Returns False if the file belongs to another codebook or format.
+        """
+        stat = os.fstat(f.fileno())
+        if (stat.st_dev, stat.st_ino) != self._file_id:
+            f.seek(0)
+            try:
+                if json.loads(f.readline() or b"{}") != self._header():
+                    return False
+            except ValueError:
+                return False
+            self._file_id = (stat.st_dev, stat.st_ino)
+            self._file_offset = f.tell()
+        self._read_new_lines(f)
+        return True
+
+    @classmethod
+    def load(cls, filepath: str, codebook_signature: str, quiet: bool = False, **kwargs) -> "ContentDedupIndex":
+        """Creates an index and populates it from filepath if a compatible index was persisted by a previous run."""
+        index = cls(filepath, codebook_signature, **kwargs)
+        if not os.path.isfile(filepath):
+            return index
+
+        try:
+            with open(filepath, "rb") as f:
+                if not index._sync(f):
+                    if not quiet:
+                        print(f"Dedup index at {filepath} was built for a different codebook, model or format. Starting with an empty index.")
+                    return index
+        except OSError as e:
+            print(f"Warning: Could not read dedup index at {filepath}: {e}. Starting with an empty index.")
+            return index
+
+        index._saved_count = len(index.entries)
+        if not quiet:
+            print(f"Loaded dedup index with {len(index.entries)} known content pieces from {filepath}.")
+        return index
+
+    def save(self):
+        """
+        Appends the entries recorded since the previous save to self.filepath, after reading the entries other
+        processes sharing the file (distributed workers) appended in the meantime. Runs under a lock file.
+        A missing file, or one built for another codebook or format, is rewritten instead.
+        """
+        directory = os.path.dirname(self.filepath)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with _save_lock(self.filepath):
+            unsaved_entries = self.entries[self._saved_count:]
+            try:
+                with open(self.filepath, "r+b") as f:
+                    if self._sync(f):
+                        if unsaved_entries:
+                            f.seek(0, os.SEEK_END)
+                            if f.tell() > self._file_offset:
+                                f.write(b"\n") # Terminate a partial line left by an interrupted write
+                            f.write(b"".join(self._entry_line(entry) for entry in unsaved_entries))
+                            self._file_offset = f.tell()
+                        self._saved_count = len(self.entries)
+                        return
+            except FileNotFoundError:
+                pass
+            self._rewrite()
+
+    def compact(self):
+        """Rewrites the index file with one line per entry (dropping duplicate and partial lines), under the lock file."""
+        directory = os.path.dirname(self.filepath)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with _save_lock(self.filepath):
+            try:
+                with open(self.filepath, "rb") as f:
+                    self._sync(f) # Entries appended by other processes since our last save
+            except FileNotFoundError:
+                pass
+            self._rewrite()
+
+    def _entry_line(self, entry: dict) -> bytes:
+        return (json.dumps(entry, separators=(",", ":")) + "\n").encode("utf-8")
+
+    def _rewrite(self):
+        """Writes the header and every entry (to a temp file first, so a crash cannot corrupt the index). Caller holds the lock."""
+        tmp_filepath = f"{self.filepath}.{os.getpid()}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_filepath, "wb") as f:
+            f.write((json.dumps(self._header(), separators=(",", ":")) + "\n").encode("utf-8"))
+            f.write(b"".join(self._entry_line(entry) for entry in self.entries))
+            self._file_offset = f.tell()
+        os.replace(tmp_filepath, self.filepath)
+        stat = os.stat(self.filepath)
+        self._file_id = (stat.st_dev, stat.st_ino)
+        self._saved_count = len(self.entries)
+
+    def _minhash(self, normalized_text: str) -> list[int]:
+        """Computes the MinHash signature of a normalized text."""
+        base_hashes = [int.from_bytes(hashlib.blake2b(shingle.encode("utf-8"), digest_size=8).digest(), "big")
+                       for shingle in _shingles(normalized_text, self.shingle_size)]
+        return [min(((a * h + b) % _MERSENNE_PRIME) & _MAX_HASH for h in base_hashes)
+                for a, b in self._permutations]
+
+    def _band_keys(self, minhash: list[int]) -> list[tuple]:
+        """Splits a signature into LSH band keys."""
+        rows = self.rows_per_band
+        return [(band, hash(tuple(minhash[band * rows:(band + 1) * rows]))) for band in range(self.num_bands)]
+
+    def _add_entry(self, entry: dict) -> int:
+        position = len(self.entries)
+        self.entries.append(entry)
+        self._digest_to_entry[entry["digest"]] = position
+        for band_key in self._band_keys(entry["minhash"]):
+            self._band_buckets.setdefault(band_key, []).append(position)
+        return position
+
+    def _find(self, content_string: str):
+        """
+        Returns (entry_position, match_type, digest, minhash) for content_string, where match_type is
+        "exact", "near" or None. minhash is only computed when no exact match exists.
+        """
+        normalized_text = normalize_content(content_string)
+        digest = hashlib.sha1(normalized_text.encode("utf-8")).hexdigest()
+        if digest in self._digest_to_entry:
+            return self._digest_to_entry[digest], "exact", digest, None
+
+        minhash = self._minhash(normalized_text)
+        candidates = set()
+        for band_key in self._band_keys(minhash):
+            candidates.update(self._band_buckets.get(band_key, []))
+
+        best_position, best_similarity = None, 0.0
+        for position in candidates:
+            candidate_minhash = self.entries[position]["minhash"]
+            similarity = sum(1 for x, y in zip(minhash, candidate_minhash) if x == y) / self.num_permutations
+            if similarity > best_similarity:
+                best_position, best_similarity = position, similarity
+
+        if best_position is not None and best_similarity >= self.similarity_threshold:
+            return best_position, "near", digest, minhash
+        return None, None, digest, minhash
+
+    def is_indexable(self, content_string: str) -> bool:
+        return bool(content_string) and len(content_string.strip()) >= self.min_characters
+
+    def lookup(self, content_string: str, document_name: str):
+        """
+        Looks up a previously classified duplicate of content_string and updates the duplicate statistics
+        for document_name.
+
+        Returns:
+            list | None: The cached [[label, confidence], ...] list of an exact duplicate, [] for an exact or near
+                         duplicate of known-irrelevant boilerplate, or None if the piece must be classified (not seen
+                         before, a near duplicate of a relevant piece, or too short to index).
+        """
+        stats = self.document_stats.setdefault(document_name, {"pieces": 0, "exact": 0, "near": 0, "irrelevant": 0})
+        stats["pieces"] += 1
+        if not self.is_indexable(content_string):
+            return None
+
+        position, match_type, _digest, _minhash = self._find(content_string)
+        if match_type is None:
+            return None
+
+        entry = self.entries[position]
+        if match_type == "near" and entry["labels"]:
+            return None # Only the exact text may reuse labels; the differing words may be the data to extract
+        stats[match_type] += 1
+        if not entry["labels"]:
+            stats["irrelevant"] += 1
+        if document_name not in entry["documents"]:
+            entry["documents"].append(document_name)
+        return [list(label_pair) for label_pair in entry["labels"]]
+
+    def record(self, content_string: str, labels: list, document_name: str):
+        """
+        Stores the validated classification of a content piece.
+
+        Args:
+            content_string (str): The content piece that was classified.
+            labels (list): [[label, confidence], ...] as accepted for the piece (empty if it was not relevant to any label).
+            document_name (str): Document the piece came from.
+        """
+        if not self.is_indexable(content_string):
+            return
+        position, match_type, digest, minhash = self._find(content_string)
+        if match_type == "exact":
+            return # Already indexed; keep the first classification
+        if match_type == "near" and not labels and not self.entries[position]["labels"]:
+            return # Near duplicate of boilerplate that is already indexed
+        self._add_entry({
+            "digest": digest,
+            "minhash": minhash,
+            "labels": [list(label_pair) for label_pair in labels],
+            "documents": [document_name],
+        })
+
+    def document_report(self, document_name: str) -> str:
+        """Returns a one-line summary of duplicate ratios for a document."""
+        stats = self.document_stats.get(document_name)
+        if not stats or not stats["pieces"]:
+            return f"Dedup: no content pieces looked up for {document_name}."
+        duplicates = stats["exact"] + stats["near"]
+        return (f"Dedup: {duplicates}/{stats['pieces']} content pieces ({duplicates / stats['pieces']:.1%}) reused a previous classification "
+                f"({stats['exact']} exact, {stats['near']} near-duplicate boilerplate, {stats['irrelevant']} known-irrelevant pieces skipped).")
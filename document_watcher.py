@@ -0,0 +1,160 @@
+# document_watcher.py
+import os
+import json
+import time
+import threading
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from results_store import file_sha256
+
+
+class DocumentWatcher:
+    """
+    Finds documents to process in service mode: new or changed DOCX files in a watched directory, plus jobs
+    submitted explicitly (e.g., over the local HTTP API). Documents are identified by content hash, so a file
+    that is renamed, copied again or touched without changes is not processed twice, while an edited file is.
+
+    The directory is polled (no platform-specific file notification dependency). Hashes are cached by file
+    size and modification time, so a poll only reads files that changed since the previous one. A file is
+    only picked up once it has not been modified for settle_seconds, so half-copied files are not parsed.
+    """
+
+    def __init__(self, input_dir: str, list_documents, seen_hashes=(), settle_seconds: float = 5, clock=time.time):
+        """
+        Args:
+            input_dir (str): Directory to watch.
+            list_documents (callable): input_dir -> DOCX filenames to consider (e.g., list_input_documents).
+            seen_hashes (iterable): Content hashes already processed (e.g., from the results database).
+            settle_seconds (float): Minimum age of a file's last modification before it is picked up.
+            clock (callable): Wall clock in seconds, comparable with file modification times (injectable for tests).
+        """
+        self.input_dir = input_dir
+        self.list_documents = list_documents
+        self.seen_hashes = set(seen_hashes)
+        self.settle_seconds = settle_seconds
+        self.clock = clock
+        self._hash_cache = {}  # {file_path: ((size, mtime_ns), document_hash)}
+        self._submitted = deque() # (file_path, force) submitted jobs, processed before the directory scan
+        self._lock = threading.Lock()
+
+    def _document_hash(self, file_path: str) -> str:
+        stat = os.stat(file_path)
+        signature = (stat.st_size, stat.st_mtime_ns)
+        cached = self._hash_cache.get(file_path)
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+        document_hash = file_sha256(file_path)
+        self._hash_cache[file_path] = (signature, document_hash)
+        return document_hash
+
+    def submit(self, file_path: str, force: bool = False):
+        """Queues a document for the next poll; with force, it is processed even if its content was seen before."""
+        with self._lock:
+            self._submitted.append((file_path, force))
+
+    def pending_submissions(self) -> int:
+        with self._lock:
+            return len(self._submitted)
+
+    def poll(self) -> list[tuple[str, str]]:
+        """
+        Returns [(file_path, document_hash)] of the documents to process now (submitted jobs first, then new or
+        changed files in input_dir, in list order). Returned hashes are marked as seen.
+        """
+        with self._lock:
+            submitted, self._submitted = list(self._submitted), deque()
+        ready = []
+        for file_path, force in submitted:
+            try:
+                document_hash = self._document_hash(file_path)
+            except OSError as e:
+                print(f"Warning: Submitted document {file_path} cannot be read ({e}). Skipping it.")
+                continue
+            if force or document_hash not in self.seen_hashes:
+                self.seen_hashes.add(document_hash)
+                ready.append((file_path, document_hash))
+            else:
+                print(f"Submitted document {os.path.basename(file_path)} was already processed (same content). Skipping it.")
+
+        try:
+            filenames = self.list_documents(self.input_dir)
+        except OSError as e:
+            print(f"Warning: Could not list {self.input_dir} ({e}).")
+            return ready
+        now = self.clock()
+        for filename in filenames:
+            file_path = os.path.join(self.input_dir, filename)
+            try:
+                if now - os.path.getmtime(file_path) < self.settle_seconds:
+                    continue # Possibly still being copied; picked up by a later poll
+                document_hash = self._document_hash(file_path)
+            except OSError:
+                continue # Removed or locked since it was listed
+            if document_hash not in self.seen_hashes:
+                self.seen_hashes.add(document_hash)
+                ready.append((file_path, document_hash))
+        return ready
+
+
+class JobServer:
+    """
+    Minimal local HTTP API for service mode, served from a background thread:
+        POST /jobs    {"path": "paper.docx", "force": false} queues a document (relative paths are in input_dir)
+        GET  /status  returns the service's counters as JSON
+    Binds to localhost by default; it has no authentication, so do not expose it on a shared network.
+    """
+
+    def __init__(self, host: str, port: int, watcher: DocumentWatcher, input_dir: str, status_fn):
+        """
+        Args:
+            host (str): Interface to bind (e.g., "127.0.0.1").
+            port (int): TCP port (0 picks a free port; see .port).
+            watcher (DocumentWatcher): Receives submitted jobs.
+            input_dir (str): Directory relative job paths are resolved against.
+            status_fn (callable): Returns the JSON-serialisable status dict.
+        """
+        class Handler(BaseHTTPRequestHandler):
+            def _reply(self, status_code: int, payload: dict):
+                body = json.dumps(payload).encode("utf-8")
+                self.send_response(status_code)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                if self.path.rstrip("/") == "/status":
+                    self._reply(200, status_fn())
+                else:
+                    self._reply(404, {"error": "Unknown path. Use GET /status or POST /jobs."})
+
+            def do_POST(self):
+                if self.path.rstrip("/") != "/jobs":
+                    self._reply(404, {"error": "Unknown path. Use GET /status or POST /jobs."})
+                    return
+                try:
+                    job = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)) or b"{}")
+                    file_path = os.path.join(input_dir, job["path"])
+                except (ValueError, KeyError, TypeError):
+                    self._reply(400, {"error": 'Expected a JSON body like {"path": "paper.docx"}.'})
+                    return
+                if not file_path.lower().endswith(".docx") or not os.path.isfile(file_path):
+                    self._reply(400, {"error": f"Not a DOCX file: {file_path}"})
+                    return
+                watcher.submit(file_path, bool(job.get("force", False)))
+                self._reply(202, {"queued": file_path})
+
+            def log_message(self, format, *args):
+                pass # Requests are reflected in the service's own output
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.host, self.port = self.httpd.server_address[:2]
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name="job-server", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        print(f"Job API listening on http://{self.host}:{self.port} (POST /jobs, GET /status).")
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -0,0 +1,482 @@
+# docx_parser.py
+import os
+import re
+import math
+import statistics
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import docx
+from docx.table import Table as DocxTable
+from content_store import DocumentContentStore
+from evidence_selection import estimate_tokens
+
+DEFAULT_HEADING = "Default Heading (Document Start)"
+SECTION_HEADING_LEVELS = {"Heading 1": 1, "Heading 2": 2} # Paragraph styles that start a section
+# Section numbering ignored when matching heading patterns ("7. References", "IV) Appendix")
+_HEADING_NUMBERING_RE = re.compile(r"^(?:\d+(?:\.\d+)*|[IVXLC]+)[.)]?\s+")
+# Heading detection for documents without Heading styles (e.g., converted from PDF)
+_NUMBERED_HEADING_RE = re.compile(r"^(?P<number>\d+(?:\.\d+)*\.?|[IVX]+\.)\s+(?P<title>[A-Z][^.!?]*)$")
+COMMON_SECTION_TITLES = {
+    "abstract", "introduction", "background", "literature review", "related work", "method", "methods", "methodology",
+    "materials and methods", "participants", "procedure", "measures", "analysis", "data analysis", "results",
+    "findings", "discussion", "limitations", "conclusion", "conclusions", "implications", "future work",
+    "references", "bibliography", "acknowledgements", "acknowledgments", "appendix", "keywords",
+}
+# Used when parse_document is called without rules: the original stop at a 'Heading 2' titled 'REFERENCES'
+LEGACY_SKIP_RULES = [{"name": "references", "heading_pattern": r"^references$", "styles": ["Heading 2"], "action": "stop"}]
+
+
+# Helper function to convert a python-docx Table object to GitHub Flavored Markdown
+def docx_table_to_markdown(table_obj: DocxTable) -> str:
+    """Converts a python-docx Table object to a GitHub Flavored Markdown string."""
+    md_rows = []
+    for i, row in enumerate(table_obj.rows):
+        # Escape pipe characters within cell text to avoid breaking Markdown table structure
+        cells_text = [cell.text.strip().replace("|", "\\|") for cell in row.cells]
+        md_rows.append("| " + " | ".join(cells_text) + " |")
+        if i == 0:  # After header row, add separator
+            separator = ["---"] * len(cells_text)
+            md_rows.append("| " + " | ".join(separator) + " |")
+    return "\n".join(md_rows)
+
+
+class SectionSkipRule:
+    """
+    A rule dropping content during parsing, before any of it is sent for classification.
+
+    A rule matches a paragraph whose style is in styles (default: the section heading styles if heading_pattern
+    is given), whose text matches heading_pattern (case-insensitive, ignoring leading section numbers and a
+    trailing colon) and whose position in the document body lies within [min_position, max_position].
+    When the matched paragraph is a section heading, "skip" drops that section (up to the next heading of the
+    same or a higher level) and "stop" drops it and everything after it. Any other matched paragraph is dropped
+    on its own ("skip") or ends the document there ("stop").
+    """
+
+    __slots__ = ("name", "heading_pattern", "styles", "action", "min_position", "max_position")
+
+    def __init__(self, name: str, heading_pattern: str = None, styles: list[str] = None, action: str = "skip",
+                 min_position: float = 0.0, max_position: float = 1.0):
+        """
+        Args:
+            name (str): Label used in skip reports.
+            heading_pattern (str, optional): Regular expression matched against the paragraph text.
+            styles (list[str], optional): Paragraph style names the rule applies to.
+            action (str): "skip" or "stop".
+            min_position (float): Earliest position (0 = start, 1 = end of the document body) the rule applies at.
+            max_position (float): Latest position the rule applies at.
+        """
+        if action not in ("skip", "stop"):
+            raise ValueError(f"Section skip rule '{name}': action must be 'skip' or 'stop', not '{action}'.")
+        if not heading_pattern and not styles:
+            raise ValueError(f"Section skip rule '{name}' needs a heading_pattern, styles, or both.")
+        self.name = name
+        self.heading_pattern = re.compile(heading_pattern, re.IGNORECASE) if heading_pattern else None
+        self.styles = tuple(styles) if styles else tuple(SECTION_HEADING_LEVELS)
+        self.action = action
+        self.min_position = min_position
+        self.max_position = max_position
+
+    def matches(self, text: str, style_name: str, position: float) -> bool:
+        if style_name not in self.styles or not self.min_position <= position <= self.max_position:
+            return False
+        if self.heading_pattern is None:
+            return True
+        normalized_text = _HEADING_NUMBERING_RE.sub("", text.strip()).rstrip(":").strip()
+        return self.heading_pattern.search(normalized_text) is not None
+
+
+def compile_skip_rules(skip_rules) -> list[SectionSkipRule]:
+    """Builds SectionSkipRules from config dicts (SECTION_SKIP_RULES); raises ValueError on an invalid rule."""
+    return [rule if isinstance(rule, SectionSkipRule) else SectionSkipRule(**rule) for rule in skip_rules]
+
+
+class ParsedDocument:
+    """
+    A document read and segmented into sections, ready for classification. Picklable, so it can be
+    produced in a worker process.
+    """
+
+    __slots__ = ("file_path", "content_store", "sections", "section_parts", "raw_piece_count", "skipped", "notes", "error")
+
+    def __init__(self, file_path: str):
+        self.file_path = file_path
+        self.content_store = DocumentContentStore() # Content pieces (no headings) kept for processing, by global index
+        self.sections = []       # [(heading_text, start_idx, end_idx)] over content_store, in document order
+        self.section_parts = []  # [(part_number, part_count)] per section; (1, 1) unless balance_sections split it
+        self.raw_piece_count = 0 # Paragraphs and tables found in the document body (including headings)
+        self.skipped = []        # [{"rule", "action", "heading", "pieces", "tokens"}] content dropped by section skip rules
+        self.notes = []          # Messages produced while parsing, printed by the consumer
+        self.error = None        # Error message if the document could not be opened
+
+    def skip_report(self) -> str:
+        """Summarises the content pieces and estimated tokens dropped by section skip rules ("" if none)."""
+        if not self.skipped:
+            return ""
+        skipped_pieces = sum(entry["pieces"] for entry in self.skipped)
+        skipped_tokens = sum(entry["tokens"] for entry in self.skipped)
+        kept_tokens = sum(estimate_tokens(content_string) for content_string in self.content_store)
+        details = "; ".join(f"{entry['rule']} ({entry['action']} at '{entry['heading']}'): {entry['pieces']} pieces, ~{entry['tokens']} tokens"
+                            for entry in self.skipped)
+        return (f"Section rules skipped {skipped_pieces} of {skipped_pieces + len(self.content_store)} content pieces "
+                f"(~{skipped_tokens} estimated tokens, {skipped_tokens / max(skipped_tokens + kept_tokens, 1):.0%}) "
+                f"in {os.path.basename(self.file_path)}: {details}")
+
+
+def _style_attribute(style, read_attribute):
+    """Reads a font attribute from a style or, if it inherits the attribute, from its base styles."""
+    while style is not None:
+        value = read_attribute(style.font)
+        if value is not None:
+            return value
+        style = style.base_style
+    return None
+
+
+def paragraph_format_hints(paragraph, max_characters: int) -> dict:
+    """
+    Returns {"bold", "font_size"} of a paragraph: bold if it is short and every run with text is bold (directly
+    or through its style), font_size the largest run size in points (None if unknown). The sizes of longer
+    paragraphs give the body text size that detected headings are compared with.
+    """
+    text = paragraph.text.strip()
+    if not text:
+        return {"bold": False, "font_size": None}
+    style_size = _style_attribute(paragraph.style, lambda font: font.size)
+    text_runs = [run for run in paragraph.runs if run.text.strip()]
+    bold = False
+    if len(text) <= max_characters:
+        style_bold = _style_attribute(paragraph.style, lambda font: font.bold)
+        bold = bool(text_runs) and all(run.bold if run.bold is not None else bool(style_bold) for run in text_runs)
+    sizes = [run.font.size.pt for run in text_runs if run.font.size is not None]
+    font_size = max(sizes) if sizes else (style_size.pt if style_size is not None else None)
+    return {"bold": bold, "font_size": font_size}
+
+
+def uses_heading_styles(doc) -> bool:
+    """
+    Returns True if any top-level paragraph of a python-docx Document uses a SECTION_HEADING_LEVELS style.
+    Only compares paragraph style IDs in the body XML, so it is much cheaper than read_raw_content_pieces.
+    """
+    heading_style_ids = {style.style_id for style in doc.styles if style.name in SECTION_HEADING_LEVELS}
+    if not heading_style_ids:
+        return False
+    return any(block_xml_element.tag.endswith('p') and block_xml_element.style in heading_style_ids
+               for block_xml_element in doc.element.body)
+
+
+def read_raw_content_pieces(doc, format_hint_max_characters: int = 0) -> list[dict]:
+    """
+    Returns every top-level paragraph and table of a python-docx Document as {"type", "content", "style"}, in body order.
+    With format_hint_max_characters, paragraphs also get "bold" and "font_size" (for heading detection; only
+    paragraphs up to that length can be bold headings).
+    """
+    raw_document_content_pieces = []
+    # Ensure access to python-docx objects for ._element comparison
+    all_paragraphs_in_doc = list(doc.paragraphs)
+    all_tables_in_doc = list(doc.tables)
+
+    iter_paragraphs = iter(all_paragraphs_in_doc)
+    iter_tables = iter(all_tables_in_doc)
+
+    current_para_obj = next(iter_paragraphs, None)
+    current_table_obj = next(iter_tables, None)
+
+    # Iterate through the top-level block elements in the document body
+    for block_xml_element in doc.element.body:
+        if block_xml_element.tag.endswith('p'): # It's a paragraph
+            if current_para_obj and block_xml_element == current_para_obj._element:
+                raw_piece = {
+                    "type": "paragraph",
+                    "content": current_para_obj.text,
+                    "style": current_para_obj.style.name
+                }
+                if format_hint_max_characters > 0:
+                    raw_piece.update(paragraph_format_hints(current_para_obj, format_hint_max_characters))
+                raw_document_content_pieces.append(raw_piece)
+                current_para_obj = next(iter_paragraphs, None)
+        elif block_xml_element.tag.endswith('tbl'): # It's a table
+            if current_table_obj and block_xml_element == current_table_obj._element:
+                markdown_table = docx_table_to_markdown(current_table_obj)
+                raw_document_content_pieces.append({
+                    "type": "table_markdown",
+                    "content": markdown_table,
+                    "style": "Table" # Conceptual style name for tables
+                })
+                current_table_obj = next(iter_tables, None)
+    return raw_document_content_pieces
+
+
+def detect_structural_headings(raw_document_content_pieces: list[dict], max_heading_characters: int = 120) -> int:
+    """
+    Marks paragraphs that look like headings as 'Heading 1'/'Heading 2' (in place), for documents that use no
+    Heading styles. A short paragraph is a heading if it is numbered like a section ("2 Methods", "3.1 Sample",
+    "IV. Results"), is a common section title on its own line, is in a larger font than the body text, is all
+    capitals, or is entirely bold. Numbered subsections and bold lines become 'Heading 2', the rest 'Heading 1'.
+    The original style is kept in "detected_from". Returns the number of headings detected.
+    """
+    paragraph_sizes = [piece["font_size"] for piece in raw_document_content_pieces
+                       if piece["type"] == "paragraph" and piece.get("font_size") and len(piece["content"]) > max_heading_characters]
+    body_font_size = statistics.median(paragraph_sizes) if paragraph_sizes else None
+
+    detected = 0
+    for piece in raw_document_content_pieces:
+        text = piece["content"].strip()
+        if piece["type"] != "paragraph" or not text or len(text) > max_heading_characters or len(text.split()) > 15:
+            continue
+        title = text.rstrip(":").strip()
+        numbered = _NUMBERED_HEADING_RE.match(title)
+        level = None
+        if numbered and len(title.split()) <= 10:
+            level = 2 if "." in numbered.group("number").rstrip(".") else 1
+        elif title.lower() in COMMON_SECTION_TITLES:
+            level = 1
+        elif text.endswith((".", ",", ";")) or not any(character.isalpha() for character in text):
+            continue # Sentences, captions and numbers are body text even when emphasised
+        elif body_font_size and piece.get("font_size") and piece["font_size"] >= body_font_size + 1.5:
+            level = 1
+        elif title.isupper() and len(title) > 3:
+            level = 1
+        elif piece.get("bold"):
+            level = 2
+        if level is not None:
+            piece["detected_from"] = piece["style"]
+            piece["style"] = f"Heading {level}"
+            detected += 1
+    return detected
+
+
+def balance_sections(sections: list, content_store, max_pieces: int = 0, max_tokens: int = 0) -> tuple[list, list]:
+    """
+    Splits sections over max_pieces content pieces or max_tokens estimated content tokens into the fewest
+    chunks of roughly equal size (by tokens) that respect both limits, so no single classification call
+    carries a whole unstructured document. Chunks keep the original heading text. 0 disables a limit.
+
+    Returns:
+        tuple: (sections, section_parts) where section_parts holds (part_number, part_count) for each section.
+    """
+    balanced_sections = []
+    section_parts = []
+    for heading, start_idx, end_idx in sections:
+        piece_tokens = [estimate_tokens(content_store[global_idx]) for global_idx in range(start_idx, end_idx)]
+        chunk_count = 1
+        if max_pieces > 0:
+            chunk_count = max(chunk_count, math.ceil(len(piece_tokens) / max_pieces))
+        if max_tokens > 0:
+            chunk_count = max(chunk_count, math.ceil(sum(piece_tokens) / max_tokens))
+        chunk_count = min(chunk_count, len(piece_tokens))
+        if chunk_count <= 1:
+            balanced_sections.append((heading, start_idx, end_idx))
+            section_parts.append((1, 1))
+            continue
+        # Cut where the running token total crosses each multiple of total/chunk_count, and whenever a chunk reaches max_pieces
+        target_tokens = sum(piece_tokens) / chunk_count
+        boundaries = [start_idx]
+        running_tokens = 0
+        for offset, tokens in enumerate(piece_tokens):
+            chunk_pieces = start_idx + offset - boundaries[-1]
+            if chunk_pieces and ((len(boundaries) < chunk_count and running_tokens + tokens / 2 > target_tokens * len(boundaries))
+                                 or (max_pieces > 0 and chunk_pieces >= max_pieces)):
+                boundaries.append(start_idx + offset)
+            running_tokens += tokens
+        boundaries.append(end_idx)
+        part_count = len(boundaries) - 1
+        for part_number in range(part_count):
+            balanced_sections.append((heading, boundaries[part_number], boundaries[part_number + 1]))
+            section_parts.append((part_number + 1, part_count))
+    return balanced_sections, section_parts
+
+
+def parse_document(file_path: str, skip_rules: list = None, detect_headings: bool = False,
+                   max_section_pieces: int = 0, max_section_tokens: int = 0, max_heading_characters: int = 120,
+                   max_styled_section_pieces: int = 0) -> ParsedDocument:
+    """
+    Reads a Word document, converts tables to Markdown and segments the content into sections
+    (demarcated by 'Heading 1'/'Heading 2' paragraphs), dropping the content matched by skip_rules.
+    Never raises: open/parse failures are reported in ParsedDocument.error.
+
+    Args:
+        file_path (str): The path to the Word document.
+        skip_rules (list, optional): SectionSkipRules or their config dicts (SECTION_SKIP_RULES). Defaults to
+                                     LEGACY_SKIP_RULES (stop at a 'Heading 2' titled 'REFERENCES').
+        detect_headings (bool): If the document uses no 'Heading 1'/'Heading 2' styles, detect headings from
+                                numbering, common section titles, font size, capitals and bold lines.
+        max_section_pieces (int): In documents without heading styles, split sections with more content pieces
+                                  into balanced chunks (0 = no limit).
+        max_section_tokens (int): Same, by estimated content tokens (0 = no limit).
+        max_heading_characters (int): Longest paragraph considered as a detected heading.
+        max_styled_section_pieces (int): In documents with heading styles, split only sections with more content
+                                         pieces than one classification response can label (0 = never split).
+    """
+    parsed_document = ParsedDocument(file_path)
+    skip_rules = compile_skip_rules(LEGACY_SKIP_RULES if skip_rules is None else skip_rules)
+    try:
+        doc = docx.Document(file_path)
+        has_heading_styles = uses_heading_styles(doc)
+        # Formatting hints are only read for documents that need heading detection
+        raw_document_content_pieces = read_raw_content_pieces(
+            doc, max_heading_characters if detect_headings and not has_heading_styles else 0)
+    except Exception as e:
+        parsed_document.error = f"Error opening document {file_path}: {e}"
+        return parsed_document
+
+    if detect_headings and not has_heading_styles:
+        detected = detect_structural_headings(raw_document_content_pieces, max_heading_characters)
+        parsed_document.notes.append(f"No Heading 1/Heading 2 styles in {os.path.basename(file_path)}; "
+                                     f"detected {detected} headings from numbering, titles and formatting.")
+
+    parsed_document.raw_piece_count = len(raw_document_content_pieces)
+    content_store = parsed_document.content_store
+    current_heading_text = DEFAULT_HEADING
+    current_section_start_idx = 0
+    skipped_by_key = {}   # {(rule name, heading): skip report entry}, in document order
+    skipping_level = None # Heading level of the section being skipped, if any
+    skipping_entry = None
+
+    def skip_entry(rule: SectionSkipRule, heading_text: str) -> dict:
+        entry = skipped_by_key.get((rule.name, heading_text))
+        if entry is None:
+            entry = {"rule": rule.name, "action": rule.action, "heading": heading_text, "pieces": 0, "tokens": 0}
+            skipped_by_key[(rule.name, heading_text)] = entry
+        return entry
+
+    for position, raw_piece_data in enumerate(raw_document_content_pieces):
+        content_string = raw_piece_data["content"]
+        style_name = raw_piece_data["style"]
+        heading_level = SECTION_HEADING_LEVELS.get(style_name)
+        relative_position = position / max(len(raw_document_content_pieces) - 1, 1)
+        matched_rule = next((rule for rule in skip_rules if rule.matches(content_string, style_name, relative_position)), None)
+
+        if matched_rule is not None and matched_rule.action == "stop":
+            entry = skip_entry(matched_rule, content_string if heading_level else current_heading_text)
+            for remaining_piece in raw_document_content_pieces[position:]:
+                if remaining_piece["style"] not in SECTION_HEADING_LEVELS:
+                    entry["pieces"] += 1
+                    entry["tokens"] += estimate_tokens(remaining_piece["content"])
+            parsed_document.notes.append(f"Found '{content_string}' ({style_name}, rule '{matched_rule.name}'). "
+                                         f"Processing any preceding content and then stopping.")
+            break # Do not process the matched paragraph or anything after
+
+        if skipping_level is not None and heading_level is not None and heading_level <= skipping_level:
+            skipping_level, skipping_entry = None, None # The skipped section ends at a heading of the same or a higher level
+
+        if heading_level is not None:
+            # Close the previous section (sections without content are not classified)
+            if len(content_store) > current_section_start_idx:
+                parsed_document.sections.append((current_heading_text, current_section_start_idx, len(content_store)))
+            current_heading_text = content_string
+            current_section_start_idx = len(content_store)
+            if matched_rule is not None and skipping_level is None:
+                skipping_level, skipping_entry = heading_level, skip_entry(matched_rule, content_string)
+        elif skipping_entry is not None or matched_rule is not None:
+            entry = skipping_entry or skip_entry(matched_rule, current_heading_text)
+            entry["pieces"] += 1
+            entry["tokens"] += estimate_tokens(content_string)
+        else: # It's a content piece (paragraph or table markdown)
+            content_store.append(content_string, raw_piece_data["type"], style_name)
+
+    if len(content_store) > current_section_start_idx:
+        parsed_document.sections.append((current_heading_text, current_section_start_idx, len(content_store)))
+    parsed_document.skipped = list(skipped_by_key.values())
+    # Release the document tree and the raw pieces, so after the join the text is only held by the store
+    del doc, raw_document_content_pieces
+    content_store.finalize()
+    # Real sections of styled documents are kept whole unless one classification response could not label them
+    if has_heading_styles:
+        max_section_pieces, max_section_tokens = max_styled_section_pieces, 0
+    parsed_document.section_parts = [(1, 1)] * len(parsed_document.sections)
+    if max_section_pieces > 0 or max_section_tokens > 0:
+        section_count = len(parsed_document.sections)
+        parsed_document.sections, parsed_document.section_parts = balance_sections(
+            parsed_document.sections, content_store, max_section_pieces, max_section_tokens)
+        if len(parsed_document.sections) > section_count:
+            parsed_document.notes.append(f"Split oversized sections of {os.path.basename(file_path)} into balanced chunks "
+                                         f"({section_count} -> {len(parsed_document.sections)} sections).")
+    return parsed_document
+
+
+def new_parse_pool(max_workers: int) -> ProcessPoolExecutor:
+    """
+    Returns a process pool for parse_document. Workers are spawned rather than forked, because callers have
+    usually initialised gRPC clients and started threads already, which a forked child would inherit in an
+    undefined state.
+    """
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("spawn"))
+
+
+class ParsePrefetcher:
+    """
+    Parses documents ahead of the LLM stages in a process pool, so DOCX unzipping, XML parsing and table
+    conversion overlap with API waits. At most prefetch_window parsed documents are in flight or waiting,
+    which bounds memory. Documents are yielded in the order given.
+
+    Usage:
+        with ParsePrefetcher(file_paths, max_workers=2, prefetch_window=4) as prefetcher:
+            for file_path, parsed_document in prefetcher:
+                ...
+    """
+
+    def __init__(self, file_paths: list[str], max_workers: int = 2, prefetch_window: int = 4, profiler=None,
+                 executor: ProcessPoolExecutor = None, **parse_options):
+        """
+        Args:
+            file_paths (list[str]): Documents to parse, in processing order.
+            max_workers (int): Parser processes. 0 parses each document in this process when it is needed.
+            prefetch_window (int): Maximum number of documents parsed ahead of the one being processed.
+            profiler (StageProfiler, optional): Profiles in-process parsing as the "parse" stage.
+            executor (ProcessPoolExecutor, optional): A pool from new_parse_pool to use instead of starting one
+                                                      (e.g., one pool for a whole service run). It is not shut down on exit.
+            **parse_options: Keyword arguments of parse_document (skip_rules, detect_headings, ...).
+        """
+        self.file_paths = list(file_paths)
+        self.max_workers = max_workers
+        self.prefetch_window = max(1, prefetch_window)
+        self.profiler = profiler
+        self.parse_options = dict(parse_options)
+        if self.parse_options.get("skip_rules") is not None: # Validated before any worker starts
+            self.parse_options["skip_rules"] = compile_skip_rules(self.parse_options["skip_rules"])
+        self._shared_executor = executor
+        self._executor = None
+        self._in_flight = deque() # (file_path, future) submitted but not yet yielded
+
+    def __enter__(self):
+        if self.max_workers > 0 and len(self.file_paths) > 1:
+            self._executor = self._shared_executor or new_parse_pool(self.max_workers)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self._executor is not None:
+            if self._executor is self._shared_executor:
+                for _file_path, future in self._in_flight:
+                    future.cancel()
+            else:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+        self._in_flight.clear()
+        return False
+
+    def __iter__(self):
+        if self._executor is None:
+            for file_path in self.file_paths:
+                if self.profiler is None:
+                    parsed_document = parse_document(file_path, **self.parse_options)
+                else:
+                    with self.profiler.stage("parse", os.path.basename(file_path)):
+                        parsed_document = parse_document(file_path, **self.parse_options)
+                yield file_path, parsed_document
+            return
+
+        in_flight = self._in_flight
+        next_position = 0
+        while next_position < len(self.file_paths) or in_flight:
+            while next_position < len(self.file_paths) and len(in_flight) < self.prefetch_window:
+                file_path = self.file_paths[next_position]
+                in_flight.append((file_path, self._executor.submit(parse_document, file_path, **self.parse_options)))
+                next_position += 1
+            file_path, future = in_flight.popleft()
+            try:
+                parsed_document = future.result()
+            except Exception as e: # e.g., a parser process died
+                print(f"Warning: Background parsing of {os.path.basename(file_path)} failed ({type(e).__name__}: {e}). Parsing it in this process.")
+                parsed_document = parse_document(file_path, **self.parse_options)
+            yield file_path, parsed_document
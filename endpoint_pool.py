@@ -0,0 +1,168 @@
+# endpoint_pool.py
+import time
+import random
+import threading
+from collections import deque
+from google.api_core import exceptions as google_exceptions
+
+# Errors that mean "this endpoint is out of quota or capacity right now", so the call is retried elsewhere
+FAILOVER_ERRORS = (google_exceptions.TooManyRequests, google_exceptions.ResourceExhausted, google_exceptions.ServiceUnavailable)
+
+
+def model_resource_name(project: str, location: str, model_name: str) -> str:
+    """Full Vertex AI resource name of a publisher model, which binds a model object to its own project and region."""
+    if model_name.startswith("projects/"):
+        return model_name
+    return f"projects/{project}/locations/{location}/publishers/google/models/{model_name}"
+
+
+def vertex_model_factory(system_instruction: str):
+    """Returns a factory building a GenerativeModel for one (project, location, model) endpoint."""
+    from vertexai.generative_models import GenerativeModel
+
+    def build_model(project: str, location: str, model_name: str):
+        return GenerativeModel(model_resource_name(project, location, model_name), system_instruction=system_instruction)
+    return build_model
+
+
+class ModelEndpoint:
+    """One (project, location, model) member of an EndpointPool, with its health and usage counters."""
+
+    def __init__(self, project: str, location: str, model_name: str, weight: float = 1.0, requests_per_minute: int = 0):
+        self.project = project
+        self.location = location
+        self.model_name = model_name
+        self.weight = weight
+        self.requests_per_minute = requests_per_minute # 0 = not tracked
+        self.model = None                  # Built lazily by the pool's model factory
+        self.recent_requests = deque()     # Start times (monotonic) of requests in the last minute
+        self.consecutive_failures = 0
+        self.cooldown_until = 0.0
+        self.stats = {"calls": 0, "succeeded": 0, "rate_limited": 0, "unavailable": 0, "errors": 0, "tokens": 0}
+
+    @property
+    def name(self) -> str:
+        return f"{self.project}/{self.location}/{self.model_name}"
+
+
+class EndpointPool:
+    """
+    Routes model calls across several (project, location, model) endpoints so throughput is not capped by one
+    region's or one project's quota. Exposes the generate_content/count_tokens interface of a GenerativeModel,
+    so it is shared by classification and extraction without changes to the callers.
+
+    Routing is weighted random among healthy endpoints that are below their requests-per-minute quota. An endpoint
+    answering 429 (quota) or 503 (unavailable) is put in a cooldown that doubles with consecutive failures, and the
+    call fails over to another endpoint; only when every endpoint has failed is the error raised to the caller's
+    retry loop. Other errors (bad request, safety, ...) are not endpoint problems and are raised immediately.
+    """
+
+    def __init__(self, endpoints: list, model_factory, cooldown_seconds: float = 30, max_cooldown_seconds: float = 600,
+                 rng: random.Random = None, clock=time.monotonic):
+        """
+        Args:
+            endpoints (list[ModelEndpoint]): Pool members.
+            model_factory (callable): (project, location, model_name) -> object with generate_content and count_tokens
+                                      (e.g., vertex_model_factory(...), or a local stand-in for tests).
+            cooldown_seconds (float): Cooldown after an endpoint's first 429/503; doubled per consecutive failure.
+            max_cooldown_seconds (float): Upper bound of the cooldown.
+            rng (random.Random, optional): Random source for weighted routing (seedable for tests).
+            clock (callable): Monotonic clock in seconds (injectable for tests).
+        """
+        if not endpoints:
+            raise ValueError("An endpoint pool needs at least one endpoint.")
+        self.endpoints = list(endpoints)
+        self.model_factory = model_factory
+        self.cooldown_seconds = cooldown_seconds
+        self.max_cooldown_seconds = max_cooldown_seconds
+        self.rng = rng or random.Random()
+        self.clock = clock
+        self._lock = threading.Lock()
+
+    def _model(self, endpoint: ModelEndpoint):
+        with self._lock:
+            if endpoint.model is None:
+                endpoint.model = self.model_factory(endpoint.project, endpoint.location, endpoint.model_name)
+            return endpoint.model
+
+    def _under_quota(self, endpoint: ModelEndpoint, now: float) -> bool:
+        while endpoint.recent_requests and now - endpoint.recent_requests[0] >= 60:
+            endpoint.recent_requests.popleft()
+        return endpoint.requests_per_minute <= 0 or len(endpoint.recent_requests) < endpoint.requests_per_minute
+
+    def choose(self, exclude=()) -> ModelEndpoint:
+        """
+        Picks the endpoint for the next request and counts the request against its quota. Healthy endpoints under
+        quota are chosen by weight; if there are none, the endpoint that becomes usable soonest is returned.
+        """
+        with self._lock:
+            now = self.clock()
+            candidates = [endpoint for endpoint in self.endpoints if endpoint not in exclude] or list(self.endpoints)
+            available = [endpoint for endpoint in candidates
+                         if endpoint.cooldown_until <= now and self._under_quota(endpoint, now)]
+            if available:
+                chosen = self.rng.choices(available, weights=[max(endpoint.weight, 0.0) or 1e-9 for endpoint in available])[0]
+            else:
+                def usable_at(endpoint):
+                    quota_free_at = endpoint.recent_requests[0] + 60 if not self._under_quota(endpoint, now) else now
+                    return max(endpoint.cooldown_until, quota_free_at)
+                chosen = min(candidates, key=usable_at)
+            chosen.recent_requests.append(now)
+            chosen.stats["calls"] += 1
+            return chosen
+
+    def _record_success(self, endpoint: ModelEndpoint, response_obj):
+        with self._lock:
+            endpoint.consecutive_failures = 0
+            endpoint.cooldown_until = 0.0
+            endpoint.stats["succeeded"] += 1
+            usage = getattr(response_obj, "usage_metadata", None)
+            endpoint.stats["tokens"] += int(getattr(usage, "total_token_count", 0) or 0) if usage is not None else 0
+
+    def _record_failover(self, endpoint: ModelEndpoint, error: Exception):
+        with self._lock:
+            endpoint.consecutive_failures += 1
+            cooldown = min(self.cooldown_seconds * (2 ** (endpoint.consecutive_failures - 1)), self.max_cooldown_seconds)
+            endpoint.cooldown_until = self.clock() + cooldown
+            endpoint.stats["unavailable" if isinstance(error, google_exceptions.ServiceUnavailable) else "rate_limited"] += 1
+        print(f"Endpoint {endpoint.name} returned {type(error).__name__}; cooling down for {cooldown:.0f}s and failing over.")
+
+    def _call(self, method_name: str, *args, **kwargs):
+        tried = []
+        last_error = None
+        for _attempt in range(len(self.endpoints)):
+            endpoint = self.choose(exclude=tried)
+            tried.append(endpoint)
+            try:
+                response_obj = getattr(self._model(endpoint), method_name)(*args, **kwargs)
+            except FAILOVER_ERRORS as e:
+                self._record_failover(endpoint, e)
+                last_error = e
+                continue
+            except Exception:
+                with self._lock:
+                    endpoint.stats["errors"] += 1
+                raise
+            if method_name == "generate_content":
+                self._record_success(endpoint, response_obj)
+            return response_obj
+        raise last_error
+
+    def generate_content(self, *args, **kwargs):
+        """GenerativeModel.generate_content on a routed endpoint, failing over on 429/503."""
+        return self._call("generate_content", *args, **kwargs)
+
+    def count_tokens(self, *args, **kwargs):
+        """GenerativeModel.count_tokens on a routed endpoint, failing over on 429/503."""
+        return self._call("count_tokens", *args, **kwargs)
+
+    def summary(self) -> str:
+        lines = [f"Endpoint pool ({len(self.endpoints)} endpoints):"]
+        now = self.clock()
+        for endpoint in self.endpoints:
+            s = endpoint.stats
+            state = f"cooling down {endpoint.cooldown_until - now:.0f}s" if endpoint.cooldown_until > now else "healthy"
+            lines.append(f"  {endpoint.name} (weight {endpoint.weight:g}): {s['calls']} calls, {s['succeeded']} succeeded, "
+                         f"{s['rate_limited']} rate limited, {s['unavailable']} unavailable, {s['errors']} other errors, "
+                         f"{s['tokens']} tokens; {state}")
+        return "\n".join(lines)
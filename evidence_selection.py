@@ -0,0 +1,117 @@
+# evidence_selection.py
+
+
+def estimate_tokens(text: str) -> int:
+    """Cheap offline token estimate (about 4 characters per token for English text)."""
+    return max(1, len(text) // 4) if text else 0
+
+
+def select_evidence(headings_map: dict, content_store, confidence_threshold: float, token_budget: int,
+                    context_window: int = 1, min_pieces: int = 1) -> tuple[dict, dict]:
+    """
+    Selects the content pieces sent to an extraction call for one tag.
+
+    Pieces at or above confidence_threshold are ranked by confidence and added until token_budget is reached.
+    Remaining budget is then spent on below-threshold pieces of the same tag that sit within context_window
+    indices of a selected piece (adjacent context such as the continuation of a table or paragraph).
+    At least min_pieces of the best pieces are always kept so every tag still gets an extraction.
+
+    Args:
+        headings_map (dict): { 'heading_text': [(confidence, global_idx), ...] } for one tag.
+        content_store (DocumentContentStore): The document's content pieces, looked up by global_idx.
+        confidence_threshold (float): Minimum classification confidence for a piece to be selected on its own.
+        token_budget (int): Maximum estimated content tokens for the call (0 or less disables the cap).
+        context_window (int): How many indices before/after a selected piece count as adjacent.
+        min_pieces (int): Number of top pieces kept regardless of threshold and budget.
+
+    Returns:
+        tuple: (selected_headings_map, stats) where selected_headings_map has the same format as headings_map
+               (headings and pieces in document order) and stats counts what was kept and pruned.
+    """
+    # Collapse duplicates of the same piece (keep its highest confidence) and remember its heading
+    candidates = {}    # {global_idx: (confidence, heading)}
+    tokens_by_idx = {} # {global_idx: estimated tokens}
+    for heading_text, content_tuples_list in headings_map.items():
+        for confidence, global_idx in content_tuples_list:
+            if global_idx not in tokens_by_idx:
+                content_string = content_store[global_idx]
+                if not content_string or content_string.isspace():
+                    continue
+                tokens_by_idx[global_idx] = estimate_tokens(content_string)
+            if global_idx not in candidates or confidence > candidates[global_idx][0]:
+                candidates[global_idx] = (confidence, heading_text)
+
+    ranked = sorted(candidates.items(), key=lambda item: (-item[1][0], item[0]))
+    has_budget = token_budget is not None and token_budget > 0
+
+    selected = set()
+    used_tokens = 0
+    for rank, (global_idx, (confidence, _heading)) in enumerate(ranked):
+        forced = rank < min_pieces
+        if confidence < confidence_threshold and not forced:
+            continue
+        if has_budget and used_tokens + tokens_by_idx[global_idx] > token_budget and not forced:
+            continue
+        selected.add(global_idx)
+        used_tokens += tokens_by_idx[global_idx]
+
+    # Spend leftover budget on adjacent pieces, closest to the best evidence first
+    context_added = 0
+    if context_window > 0:
+        anchors = set(selected) # Context is only added around selected evidence, never around added context
+        for global_idx, _data in ranked:
+            if global_idx not in anchors:
+                continue
+            for offset in range(1, context_window + 1):
+                for neighbour_idx in (global_idx - offset, global_idx + offset):
+                    if neighbour_idx in selected or neighbour_idx not in candidates:
+                        continue
+                    if has_budget and used_tokens + tokens_by_idx[neighbour_idx] > token_budget:
+                        continue
+                    selected.add(neighbour_idx)
+                    used_tokens += tokens_by_idx[neighbour_idx]
+                    context_added += 1
+
+    selected_headings_map = {}
+    emitted = set()
+    for heading_text, content_tuples_list in headings_map.items():
+        kept = []
+        for _confidence, global_idx in content_tuples_list:
+            if global_idx in selected and global_idx not in emitted and candidates[global_idx][1] == heading_text:
+                kept.append((candidates[global_idx][0], global_idx))
+                emitted.add(global_idx)
+        if kept:
+            selected_headings_map[heading_text] = sorted(kept, key=lambda item: item[1])
+
+    pruned = [confidence for global_idx, (confidence, _heading) in candidates.items() if global_idx not in selected]
+    stats = {
+        "candidates": len(candidates),
+        "selected": len(selected),
+        "candidate_tokens": sum(tokens_by_idx.values()),
+        "selected_tokens": used_tokens,
+        "below_threshold": sum(1 for confidence in pruned if confidence < confidence_threshold),
+        "over_budget": sum(1 for confidence in pruned if confidence >= confidence_threshold),
+        "context_added": context_added,
+    }
+    return selected_headings_map, stats
+
+
+class EvidenceSelectionMetrics:
+    """Accumulates select_evidence statistics for a document or a whole run."""
+
+    def __init__(self):
+        self.totals = {}
+
+    def add(self, stats: dict):
+        for key, value in stats.items():
+            self.totals[key] = self.totals.get(key, 0) + value
+
+    def summary(self, scope: str) -> str:
+        candidate_tokens = self.totals.get("candidate_tokens", 0)
+        if not candidate_tokens:
+            return f"Evidence selection ({scope}): no extraction payloads."
+        pruned_tokens = candidate_tokens - self.totals.get("selected_tokens", 0)
+        return (f"Evidence selection ({scope}): kept {self.totals.get('selected', 0)}/{self.totals.get('candidates', 0)} content pieces, "
+                f"pruned ~{pruned_tokens}/{candidate_tokens} estimated tokens ({pruned_tokens / candidate_tokens:.1%}); "
+                f"{self.totals.get('below_threshold', 0)} below threshold, {self.totals.get('over_budget', 0)} over budget, "
+                f"{self.totals.get('context_added', 0)} adjacent pieces added as context.")
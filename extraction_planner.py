@@ -0,0 +1,104 @@
+# extraction_planner.py
+from evidence_selection import estimate_tokens
+
+
+class ExtractionGroup:
+    """
+    One extraction call: the tags whose evidence is sent together, the union of their target variables, and
+    their evidence merged by heading so a content piece selected for several tags is sent only once.
+    """
+
+    __slots__ = ("tag_labels", "target_variables", "payload_by_heading", "piece_tokens", "separate_evidence_tokens")
+
+    def __init__(self):
+        self.tag_labels = []
+        self.target_variables = {}          # {variable_name: definition}, union over tag_labels
+        self.payload_by_heading = {}        # {heading: {global_idx_str: content_string}}
+        self.piece_tokens = {}              # {global_idx_str: estimated tokens} of the merged evidence
+        self.separate_evidence_tokens = 0   # Evidence tokens if each tag had its own call
+
+    @property
+    def evidence_tokens(self) -> int:
+        return sum(self.piece_tokens.values())
+
+    def add(self, tag_label: str, target_variables: dict, payload_by_heading: dict, piece_tokens: dict):
+        self.tag_labels.append(tag_label)
+        self.target_variables.update(target_variables)
+        for heading, payload in payload_by_heading.items():
+            self.payload_by_heading.setdefault(heading, {}).update(payload)
+        self.piece_tokens.update(piece_tokens)
+        self.separate_evidence_tokens += sum(piece_tokens.values())
+
+    def ordered_payload(self) -> dict:
+        """The merged evidence in document order (headings by their first piece, pieces by index)."""
+        ordered_headings = sorted(self.payload_by_heading.items(), key=lambda item: min(int(global_idx) for global_idx in item[1]))
+        return {heading: dict(sorted(payload.items(), key=lambda item: int(item[0]))) for heading, payload in ordered_headings}
+
+
+def evidence_overlap(piece_tokens_a: dict, piece_tokens_b: dict) -> float:
+    """Token-weighted Jaccard overlap of two evidence sets ({global_idx_str: estimated tokens})."""
+    shared_tokens = sum(tokens for global_idx, tokens in piece_tokens_a.items() if global_idx in piece_tokens_b)
+    union_tokens = sum(piece_tokens_a.values()) + sum(piece_tokens_b.values()) - shared_tokens
+    return shared_tokens / union_tokens if union_tokens else 0.0
+
+
+def plan_extraction_groups(tag_requests: list, min_overlap: float = 0.5, max_evidence_tokens: int = 0,
+                           max_variables: int = 0) -> list[ExtractionGroup]:
+    """
+    Groups extraction requests of one document into calls. Each tag, in order, joins the existing group whose
+    evidence it overlaps most (at least min_overlap) if the merged evidence and variable count stay within
+    the limits; otherwise it starts a new group. With min_overlap above 1, every tag gets its own call.
+
+    Args:
+        tag_requests (list): [(tag_label, target_variables, payload_by_heading)] where payload_by_heading is
+                             {heading: {global_idx_str: content_string}} (the tag's selected evidence).
+        min_overlap (float): Minimum token-weighted Jaccard overlap between a tag's evidence and a group's.
+        max_evidence_tokens (int): Maximum estimated evidence tokens of a merged call (0 = no limit).
+        max_variables (int): Maximum target variables of a merged call, bounding its output (0 = no limit).
+
+    Returns:
+        list[ExtractionGroup]: One group per extraction call, in order of their first tag.
+    """
+    groups = []
+    for tag_label, target_variables, payload_by_heading in tag_requests:
+        piece_tokens = {global_idx: estimate_tokens(content_string)
+                        for payload in payload_by_heading.values() for global_idx, content_string in payload.items()}
+        best_group, best_overlap = None, min_overlap
+        for group in groups:
+            overlap = evidence_overlap(piece_tokens, group.piece_tokens)
+            if overlap < best_overlap:
+                continue
+            merged_tokens = group.evidence_tokens + sum(tokens for global_idx, tokens in piece_tokens.items()
+                                                        if global_idx not in group.piece_tokens)
+            if max_evidence_tokens > 0 and merged_tokens > max_evidence_tokens:
+                continue
+            if max_variables > 0 and len(set(group.target_variables) | set(target_variables)) > max_variables:
+                continue
+            best_group, best_overlap = group, overlap
+        if best_group is None:
+            best_group = ExtractionGroup()
+            groups.append(best_group)
+        best_group.add(tag_label, target_variables, payload_by_heading, piece_tokens)
+    return groups
+
+
+class ExtractionMergeMetrics:
+    """Accumulates the calls and evidence tokens saved by merged extraction calls, for a document or a run."""
+
+    def __init__(self):
+        self.totals = {"tags": 0, "calls": 0, "separate_evidence_tokens": 0, "merged_evidence_tokens": 0}
+
+    def add(self, groups: list[ExtractionGroup]):
+        self.totals["tags"] += sum(len(group.tag_labels) for group in groups)
+        self.totals["calls"] += len(groups)
+        self.totals["separate_evidence_tokens"] += sum(group.separate_evidence_tokens for group in groups)
+        self.totals["merged_evidence_tokens"] += sum(group.evidence_tokens for group in groups)
+
+    def summary(self, scope: str) -> str:
+        separate_tokens = self.totals["separate_evidence_tokens"]
+        if not self.totals["tags"]:
+            return f"Extraction merging ({scope}): no extraction calls."
+        saved_tokens = separate_tokens - self.totals["merged_evidence_tokens"]
+        return (f"Extraction merging ({scope}): {self.totals['tags']} tags in {self.totals['calls']} calls; "
+                f"~{self.totals['merged_evidence_tokens']} evidence tokens sent instead of ~{separate_tokens} "
+                f"({saved_tokens / separate_tokens if separate_tokens else 0:.1%} saved).")
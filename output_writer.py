@@ -0,0 +1,186 @@
+# output_writer.py
+import os
+import csv
+from openpyxl import Workbook
+from openpyxl.cell.cell import ILLEGAL_CHARACTERS_RE
+from results_store import EXCEL_COLUMNS
+
+EXCEL_MAX_CELL_CHARACTERS = 32767
+CONTENT_COLUMNS = ["filename", "index", "content"]
+
+
+def _excel_safe(value):
+    """Removes characters Excel cannot store and truncates text to Excel's cell limit."""
+    if not isinstance(value, str):
+        return value
+    value = ILLEGAL_CHARACTERS_RE.sub("", value)
+    if len(value) > EXCEL_MAX_CELL_CHARACTERS:
+        suffix = " [truncated]"
+        value = value[:EXCEL_MAX_CELL_CHARACTERS - len(suffix)] + suffix
+    return value
+
+
+class _XlsxPart:
+    """One output workbook in openpyxl write-only mode: rows are streamed to temporary files, not kept as cells."""
+
+    def __init__(self, path: str, with_content_sheet: bool):
+        self.path = path
+        self.workbook = Workbook(write_only=True)
+        self.results_sheet = self.workbook.create_sheet("results")
+        self.results_sheet.append(EXCEL_COLUMNS)
+        self.content_sheet = None
+        if with_content_sheet:
+            self.content_sheet = self.workbook.create_sheet("content")
+            self.content_sheet.append(CONTENT_COLUMNS)
+
+    def append_result(self, values: list):
+        self.results_sheet.append([_excel_safe(value) for value in values])
+
+    def append_content(self, values: list):
+        self.content_sheet.append([_excel_safe(value) for value in values])
+
+    def close(self):
+        self.workbook.save(self.path)
+
+
+class _CsvPart:
+    """One output part as CSV files, appended and flushed per document (a content sheet becomes a *_content.csv file)."""
+
+    def __init__(self, path: str, with_content_sheet: bool):
+        self.path = path
+        self.paths = [path]
+        self._results_file = open(path, "w", newline="", encoding="utf-8")
+        self._results_writer = csv.writer(self._results_file)
+        self._results_writer.writerow(EXCEL_COLUMNS)
+        self._content_file = None
+        if with_content_sheet:
+            content_path = path[:-len(".csv")] + "_content.csv"
+            self.paths.append(content_path)
+            self._content_file = open(content_path, "w", newline="", encoding="utf-8")
+            self._content_writer = csv.writer(self._content_file)
+            self._content_writer.writerow(CONTENT_COLUMNS)
+
+    def append_result(self, values: list):
+        self._results_writer.writerow(values)
+
+    def append_content(self, values: list):
+        self._content_writer.writerow(values)
+
+    def flush(self):
+        self._results_file.flush()
+        if self._content_file is not None:
+            self._content_file.flush()
+
+    def close(self):
+        self._results_file.close()
+        if self._content_file is not None:
+            self._content_file.close()
+
+
+class StreamingResultsWriter:
+    """
+    Writes result rows as each document completes instead of collecting them for one DataFrame at the end.
+    Output rolls over to a new part (file) once a part reaches max_rows_per_part rows or max_characters_per_part
+    characters, always at a document boundary. With content_sheet, each referenced content piece is written once
+    per document to a "content" sheet and rows reference it by index instead of repeating its text per variable.
+
+    Parts are written as <base_name>_partNNN.<ext> while the run is in progress and renamed at close() to
+    <base_name><status_suffix>[_partNNN].<ext> (no part number if there is only one).
+    """
+
+    def __init__(self, output_dir: str, base_name: str, file_format: str = "xlsx", max_rows_per_part: int = 50000,
+                 max_characters_per_part: int = 100_000_000, content_sheet: bool = False):
+        """
+        Args:
+            output_dir (str): Directory for the output files.
+            base_name (str): File name prefix (e.g., "extracted_data_<timestamp>").
+            file_format (str): "xlsx" (openpyxl write-only mode) or "csv".
+            max_rows_per_part (int): Result rows per part before rolling over (0 = unlimited).
+            max_characters_per_part (int): Approximate characters per part before rolling over (0 = unlimited).
+            content_sheet (bool): Write content pieces to a separate sheet and reference them by index.
+        """
+        if file_format not in ("xlsx", "csv"):
+            raise ValueError(f"Unsupported output format '{file_format}' (expected 'xlsx' or 'csv').")
+        self.output_dir = output_dir
+        self.base_name = base_name
+        self.file_format = file_format
+        self.max_rows_per_part = max_rows_per_part
+        self.max_characters_per_part = max_characters_per_part
+        self.content_sheet = content_sheet
+        self.rows_written = 0
+        self.documents_written = 0
+        self._part = None
+        self._part_rows = 0
+        self._part_characters = 0
+        self._closed_parts = [] # Finished parts (still under their temporary names), in order
+
+    def _part_path(self, part_number: int) -> str:
+        return os.path.join(self.output_dir, f"{self.base_name}_part{part_number:03d}.{self.file_format}")
+
+    def _open_part(self):
+        os.makedirs(self.output_dir, exist_ok=True)
+        part_class = _XlsxPart if self.file_format == "xlsx" else _CsvPart
+        self._part = part_class(self._part_path(len(self._closed_parts) + 1), self.content_sheet)
+        self._part_rows = 0
+        self._part_characters = 0
+
+    def _close_part(self):
+        if self._part is not None:
+            self._part.close()
+            self._closed_parts.append(self._part)
+            self._part = None
+
+    def _part_is_full(self) -> bool:
+        return ((self.max_rows_per_part > 0 and self._part_rows >= self.max_rows_per_part) or
+                (self.max_characters_per_part > 0 and self._part_characters >= self.max_characters_per_part))
+
+    def write_document(self, rows: list[dict], referenced_content: dict = None):
+        """
+        Appends one document's result rows (and, with content_sheet, its referenced content pieces).
+
+        Args:
+            rows (list[dict]): Result rows as built by process_single_document.
+            referenced_content (dict, optional): {global_idx: content text} of the pieces the rows cite
+                                                 (used only with content_sheet).
+        """
+        if not rows:
+            return
+        if self._part is not None and self._part_is_full():
+            self._close_part()
+        if self._part is None:
+            self._open_part()
+
+        filename = rows[0].get("filename", "")
+        for row in rows:
+            values = [row.get(column, "") for column in EXCEL_COLUMNS]
+            if self.content_sheet:
+                values[EXCEL_COLUMNS.index("relevant_paragraphs_or_tables")] = ", ".join(
+                    f"Index {global_idx}" for global_idx in row.get("indices", []))
+            self._part.append_result(values)
+            self._part_characters += sum(len(value) for value in values if isinstance(value, str))
+        if self.content_sheet and referenced_content:
+            for global_idx in sorted(referenced_content):
+                self._part.append_content([filename, global_idx, referenced_content[global_idx]])
+                self._part_characters += len(referenced_content[global_idx])
+        if isinstance(self._part, _CsvPart):
+            self._part.flush()
+
+        self._part_rows += len(rows)
+        self.rows_written += len(rows)
+        self.documents_written += 1
+
+    def close(self, status_suffix: str = "") -> list[str]:
+        """Finishes the last part and renames all parts with the run's status suffix. Returns the output paths."""
+        self._close_part()
+        final_paths = []
+        single_part = len(self._closed_parts) == 1
+        for part_number, part in enumerate(self._closed_parts, start=1):
+            part_label = "" if single_part else f"_part{part_number:03d}"
+            temporary_stem = self._part_path(part_number)[:-len(self.file_format) - 1]
+            for temporary_path in getattr(part, "paths", [part.path]):
+                file_tail = temporary_path[len(temporary_stem):] # ".xlsx", ".csv" or "_content.csv"
+                final_path = os.path.join(self.output_dir, f"{self.base_name}{status_suffix}{part_label}{file_tail}")
+                os.replace(temporary_path, final_path)
+                final_paths.append(final_path)
+        self._closed_parts = []
+        return final_paths
@@ -0,0 +1,128 @@
+# profiling.py
+import io
+import os
+import re
+import time
+import pstats
+import cProfile
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+
+_DISABLED_STAGE = nullcontext() # Shared no-op context returned for every stage when profiling is off
+
+
+def _safe_filename(name: str) -> str:
+    return re.sub(r"[^A-Za-z0-9._-]+", "_", name)
+
+
+class StageProfiler:
+    """
+    Opt-in CPU (cProfile) and memory (tracemalloc) profiling of pipeline stages ("parse", "classification",
+    "extraction", "output"). Each stage run is profiled separately and dumped per document to
+    <output_dir>/<document>.<stage>.pstats (open with pstats or snakeviz) and .tracemalloc (a tracemalloc
+    snapshot); stats are also accumulated per stage for an end-of-run summary.
+
+    When disabled, stage() returns a shared no-op context manager, so the hooks cost a method call and nothing else.
+    Only the main thread is profiled: time spent waiting on model calls (which run on worker threads) shows up
+    as lock waits in the calling stage.
+    """
+
+    def __init__(self, enabled: bool = False, output_dir: str = "", top_n: int = 15, traceback_frames: int = 5):
+        """
+        Args:
+            enabled (bool): Profile stages. If False, every hook is a no-op.
+            output_dir (str): Directory for per-document .pstats and .tracemalloc dumps.
+            top_n (int): Functions and allocation sites listed per stage in the summary.
+            traceback_frames (int): Frames stored per allocation by tracemalloc (more frames cost more memory).
+        """
+        self.enabled = enabled
+        self.output_dir = output_dir
+        self.top_n = top_n
+        self.traceback_frames = traceback_frames
+        self._active_stage = None
+        self._stage_stats = {}        # {stage: pstats.Stats accumulated over documents}
+        self._stage_seconds = {}      # {stage: wall-clock seconds}
+        self._stage_runs = {}         # {stage: number of profiled runs}
+        self._stage_peak_bytes = {}   # {stage: highest traced memory peak of a single run}
+        self._stage_allocations = {}  # {stage: {allocation site: bytes still allocated at stage end, summed over runs}}
+
+    def enable(self, output_dir: str, top_n: int = None):
+        self.enabled = True
+        self.output_dir = output_dir
+        if top_n is not None:
+            self.top_n = top_n
+
+    def stage(self, stage_name: str, document_name: str = "run"):
+        """Returns a context manager profiling the enclosed code as one run of stage_name for document_name."""
+        if not self.enabled or self._active_stage is not None: # Nested stages are part of the enclosing one
+            return _DISABLED_STAGE
+        return self._profile_stage(stage_name, document_name)
+
+    @contextmanager
+    def _profile_stage(self, stage_name: str, document_name: str):
+        self._active_stage = stage_name
+        tracemalloc_was_running = tracemalloc.is_tracing()
+        if not tracemalloc_was_running:
+            tracemalloc.start(self.traceback_frames)
+        tracemalloc.reset_peak()
+        profile = cProfile.Profile()
+        started = time.perf_counter()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            elapsed = time.perf_counter() - started
+            snapshot = tracemalloc.take_snapshot()
+            _current_bytes, peak_bytes = tracemalloc.get_traced_memory()
+            if not tracemalloc_was_running:
+                tracemalloc.stop()
+            self._active_stage = None
+            self._record(stage_name, document_name, profile, snapshot, elapsed, peak_bytes)
+
+    def _record(self, stage_name: str, document_name: str, profile, snapshot, elapsed: float, peak_bytes: int):
+        self._stage_seconds[stage_name] = self._stage_seconds.get(stage_name, 0.0) + elapsed
+        self._stage_runs[stage_name] = self._stage_runs.get(stage_name, 0) + 1
+        self._stage_peak_bytes[stage_name] = max(self._stage_peak_bytes.get(stage_name, 0), peak_bytes)
+
+        profile.create_stats()
+        if stage_name in self._stage_stats:
+            self._stage_stats[stage_name].add(profile)
+        else:
+            self._stage_stats[stage_name] = pstats.Stats(profile, stream=io.StringIO())
+
+        snapshot = snapshot.filter_traces((tracemalloc.Filter(False, tracemalloc.__file__),))
+        allocations = self._stage_allocations.setdefault(stage_name, {})
+        for statistic in snapshot.statistics("lineno")[:self.top_n * 4]:
+            site = str(statistic.traceback[0])
+            allocations[site] = allocations.get(site, 0) + statistic.size
+
+        if self.output_dir:
+            try:
+                os.makedirs(self.output_dir, exist_ok=True)
+                base_path = os.path.join(self.output_dir, f"{_safe_filename(document_name)}.{stage_name}")
+                profile.dump_stats(base_path + ".pstats")
+                snapshot.dump(base_path + ".tracemalloc")
+            except OSError as e:
+                print(f"Warning: Could not write profile of stage '{stage_name}' for {document_name}: {e}")
+
+    def summary(self) -> str:
+        """Returns the per-stage time, peak memory, top functions (by own time) and top allocation sites."""
+        if not self.enabled:
+            return ""
+        if not self._stage_stats:
+            return "Profile: no stages were profiled."
+        lines = [f"Profile by stage (per-document dumps in {self.output_dir}):"]
+        for stage_name in sorted(self._stage_seconds, key=self._stage_seconds.get, reverse=True):
+            lines.append(f"\n== {stage_name}: {self._stage_seconds[stage_name]:.2f}s over {self._stage_runs[stage_name]} run(s), "
+                         f"peak traced memory {self._stage_peak_bytes[stage_name] / 1024 / 1024:.1f} MiB ==")
+            stream = io.StringIO()
+            stats = self._stage_stats[stage_name]
+            stats.stream = stream
+            stats.sort_stats("tottime").print_stats(self.top_n)
+            lines.append(stream.getvalue().strip())
+            top_allocations = sorted(self._stage_allocations.get(stage_name, {}).items(), key=lambda item: item[1], reverse=True)[:self.top_n]
+            if top_allocations:
+                lines.append("Largest allocations still held at stage end:")
+                lines.extend(f"  {size / 1024:.1f} KiB  {site}" for site, size in top_allocations)
+        return "\n".join(lines)
@@ -0,0 +1,258 @@
+# prompt_compiler.py
+import json
+import hashlib
+
+SYSTEM_INSTRUCTION = """You are a meticulous research assistant with expertise in natural language processing. Your primary focus will be on analyzing the methodologies, findings, and details of **the main, current research study being reported in the provided academic articles.** You will be assigned two main tasks:
+1. **Paragraph Classification:** Given a research paper section heading and its paragraphs (which may include text paragraphs or tables formatted as Markdown), you will classify each paragraph/table based on a set of predefined labels, along with your confidence in each label. You will be provided with descriptions of these labels to guide your classification.
+2. **Variable Extraction:** Given a research paper section heading, paragraphs (which may include text paragraphs or tables formatted as Markdown), and a list of target variables, you will extract the values of these variables from the paragraphs/tables. For each extracted value, you will provide a justification explaining how you derived it from the text, referencing the most relevant paragraph(s)/table(s). You will be provided with detailed descriptions of the target variables to help you accurately identify and extract them."""
+
+# Prompt components, in the order they appear in every compiled prompt. Static components come first
+# so consecutive prompts share the longest possible prefix.
+PROMPT_COMPONENTS = ("instructions", "codebook", "content")
+
+CLASSIFICATION_LABEL_RULES = (
+    "You MUST ONLY use label names from the VALID LABEL NAMES list below; the descriptions that follow it explain what each label covers. "
+    "If a content piece is relevant to multiple labels, assign multiple labels using ONLY names from the VALID LABEL NAMES list. "
+    "For each relevant content piece, provide a list containing pairs of [\"exact_label_name_from_valid_list\", confidence_score_0_to_1]. "
+    "If a content piece is not relevant to any of the listed VALID LABEL NAMES, do not include that content piece index in your response's 'classifications' object.\n\n"
+    "The response MUST be a single JSON object with the following format. Pay EXTREMELY close attention to JSON syntax, especially commas between list items and object properties:\n"
+    "```json\n"
+    "{\"classifications\": {\"[Content Piece Index String]\": [[\"exact_label_name_from_valid_list_1\", 0.0], [\"exact_label_name_from_valid_list_2\", 0.0]], "
+    "\"[Another Content Piece Index String]\": [[\"exact_label_name_from_valid_list_3\", 0.0]]}}\n"
+    "```\n"
+    "CRITICAL: Ensure every label name you output in the 'classifications' is an exact match to one of the names in the 'VALID LABEL NAMES' list. Do not use descriptions or other phrases as label names. "
+    "The entire response MUST be only the valid JSON object, without any surrounding text or markdown fences in the final output. Ensure all strings are double-quoted, and all lists and objects are correctly structured with necessary commas.\n\n"
+)
+
+CLASSIFICATION_INSTRUCTIONS = (
+    "Your task is to classify each content piece (paragraph or table formatted as Markdown) of the research paper section given at the end of this prompt. "
+    "The section is a JSON object with a 'heading' and a 'paragraphs' dictionary whose keys are unique content piece indices (as strings) and whose values are the content strings.\n\n"
+    + CLASSIFICATION_LABEL_RULES
+)
+
+DOCUMENT_CLASSIFICATION_INSTRUCTIONS = (
+    "Your task is to classify each content piece (paragraph or table formatted as Markdown) of the whole research paper given at the end of this prompt. "
+    "The paper is a JSON object with a 'sections' list in document order; each section has a 'heading' and a 'paragraphs' dictionary whose keys are unique content piece indices (as strings) and whose values are the content strings. "
+    "Use each section's heading as context for its content pieces. Indices are unique across the whole paper, so return all classifications in one 'classifications' object.\n\n"
+    + CLASSIFICATION_LABEL_RULES
+)
+
+EXTRACTION_INSTRUCTIONS = (
+    "You are an expert data extractor for systematic reviews. You are given, at the end of this prompt:\n"
+    "1. TARGET VARIABLES: A JSON dictionary of variables you need to extract. For each variable (the key), the value is an object containing:\n"
+    "   - 'description': A detailed description of what this variable represents.\n"
+    "   - 'examples': (Optional) A list of example values to guide you.\n"
+    "   - 'notes_questions': (Optional) Specific notes, context, or guiding questions related to extracting this variable. You MUST consider these carefully if provided.\n"
+    "2. RELEVANT CONTENT: A JSON dictionary where keys are section headings from a research paper. The values for each heading are dictionaries where keys are unique content piece indices (as strings) and values are the content strings (these can be text paragraphs or tables formatted as GitHub Flavored Markdown) that have been deemed relevant to the target variables under that heading.\n\n"
+    "**CRUCIAL INSTRUCTION FOR DATA SCOPE:**\n"
+    "When extracting values for the target variables, you MUST focus *exclusively* on information that describes the **primary research study** being conducted and reported in the provided content. "
+    "Do NOT extract data or values that pertain to **other studies, previous work, or background literature** that are merely cited or discussed. "
+    "If a target variable's specific value or detail is only found within the description of a cited study and not for the primary study's own methodology, sample, or results, then you should consider that value as 'Not Found' for the primary study.\n\n"
+    "Please extract the values for the target variables from the RELEVANT CONTENT, adhering strictly to the data scope instruction above.\n"
+    "If a value cannot be found for the primary study with high confidence, set the \"value\" to 'Not Found'.\n\n"
+    "For each target variable, provide:\n"
+    "- \"value\": The extracted value (string, number, boolean Y/N as appropriate, or 'Not Found').\n"
+    "- \"confidence\": Your confidence in the extraction (a float from 0.0 to 1.0).\n"
+    "- \"indices\": A list of a few (typically 1-5) unique content piece indices (strings, as provided in the RELEVANT CONTENT) that are **most directly relevant** to supporting your extracted 'value' and 'justification'. If the 'value' is 'Not Found' because the information is absent from the primary study, this list should ideally be empty `[]` or contain at most 1-2 indices that broadly confirm this absence.\n"
+    "- \"justification\": A **very brief** explanation (preferably a single concise sentence) of how you deduced the value for the primary study, referencing specific information from the content found at the provided indices.\n\n"
+    "Return your results as a single JSON object with one key per variable name listed under REQUIRED OUTPUT KEYS, using exactly these names. Each value follows this format:\n"
+    "```json\n"
+    "{\"[variable_name]\": {\"value\": \"[extracted value or 'Not Found']\", \"confidence\": 0.0, \"indices\": [\"string_index_1\"], \"justification\": \"[brief explanation]\"}}\n"
+    "```\n"
+    "YOUR ENTIRE RESPONSE MUST BE ONLY THIS VALID JSON OBJECT.\n\n"
+)
+
+
+def compact_json(obj) -> str:
+    """Serialises obj without indentation or padding whitespace (non-ASCII text is kept as-is, which tokenises shorter than escapes)."""
+    return json.dumps(obj, separators=(",", ":"), ensure_ascii=False)
+
+
+class CompiledPrompt:
+    """A prompt split into named components so token usage can be attributed to each of them."""
+
+    __slots__ = ("components",)
+
+    def __init__(self, components: dict):
+        self.components = components # {component_name: text}, in PROMPT_COMPONENTS order
+
+    @property
+    def text(self) -> str:
+        return "".join(self.components.values())
+
+
+class PromptCompiler:
+    """
+    Builds classification and extraction prompts. Everything that does not depend on the document
+    (instructions, label descriptions, target variable definitions) is rendered once per run and reused;
+    only the content component is rendered per call, as compact JSON keyed by global content piece indices.
+    """
+
+    def __init__(self, paragraph_tag_descriptions: dict, target_variables: dict, cluster_target_variables: dict):
+        """
+        Args:
+            paragraph_tag_descriptions (dict): {tag_label: [description, ...]} (PARAGRAPH_TAG_DESCRIPTIONS).
+            target_variables (dict): {variable_name: {"description", "examples", "notes_questions"}} (TARGET_VARIABLES).
+            cluster_target_variables (dict): {cluster_name: [variable_name, ...]} (CLUSTER_TARGET_VARIABLES).
+        """
+        self.target_variables = target_variables
+        self.cluster_target_variables = cluster_target_variables
+        self.valid_label_names = list(paragraph_tag_descriptions.keys())
+
+        label_lines = [f"- **{label_name}**: {'; '.join(description_list)}"
+                       for label_name, description_list in paragraph_tag_descriptions.items()]
+        self.classification_codebook = (
+            f"VALID LABEL NAMES: [{', '.join(self.valid_label_names)}]\n\n"
+            "Available Labels and What They Cover:\n" + "\n".join(label_lines) + "\n\n"
+        )
+        self._extraction_codebooks = {} # {tuple(variable names): rendered codebook component}
+
+    def target_variables_for_tag(self, tag_label: str) -> dict:
+        """Returns the target variables extracted for a paragraph tag (a single variable or a cluster's variables)."""
+        if tag_label in self.target_variables:
+            return {tag_label: self.target_variables[tag_label]}
+        if tag_label in self.cluster_target_variables:
+            return {var_name: self.target_variables[var_name]
+                    for var_name in self.cluster_target_variables.get(tag_label, []) if var_name in self.target_variables}
+        return {}
+
+    def classification_prompt(self, heading: str, payload_paragraphs: dict) -> CompiledPrompt:
+        """
+        Args:
+            heading (str): Section heading.
+            payload_paragraphs (dict): {global_idx_str: content_string} for the non-empty pieces of the section.
+        """
+        content = "SECTION TO CLASSIFY:\n" + compact_json({"heading": heading, "paragraphs": payload_paragraphs}) + "\n"
+        return CompiledPrompt({
+            "instructions": CLASSIFICATION_INSTRUCTIONS,
+            "codebook": self.classification_codebook,
+            "content": content,
+        })
+
+    def document_classification_prompt(self, section_payloads: list) -> CompiledPrompt:
+        """
+        Args:
+            section_payloads (list): [(heading, {global_idx_str: content_string})] for every section of a document,
+                                     in document order.
+        """
+        sections = [{"heading": heading, "paragraphs": payload_paragraphs} for heading, payload_paragraphs in section_payloads]
+        content = "DOCUMENT TO CLASSIFY:\n" + compact_json({"sections": sections}) + "\n"
+        return CompiledPrompt({
+            "instructions": DOCUMENT_CLASSIFICATION_INSTRUCTIONS,
+            "codebook": self.classification_codebook,
+            "content": content,
+        })
+
+    def extraction_codebook(self, target_vars: dict) -> str:
+        """Renders (once per distinct variable set) the target variable definitions, omitting empty examples/notes."""
+        cache_key = tuple(target_vars.keys())
+        if cache_key not in self._extraction_codebooks:
+            definitions = {}
+            for var_name, var_info in target_vars.items():
+                definition = {"description": var_info["description"]}
+                if var_info.get("examples"):
+                    definition["examples"] = var_info["examples"]
+                if var_info.get("notes_questions"):
+                    definition["notes_questions"] = var_info["notes_questions"]
+                definitions[var_name] = definition
+            self._extraction_codebooks[cache_key] = (
+                "TARGET VARIABLES:\n" + compact_json(definitions) + "\n\n"
+                f"REQUIRED OUTPUT KEYS: [{', '.join(target_vars.keys())}]\n\n"
+            )
+        return self._extraction_codebooks[cache_key]
+
+    def extraction_prompt(self, target_vars: dict, content_payload_by_heading: dict) -> CompiledPrompt:
+        """
+        Args:
+            target_vars (dict): {variable_name: variable definition} to extract in this call.
+            content_payload_by_heading (dict): {heading: {global_idx_str: content_string}}.
+        """
+        return CompiledPrompt({
+            "instructions": EXTRACTION_INSTRUCTIONS,
+            "codebook": self.extraction_codebook(target_vars),
+            "content": "RELEVANT CONTENT:\n" + compact_json(content_payload_by_heading) + "\n",
+        })
+
+
+class TokenLedger:
+    """
+    Accumulates input tokens per prompt component (system instruction, instructions, codebook, content)
+    and output tokens per task kind ("classification", "extraction").
+
+    Static components are counted once with the model's token counter and cached by content hash; the content
+    component is the remainder of the prompt token count reported in the response's usage metadata, so no
+    per-call counting request is needed.
+    """
+
+    def __init__(self, count_tokens_fn, system_instruction: str = "", enabled: bool = True):
+        """
+        Args:
+            count_tokens_fn (callable): Returns the token count of a string (e.g., via GenerativeModel.count_tokens).
+            system_instruction (str): The model's system instruction, which is billed with every prompt.
+            enabled (bool): If False, record() is a no-op and the summary is empty.
+        """
+        self.count_tokens_fn = count_tokens_fn
+        self.enabled = enabled
+        self._static_counts = {} # {sha1 of text: token count}
+        self.totals = {}         # {task_kind: {"calls": n, "system": n, "instructions": n, ..., "output": n}}
+        self.system_instruction_tokens = self._count_static(system_instruction) if (enabled and system_instruction) else 0
+
+    def _count_static(self, text: str) -> int:
+        key = hashlib.sha1(text.encode("utf-8")).hexdigest()
+        if key not in self._static_counts:
+            try:
+                self._static_counts[key] = int(self.count_tokens_fn(text))
+            except Exception as e:
+                print(f"Warning: Token counting failed ({type(e).__name__}: {e}). Estimating from character count.")
+                self._static_counts[key] = max(1, len(text) // 4)
+        return self._static_counts[key]
+
+    def record(self, task_kind: str, compiled_prompt: CompiledPrompt, response_obj=None) -> dict:
+        """
+        Attributes the input tokens of one call to prompt components and adds them to the totals.
+
+        Returns:
+            dict: The per-component token counts of this call (empty if accounting is disabled).
+        """
+        if not self.enabled:
+            return {}
+
+        call_counts = {"system": self.system_instruction_tokens}
+        for component_name in PROMPT_COMPONENTS:
+            if component_name != "content":
+                call_counts[component_name] = self._count_static(compiled_prompt.components.get(component_name, ""))
+
+        usage = getattr(response_obj, "usage_metadata", None)
+        prompt_token_count = getattr(usage, "prompt_token_count", 0) if usage is not None else 0
+        if prompt_token_count:
+            call_counts["content"] = max(0, prompt_token_count - sum(call_counts.values()))
+        else:
+            call_counts["content"] = len(compiled_prompt.components.get("content", "")) // 4 # Estimate when usage is unavailable
+        call_counts["output"] = getattr(usage, "candidates_token_count", 0) if usage is not None else 0
+
+        kind_totals = self.totals.setdefault(task_kind, {"calls": 0})
+        kind_totals["calls"] += 1
+        for component_name, count in call_counts.items():
+            kind_totals[component_name] = kind_totals.get(component_name, 0) + count
+        return call_counts
+
+    def input_tokens(self) -> int:
+        return sum(count for kind_totals in self.totals.values()
+                   for component_name, count in kind_totals.items() if component_name not in ("calls", "output"))
+
+    def output_tokens(self) -> int:
+        return sum(kind_totals.get("output", 0) for kind_totals in self.totals.values())
+
+    def summary(self) -> str:
+        """Returns a multi-line report of where the input tokens went."""
+        if not self.totals:
+            return "Token accounting: no calls recorded."
+        lines = ["Token accounting (input tokens by prompt component):"]
+        for task_kind, kind_totals in self.totals.items():
+            input_total = sum(count for name, count in kind_totals.items() if name not in ("calls", "output"))
+            shares = ", ".join(
+                f"{name}={kind_totals.get(name, 0)} ({kind_totals.get(name, 0) / input_total:.0%})" if input_total else f"{name}=0"
+                for name in ("system",) + PROMPT_COMPONENTS)
+            lines.append(f"  {task_kind}: {kind_totals['calls']} calls, {input_total} input tokens [{shares}], {kind_totals.get('output', 0)} output tokens")
+        lines.append(f"  Total: {self.input_tokens()} input tokens, {self.output_tokens()} output tokens")
+        return "\n".join(lines)
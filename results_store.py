@@ -0,0 +1,205 @@
+# results_store.py
+import os
+import json
+import sqlite3
+import hashlib
+import datetime
+
+# Columns of the Excel view, in order (the workbook layout written by save_results)
+EXCEL_COLUMNS = ["filename", "variable", "relevant_paragraphs_or_tables", "extracted_value", "confidence",
+                 "justification", "human_verified_response"]
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id TEXT PRIMARY KEY,
+    started_at TEXT NOT NULL,
+    finished_at TEXT,
+    status TEXT,
+    command TEXT,
+    model TEXT,
+    codebook_signature TEXT,
+    input_tokens INTEGER DEFAULT 0,
+    output_tokens INTEGER DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS documents (
+    run_id TEXT NOT NULL,
+    document_hash TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    input_tokens INTEGER DEFAULT 0,
+    output_tokens INTEGER DEFAULT 0,
+    completed_at TEXT NOT NULL,
+    PRIMARY KEY (run_id, document_hash)
+);
+CREATE TABLE IF NOT EXISTS results (
+    run_id TEXT NOT NULL,
+    document_hash TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    variable TEXT NOT NULL,
+    extracted_value TEXT,
+    confidence REAL,
+    indices TEXT,
+    justification TEXT,
+    relevant_paragraphs_or_tables TEXT,
+    model TEXT,
+    completed_at TEXT NOT NULL,
+    PRIMARY KEY (run_id, document_hash, variable)
+);
+CREATE INDEX IF NOT EXISTS results_by_variable ON results (variable);
+CREATE INDEX IF NOT EXISTS results_by_document ON results (document_hash, completed_at);
+"""
+
+
+def file_sha256(file_path: str) -> str:
+    """Content hash of a document, so results follow the document rather than its filename."""
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def new_run_id(prefix: str = "run") -> str:
+    return f"{prefix}-{datetime.datetime.now().strftime('%Y%m%d-%H%M%S-%f')}"
+
+
+def _now() -> str:
+    return datetime.datetime.now().isoformat(timespec="seconds")
+
+
+class ResultsStore:
+    """
+    An indexed SQLite database of extraction results across runs: one row per (run, document hash, variable),
+    plus per-run and per-document token usage. Writing a document again in the same run replaces its rows
+    (upsert), so a partial run can be completed without duplicates. The Excel view of any run, or of the latest
+    result of every document across runs, is rendered by rows().
+
+    SQLite locking is unreliable on network filesystems, so distributed workers keep writing shard files and the
+    'merge' command imports them here.
+    """
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        directory = os.path.dirname(db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.connection = sqlite3.connect(db_path)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.executescript(_SCHEMA)
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+    def start_run(self, run_id: str, command: str, model: str, codebook_signature: str):
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR IGNORE INTO runs (run_id, started_at, command, model, codebook_signature, status) VALUES (?, ?, ?, ?, ?, 'running')",
+                (run_id, _now(), command, model, codebook_signature))
+
+    def finish_run(self, run_id: str, status: str, input_tokens: int = 0, output_tokens: int = 0):
+        with self.connection:
+            self.connection.execute(
+                "UPDATE runs SET finished_at = ?, status = ?, input_tokens = ?, output_tokens = ? WHERE run_id = ?",
+                (_now(), status, input_tokens, output_tokens, run_id))
+
+    def upsert_document(self, run_id: str, document_hash: str, filename: str, rows: list[dict], model: str,
+                        input_tokens: int = 0, output_tokens: int = 0):
+        """Replaces a document's results in a run with rows (result rows as built by process_single_document)."""
+        completed_at = _now()
+        with self.connection:
+            self.connection.execute("DELETE FROM results WHERE run_id = ? AND document_hash = ?", (run_id, document_hash))
+            self.connection.execute(
+                "INSERT INTO documents (run_id, document_hash, filename, input_tokens, output_tokens, completed_at) VALUES (?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (run_id, document_hash) DO UPDATE SET filename = excluded.filename, input_tokens = excluded.input_tokens, "
+                "output_tokens = excluded.output_tokens, completed_at = excluded.completed_at",
+                (run_id, document_hash, filename, input_tokens, output_tokens, completed_at))
+            self.connection.executemany(
+                "INSERT INTO results (run_id, document_hash, filename, variable, extracted_value, confidence, indices, justification, "
+                "relevant_paragraphs_or_tables, model, completed_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (run_id, document_hash, variable) DO UPDATE SET extracted_value = excluded.extracted_value, "
+                "confidence = excluded.confidence, indices = excluded.indices, justification = excluded.justification, "
+                "relevant_paragraphs_or_tables = excluded.relevant_paragraphs_or_tables, model = excluded.model, completed_at = excluded.completed_at",
+                [(run_id, document_hash, filename, row["variable"],
+                  None if row.get("extracted_value") is None else str(row.get("extracted_value")),
+                  row.get("confidence"), json.dumps(row.get("indices", [])), row.get("justification", ""),
+                  row.get("relevant_paragraphs_or_tables", ""), model, completed_at)
+                 for row in rows])
+
+    def document_hashes(self, codebook_signature: str = None) -> set[str]:
+        """Content hashes of the documents completed in any run (only runs with codebook_signature, if given)."""
+        query = "SELECT DISTINCT d.document_hash FROM documents d JOIN runs r ON r.run_id = d.run_id"
+        parameters = ()
+        if codebook_signature is not None:
+            query += " WHERE r.codebook_signature = ?"
+            parameters = (codebook_signature,)
+        return {row["document_hash"] for row in self.connection.execute(query, parameters)}
+
+    def latest_run_id(self):
+        row = self.connection.execute("SELECT run_id FROM runs ORDER BY started_at DESC, rowid DESC LIMIT 1").fetchone()
+        return row["run_id"] if row else None
+
+    def runs(self) -> list[dict]:
+        return [dict(row) for row in self.connection.execute(
+            "SELECT r.*, COUNT(d.document_hash) AS documents FROM runs r LEFT JOIN documents d ON d.run_id = r.run_id "
+            "GROUP BY r.run_id ORDER BY r.started_at")]
+
+    def rows(self, run_id: str = None) -> list[dict]:
+        """
+        Returns results as Excel-view rows (EXCEL_COLUMNS plus run_id, document_hash, indices and model).
+
+        Args:
+            run_id (str, optional): The run to render. If None, the latest result of every document across all
+                                    runs (the rows of the most recent run that completed that document).
+        """
+        if run_id is not None:
+            query = "SELECT * FROM results WHERE run_id = ? ORDER BY filename, rowid"
+            parameters = (run_id,)
+        else:
+            query = (
+                "SELECT r.* FROM results r JOIN ("
+                "  SELECT document_hash, run_id FROM ("
+                "    SELECT document_hash, run_id, ROW_NUMBER() OVER (PARTITION BY document_hash ORDER BY completed_at DESC, rowid DESC) AS rank"
+                "    FROM documents) WHERE rank = 1"
+                ") latest ON latest.document_hash = r.document_hash AND latest.run_id = r.run_id ORDER BY r.filename, r.rowid")
+            parameters = ()
+        rows = []
+        for record in self.connection.execute(query, parameters):
+            rows.append({
+                "filename": record["filename"],
+                "variable": record["variable"],
+                "relevant_paragraphs_or_tables": record["relevant_paragraphs_or_tables"],
+                "extracted_value": record["extracted_value"],
+                "confidence": record["confidence"],
+                "justification": record["justification"],
+                "human_verified_response": "",
+                "run_id": record["run_id"],
+                "document_hash": record["document_hash"],
+                "indices": json.loads(record["indices"] or "[]"),
+                "model": record["model"],
+            })
+        return rows
+
+    def export_parquet(self, parquet_dir: str, run_id: str = None) -> int:
+        """
+        Writes results to Parquet partitioned by run_id (requires pyarrow). Each exported run's partition is
+        replaced. Returns the number of rows written.
+        """
+        import shutil
+        import pandas as pd
+        try:
+            import pyarrow # noqa: F401 (needed by DataFrame.to_parquet)
+        except ImportError as e:
+            raise RuntimeError("Parquet export requires pyarrow (pip install pyarrow).") from e
+        if run_id is None:
+            query, parameters = "SELECT * FROM results", ()
+        else:
+            query, parameters = "SELECT * FROM results WHERE run_id = ?", (run_id,)
+        df = pd.read_sql_query(query, self.connection, params=parameters)
+        if df.empty:
+            return 0
+        for exported_run_id in df["run_id"].unique():
+            partition_dir = os.path.join(parquet_dir, f"run_id={exported_run_id}")
+            if os.path.isdir(partition_dir):
+                shutil.rmtree(partition_dir)
+        df.to_parquet(parquet_dir, partition_cols=["run_id"], index=False)
+        return len(df)
@@ -0,0 +1,269 @@
+# run_planner.py
+import heapq
+import threading
+from evidence_selection import estimate_tokens
+
+
+def estimate_cost(input_tokens: int, output_tokens: int, input_price_per_1m: float, output_price_per_1m: float) -> float:
+    """Cost of a number of tokens at per-million-token prices."""
+    return input_tokens / 1_000_000 * input_price_per_1m + output_tokens / 1_000_000 * output_price_per_1m
+
+
+class RunPlanner:
+    """
+    Dry-run estimates for a corpus. Classification prompts are built exactly as a real run builds them and
+    their tokens counted; extraction prompts cannot be known before classification, so each tag with target
+    variables is assumed to get one call whose evidence is a share of the document's content, capped at the
+    per-call evidence budget. Output tokens and call latency come from configurable rates. Dedup hits are
+    not anticipated, so estimates are an upper bound for corpora with repeated boilerplate.
+
+    Merged extraction calls depend on how much the tags' evidence overlaps, which is only known after
+    classification. The totals therefore keep one call per tag; with merging enabled, each document plan also
+    gets the best case (every tag's evidence overlapping fully, so tags share calls up to merge_max_variables
+    and the evidence is sent once per call), and the report shows both.
+    """
+
+    def __init__(self, prompt_compiler, count_tokens_fn, system_instruction: str, tag_labels: list[str],
+                 evidence_token_budget: int, evidence_share_per_tag: float,
+                 classification_output_tokens_per_piece: int, extraction_output_tokens_per_variable: int,
+                 call_overhead_seconds: float, output_tokens_per_second: float,
+                 input_price_per_1m: float, output_price_per_1m: float, merge_extraction_calls: bool = False,
+                 merge_max_variables: int = 0):
+        """
+        Args:
+            prompt_compiler (PromptCompiler): Builds the prompts a real run would send.
+            count_tokens_fn (callable): Returns the token count of a string (the model's counter, or estimate_tokens).
+            system_instruction (str): The model's system instruction, billed with every prompt.
+            tag_labels (list[str]): Paragraph tags (PARAGRAPH_TAG_DESCRIPTIONS keys); one extraction call each.
+            evidence_token_budget (int): EVIDENCE_TOKEN_BUDGET_PER_CALL (0 = uncapped).
+            evidence_share_per_tag (float): Assumed fraction of a document's content selected as evidence per tag.
+            classification_output_tokens_per_piece (int): Output tokens per classified content piece.
+            extraction_output_tokens_per_variable (int): Output tokens per extracted variable.
+            call_overhead_seconds (float): Fixed latency per call (queueing, prefill, network).
+            output_tokens_per_second (float): Generation speed used for the output part of call latency.
+            input_price_per_1m (float): Price per million input tokens.
+            output_price_per_1m (float): Price per million output tokens.
+            merge_extraction_calls (bool): Also estimate the best case of merged extraction calls (MERGE_EXTRACTION_CALLS).
+            merge_max_variables (int): Maximum target variables per merged call (0 = no limit).
+        """
+        self.prompt_compiler = prompt_compiler
+        self.count_tokens_fn = count_tokens_fn
+        self.tag_labels = list(tag_labels)
+        self.evidence_token_budget = evidence_token_budget
+        self.evidence_share_per_tag = evidence_share_per_tag
+        self.classification_output_tokens_per_piece = classification_output_tokens_per_piece
+        self.extraction_output_tokens_per_variable = extraction_output_tokens_per_variable
+        self.call_overhead_seconds = call_overhead_seconds
+        self.output_tokens_per_second = output_tokens_per_second
+        self.input_price_per_1m = input_price_per_1m
+        self.output_price_per_1m = output_price_per_1m
+        self.merge_extraction_calls = merge_extraction_calls
+        self.merge_max_variables = merge_max_variables
+        self._static_counts = {} # {text: token count} for prompt components that repeat across calls
+        self.system_instruction_tokens = self._count_static(system_instruction) if system_instruction else 0
+        self.document_plans = []
+
+    def _count_static(self, text: str) -> int:
+        if text not in self._static_counts:
+            self._static_counts[text] = int(self.count_tokens_fn(text))
+        return self._static_counts[text]
+
+    def _prompt_tokens(self, compiled_prompt) -> int:
+        components = compiled_prompt.components
+        static_tokens = sum(self._count_static(text) for name, text in components.items() if name != "content")
+        return self.system_instruction_tokens + static_tokens + int(self.count_tokens_fn(components.get("content", "")))
+
+    def _call_seconds(self, output_tokens: int) -> float:
+        return self.call_overhead_seconds + output_tokens / max(self.output_tokens_per_second, 1e-9)
+
+    def plan_document(self, parsed_document, whole_document: bool = False) -> dict:
+        """
+        Estimates the calls, tokens, cost and sequential processing time of one parsed document.
+
+        Args:
+            parsed_document (ParsedDocument): The parsed and sectioned document.
+            whole_document (bool): Plan one whole-document classification call instead of one call per section.
+
+        Returns:
+            dict: {"filename", "content_pieces", "classification_calls", "extraction_calls", "input_tokens",
+                   "output_tokens", "cost", "seconds"}, plus, with merge_extraction_calls, the best case of merged
+                   extraction calls: "merged_extraction_calls" and "merged_extraction_input_tokens" (compared with
+                   "extraction_input_tokens" of one call per tag).
+        """
+        content_store = parsed_document.content_store
+        plan = {"filename": parsed_document.file_path, "content_pieces": len(content_store),
+                "classification_calls": 0, "extraction_calls": 0, "input_tokens": 0, "output_tokens": 0, "seconds": 0.0,
+                "extraction_input_tokens": 0}
+
+        # Classification: the exact prompts of a real run, one call per section (or per document)
+        section_payloads = []
+        for heading, start_idx, end_idx in parsed_document.sections:
+            payload_paragraphs = {str(global_idx): content_store[global_idx] for global_idx in range(start_idx, end_idx)
+                                  if content_store[global_idx] and not content_store[global_idx].isspace()}
+            if payload_paragraphs:
+                section_payloads.append((heading, payload_paragraphs))
+        if whole_document and section_payloads:
+            classification_calls = [(self.prompt_compiler.document_classification_prompt(section_payloads),
+                                     sum(len(payload_paragraphs) for _heading, payload_paragraphs in section_payloads))]
+        else:
+            classification_calls = [(self.prompt_compiler.classification_prompt(heading, payload_paragraphs), len(payload_paragraphs))
+                                    for heading, payload_paragraphs in section_payloads]
+        for compiled_prompt, piece_count in classification_calls:
+            output_tokens = piece_count * self.classification_output_tokens_per_piece
+            plan["classification_calls"] += 1
+            plan["input_tokens"] += self._prompt_tokens(compiled_prompt)
+            plan["output_tokens"] += output_tokens
+            plan["seconds"] += self._call_seconds(output_tokens)
+
+        # Extraction: one call per tag with target variables, with an assumed evidence payload
+        document_content_tokens = sum(estimate_tokens(content_string) for content_string in content_store)
+        evidence_tokens = int(document_content_tokens * self.evidence_share_per_tag)
+        if self.evidence_token_budget > 0:
+            evidence_tokens = min(evidence_tokens, self.evidence_token_budget)
+        tag_target_variables = []
+        if plan["classification_calls"]:
+            for tag_label in self.tag_labels:
+                target_vars = self.prompt_compiler.target_variables_for_tag(tag_label)
+                if not target_vars:
+                    continue
+                tag_target_variables.append(target_vars)
+                output_tokens = len(target_vars) * self.extraction_output_tokens_per_variable
+                input_tokens = self._prompt_tokens(self.prompt_compiler.extraction_prompt(target_vars, {})) + evidence_tokens
+                plan["extraction_calls"] += 1
+                plan["extraction_input_tokens"] += input_tokens
+                plan["input_tokens"] += input_tokens
+                plan["output_tokens"] += output_tokens
+                plan["seconds"] += self._call_seconds(output_tokens)
+
+        if self.merge_extraction_calls:
+            merged_calls = self._merged_target_variables(tag_target_variables)
+            plan["merged_extraction_calls"] = len(merged_calls)
+            plan["merged_extraction_input_tokens"] = sum(
+                self._prompt_tokens(self.prompt_compiler.extraction_prompt(target_vars, {})) + evidence_tokens
+                for target_vars in merged_calls)
+
+        plan["cost"] = estimate_cost(plan["input_tokens"], plan["output_tokens"], self.input_price_per_1m, self.output_price_per_1m)
+        self.document_plans.append(plan)
+        return plan
+
+    def _merged_target_variables(self, tag_target_variables: list[dict]) -> list[dict]:
+        """
+        Best case of merged extraction calls: with fully overlapping evidence, tags (in order) share a call until
+        its target variables would exceed merge_max_variables, as plan_extraction_groups would group them.
+        """
+        merged_calls = []
+        for target_vars in tag_target_variables:
+            if merged_calls and (self.merge_max_variables <= 0
+                                 or len(set(merged_calls[-1]) | set(target_vars)) <= self.merge_max_variables):
+                merged_calls[-1].update(target_vars)
+            else:
+                merged_calls.append(dict(target_vars))
+        return merged_calls
+
+    @staticmethod
+    def wall_clock_seconds(document_seconds: list[float], concurrency: int) -> float:
+        """Simulates concurrency workers each claiming the next document when free (as the 'worker' command does)."""
+        worker_free_at = [0.0] * max(1, concurrency)
+        for seconds in document_seconds:
+            heapq.heappush(worker_free_at, heapq.heappop(worker_free_at) + seconds)
+        return max(worker_free_at)
+
+    def report(self, concurrency_levels: list[int], requests_per_minute: int = 0, tokens_per_minute: int = 0,
+               currency: str = "USD") -> str:
+        """
+        Returns the totals and the estimated wall-clock time at each concurrency level. If quotas are given,
+        the time is at least what the quota allows (total calls / requests_per_minute, total tokens / tokens_per_minute).
+        """
+        plans = self.document_plans
+        total_calls = sum(plan["classification_calls"] + plan["extraction_calls"] for plan in plans)
+        total_input = sum(plan["input_tokens"] for plan in plans)
+        total_output = sum(plan["output_tokens"] for plan in plans)
+        total_cost = sum(plan["cost"] for plan in plans)
+        lines = [
+            f"Plan for {len(plans)} documents:",
+            f"  Calls: {total_calls} ({sum(plan['classification_calls'] for plan in plans)} classification, "
+            f"{sum(plan['extraction_calls'] for plan in plans)} extraction)",
+            f"  Tokens: {total_input} input, ~{total_output} output",
+            f"  Cost: ~{total_cost:.2f} {currency}",
+        ]
+        document_seconds = [plan["seconds"] for plan in plans]
+        for concurrency in concurrency_levels:
+            seconds = self.wall_clock_seconds(document_seconds, concurrency)
+            limit_note = ""
+            if requests_per_minute > 0 and total_calls / requests_per_minute * 60 > seconds:
+                seconds = total_calls / requests_per_minute * 60
+                limit_note = " (limited by requests-per-minute quota)"
+            if tokens_per_minute > 0 and (total_input + total_output) / tokens_per_minute * 60 > seconds:
+                seconds = (total_input + total_output) / tokens_per_minute * 60
+                limit_note = " (limited by tokens-per-minute quota)"
+            lines.append(f"  Time at concurrency {concurrency}: ~{seconds / 60:.1f} minutes{limit_note}")
+        if self.merge_extraction_calls:
+            extraction_calls = sum(plan["extraction_calls"] for plan in plans)
+            merged_calls = sum(plan.get("merged_extraction_calls", 0) for plan in plans)
+            saved_input = sum(plan["extraction_input_tokens"] - plan.get("merged_extraction_input_tokens", 0) for plan in plans)
+            saved_cost = estimate_cost(saved_input, 0, self.input_price_per_1m, self.output_price_per_1m)
+            lines.append(f"  Extraction totals above assume one call per tag. With merged extraction calls, as few as "
+                         f"{merged_calls} of the {extraction_calls} extraction calls (~{saved_input} input tokens, "
+                         f"~{saved_cost:.2f} {currency} less) if the tags' evidence overlaps fully; the actual saving "
+                         f"depends on the overlap found after classification.")
+        return "\n".join(lines)
+
+
+class RunBudget:
+    """
+    Tracks the tokens and cost actually spent in a run (from response usage metadata) against optional limits.
+    Output tokens include any thinking tokens (total minus prompt tokens), since those are billed as output.
+    Discarded responses (hedge losers, calls abandoned at their deadline that completed later) are billed too,
+    so they count against the limits; they are reported separately and may arrive from other threads.
+    """
+
+    def __init__(self, token_budget: int = 0, cost_budget: float = 0, input_price_per_1m: float = 0,
+                 output_price_per_1m: float = 0, currency: str = "USD"):
+        """
+        Args:
+            token_budget (int): Maximum input + output tokens for the run (0 = no limit).
+            cost_budget (float): Maximum cost for the run (0 = no limit).
+            input_price_per_1m (float): Price per million input tokens.
+            output_price_per_1m (float): Price per million output tokens.
+            currency (str): Currency label for messages.
+        """
+        self.token_budget = token_budget
+        self.cost_budget = cost_budget
+        self.input_price_per_1m = input_price_per_1m
+        self.output_price_per_1m = output_price_per_1m
+        self.currency = currency
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self.discarded_tokens = 0 # Part of input_tokens + output_tokens spent on responses that were not used
+        self._lock = threading.Lock()
+
+    def add_usage(self, response_obj, discarded: bool = False):
+        """Adds a response's usage; discarded marks a response that was billed but not used (see HedgedCaller)."""
+        usage = getattr(response_obj, "usage_metadata", None)
+        if usage is None:
+            return
+        prompt_tokens = getattr(usage, "prompt_token_count", 0) or 0
+        total_tokens = getattr(usage, "total_token_count", 0) or 0
+        output_tokens = max(total_tokens - prompt_tokens, getattr(usage, "candidates_token_count", 0) or 0)
+        with self._lock:
+            self.input_tokens += prompt_tokens
+            self.output_tokens += output_tokens
+            if discarded:
+                self.discarded_tokens += prompt_tokens + output_tokens
+
+    def spent_cost(self) -> float:
+        return estimate_cost(self.input_tokens, self.output_tokens, self.input_price_per_1m, self.output_price_per_1m)
+
+    def exhausted(self):
+        """Returns a message if a limit has been reached, otherwise None."""
+        spent_tokens = self.input_tokens + self.output_tokens
+        if self.token_budget > 0 and spent_tokens >= self.token_budget:
+            return f"Token budget reached ({spent_tokens} of {self.token_budget} tokens)."
+        if self.cost_budget > 0 and self.spent_cost() >= self.cost_budget:
+            return f"Cost budget reached (~{self.spent_cost():.2f} of {self.cost_budget:.2f} {self.currency})."
+        return None
+
+    def summary(self) -> str:
+        discarded_note = f" (including {self.discarded_tokens} tokens of discarded hedged or late responses)" if self.discarded_tokens else ""
+        return (f"Spend: {self.input_tokens} input + {self.output_tokens} output tokens{discarded_note}, "
+                f"~{self.spent_cost():.2f} {self.currency}.")
@@ -1,7 +1,35 @@
 import unittest
+import csv
+import json
+import random
+import tempfile
+import threading
+import time
+from concurrent.futures import Future
+from types import SimpleNamespace
+from unittest import mock
 import docx
+import openpyxl
+from google.api_core import exceptions as google_exceptions
+import ai_data_extractor
 from ai_data_extractor import process_document, ParagraphClassifierClient
+from ai_data_extractor import split_classifications_by_section, whole_document_fallback_reason, classify_document_sections
 from config import *
+from call_policy import HedgedCaller, CallDeadlineExceeded
+from content_store import DocumentContentStore
+from dead_letter import DeadLetterQueue, DocumentProcessingError, StageFailure
+from dedup_index import ContentDedupIndex
+from document_watcher import DocumentWatcher
+from docx_parser import parse_document, detect_structural_headings, balance_sections, ParsePrefetcher
+from endpoint_pool import EndpointPool, ModelEndpoint
+from evidence_selection import select_evidence
+from extraction_planner import plan_extraction_groups
+from output_writer import StreamingResultsWriter, _excel_safe, EXCEL_MAX_CELL_CHARACTERS
+from profiling import StageProfiler
+from prompt_compiler import PromptCompiler, TokenLedger, CLASSIFICATION_INSTRUCTIONS, EXTRACTION_INSTRUCTIONS
+from results_store import ResultsStore, file_sha256
+from run_planner import RunPlanner, RunBudget
+from work_queue import FileLeaseQueue, append_shard_rows
 
 @unittest.skip("temp removal")
 class TestClassifySection(unittest.TestCase):
@@ -55,7 +83,7 @@ class TestProcessDocument(unittest.TestCase):
 
     def test_process_document(self):
         # Process the test document
-        classified_paragraphs_data = process_document(self.test_doc_path, self.par_classifier_client)
+        classified_paragraphs_data, content_store, _content_pieces = process_document(self.test_doc_path, self.par_classifier_client)
         print(f"Classified paragraphs data: {classified_paragraphs_data}")
 
         # Assertions
@@ -68,11 +96,11 @@ class TestProcessDocument(unittest.TestCase):
             assert tag in TARGET_VARIABLES or tag in CLUSTER_TARGET_VARIABLES, f"Invalid tag: {tag}"
             for heading, paragraphs in heading_data.items():
                 assert isinstance(heading, str), f"Heading should be a string: {heading}"
-                for confidence, index, text in paragraphs:
+                for confidence, index in paragraphs:
                     assert isinstance(confidence, float), f"Confidence should be a float: {confidence} (tag: {tag}, heading: {heading})"
                     assert 0 <= confidence <= 1, f"Confidence should be between 0 and 1: {confidence} (tag: {tag}, heading: {heading})"
                     assert isinstance(index, int), f"Index should be an integer: {index} (tag: {tag}, heading: {heading})"
-                    assert isinstance(text, str), f"Text should be a string: {text} (tag: {tag}, heading: {heading})"
+                    assert isinstance(content_store[index], str), f"Content at index {index} should be a string (tag: {tag}, heading: {heading})"
 
 class TestExtractTargetVariables(unittest.TestCase):
     @classmethod
@@ -82,15 +110,15 @@ class TestExtractTargetVariables(unittest.TestCase):
 
     def test_extract_target_variables(self):
         # Get classified paragraphs data (using the same document as TestProcessDocument)
-        classified_data_dict, indexed_content_strings, document_content_pieces = process_document(self.test_doc_path, self.par_classifier_client)
+        classified_data_dict, content_store, document_content_pieces = process_document(self.test_doc_path, self.par_classifier_client)
         
         # If process_document could have failed and returned, e.g., (None, None, None) or just ({}, [], [])
         # you might want to check if classified_data_dict is actually a dict here before proceeding.
-        # For example, if not classified_data_dict and not indexed_content_strings:
+        # For example, if not classified_data_dict and not content_store:
         #    self.fail("process_document did not return valid data, possibly due to file error seen earlier.")
 
         # Extract target variables using the first element of the tuple
-        extracted_results = self.par_classifier_client.extract_target_variables(classified_data_dict)
+        extracted_results = self.par_classifier_client.extract_target_variables(classified_data_dict, content_store)
 
         # Assertions
         self.assertIsNotNone(extracted_results)
@@ -107,3 +135,950 @@ class TestExtractTargetVariables(unittest.TestCase):
             self.assertIsInstance(extraction_info["indices"], list)
             for idx in extraction_info["indices"]:
                 self.assertIsInstance(idx, int)
+
+
+class TestContentDedupIndex(unittest.TestCase):
+    def setUp(self):
+        self.index = ContentDedupIndex(os.path.join("cache", "test_dedup_index.json"), "test-signature")
+        self.funding_statement = ("This work was supported by the National Science Foundation under grant number 12345. "
+                                  "Any opinions, findings, and conclusions are those of the authors and do not necessarily "
+                                  "reflect the views of the foundation.")
+
+    def test_near_duplicate_of_boilerplate_is_skipped(self):
+        self.assertIsNone(self.index.lookup(self.funding_statement, "paper_a.docx"))
+        self.index.record(self.funding_statement, [], "paper_a.docx")
+
+        near_duplicate = self.funding_statement.replace("12345", "67890")
+        self.assertEqual(self.index.lookup(near_duplicate, "paper_b.docx"), [])
+        self.assertEqual(self.index.document_stats["paper_b.docx"]["near"], 1)
+        self.assertEqual(self.index.document_stats["paper_b.docx"]["irrelevant"], 1)
+
+    def test_near_duplicate_of_relevant_piece_is_classified_again(self):
+        sample = ("A total of 40 children aged 6 to 8 years took part in the study, recruited from four primary "
+                  "schools in the region between March and June of the school year.")
+        self.index.record(sample, [["demographic_info", 0.9]], "paper_a.docx")
+        self.assertEqual(self.index.lookup(sample, "paper_b.docx"), [["demographic_info", 0.9]]) # Exact duplicate
+
+        other_sample = sample.replace("40 children", "52 children")
+        self.assertIsNone(self.index.lookup(other_sample, "paper_c.docx"))
+        self.index.record(other_sample, [["demographic_info", 0.8]], "paper_c.docx")
+        self.assertEqual(self.index.lookup(other_sample, "paper_d.docx"), [["demographic_info", 0.8]])
+
+    def test_short_pieces_are_not_indexed(self):
+        self.index.record("Table 1", [["demographic_info", 0.9]], "paper_a.docx")
+        self.assertIsNone(self.index.lookup("Table 1", "paper_b.docx"))
+
+    def test_concurrent_saves_keep_every_entry(self):
+        filepath = os.path.join(tempfile.mkdtemp(), "dedup_index.json")
+        worker_indexes = []
+        for worker in range(4):
+            index = ContentDedupIndex(filepath, "test-signature")
+            for piece in range(10):
+                index.record(self.distinct_piece(f"w{worker}p{piece}"), [], f"paper_{worker}.docx")
+            worker_indexes.append(index)
+        threads = [threading.Thread(target=index.save) for index in worker_indexes]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(ContentDedupIndex.load(filepath, "test-signature", quiet=True).entries), 40)
+        self.assertFalse(os.path.exists(filepath + ".lock"))
+
+    def distinct_piece(self, name):
+        return " ".join(f"{name}x{i}" for i in range(20)) # Unrelated to every other piece
+
+    def line_count(self, filepath):
+        with open(filepath, encoding="utf-8") as f:
+            return len(f.readlines())
+
+    def test_save_appends_only_new_entries(self):
+        filepath = os.path.join(tempfile.mkdtemp(), "dedup_index.jsonl")
+        worker_a = ContentDedupIndex.load(filepath, "test-signature", quiet=True)
+        worker_b = ContentDedupIndex.load(filepath, "test-signature", quiet=True)
+        worker_a.record(self.distinct_piece("a1"), [], "paper_a.docx")
+        worker_a.save()
+        worker_a.save() # Nothing new to append
+        self.assertEqual(self.line_count(filepath), 2) # Header and one entry
+        worker_b.record(self.distinct_piece("b1"), [["demographic_info", 0.9]], "paper_b.docx")
+        worker_b.save()
+        self.assertEqual(len(worker_b.entries), 2) # worker_a's entry was read while saving
+        worker_a.record(self.distinct_piece("a1"), [], "paper_c.docx") # Already indexed: not appended again
+        worker_a.save()
+        self.assertEqual(self.line_count(filepath), 3)
+        self.assertEqual(len(ContentDedupIndex.load(filepath, "test-signature", quiet=True).entries), 2)
+
+    def test_compaction_drops_duplicates_and_is_followed_by_other_workers(self):
+        filepath = os.path.join(tempfile.mkdtemp(), "dedup_index.jsonl")
+        worker_a = ContentDedupIndex.load(filepath, "test-signature", quiet=True)
+        worker_b = ContentDedupIndex.load(filepath, "test-signature", quiet=True)
+        for worker in (worker_a, worker_b): # Both classified the same piece before either saved
+            worker.record(self.distinct_piece("shared"), [], "paper_a.docx")
+            worker.save()
+        self.assertEqual(self.line_count(filepath), 3)
+        worker_a.compact()
+        self.assertEqual(self.line_count(filepath), 2)
+        worker_b.record(self.distinct_piece("b1"), [], "paper_b.docx")
+        worker_b.save() # The file was replaced by the compaction; worker_b rereads it instead of using a stale offset
+        self.assertEqual(self.line_count(filepath), 3)
+        self.assertEqual(len(ContentDedupIndex.load(filepath, "test-signature", quiet=True).entries), 2)
+
+    def test_index_for_another_codebook_is_replaced(self):
+        filepath = os.path.join(tempfile.mkdtemp(), "dedup_index.jsonl")
+        old_index = ContentDedupIndex(filepath, "old-signature")
+        old_index.record(self.distinct_piece("old"), [], "paper_a.docx")
+        old_index.save()
+        new_index = ContentDedupIndex.load(filepath, "test-signature", quiet=True)
+        self.assertEqual(new_index.entries, [])
+        new_index.record(self.distinct_piece("new"), [], "paper_b.docx")
+        new_index.save()
+        self.assertEqual(self.line_count(filepath), 2)
+        self.assertEqual(len(ContentDedupIndex.load(filepath, "test-signature", quiet=True).entries), 1)
+
+    def test_stale_save_lock_is_broken(self):
+        filepath = os.path.join(tempfile.mkdtemp(), "dedup_index.json")
+        with open(filepath + ".lock", "w"):
+            pass
+        os.utime(filepath + ".lock", (time.time() - 3600, time.time() - 3600))
+        self.index.filepath = filepath
+        self.index.record(self.funding_statement, [], "paper_a.docx")
+        self.index.save()
+        self.assertEqual(len(ContentDedupIndex.load(filepath, "test-signature", quiet=True).entries), 1)
+
+
+class TestSelectEvidence(unittest.TestCase):
+    def setUp(self):
+        self.content_store = DocumentContentStore()
+        for i in range(6):
+            self.content_store.append("x" * 400, "paragraph", "Normal") # ~100 estimated tokens each
+        # One piece above the threshold, five below it, all in one section
+        self.headings_map = {"Methods": [(0.9, 0)] + [(0.3, global_idx) for global_idx in range(1, 6)]}
+
+    def selected_indices(self, selected_headings_map):
+        return [global_idx for pieces in selected_headings_map.values() for _confidence, global_idx in pieces]
+
+    def test_threshold_prunes_low_confidence_pieces(self):
+        selected, stats = select_evidence(self.headings_map, self.content_store, 0.5, 0, context_window=0)
+        self.assertEqual(self.selected_indices(selected), [0])
+        self.assertEqual(stats["below_threshold"], 5)
+
+    def test_context_does_not_chain_past_the_window(self):
+        selected, stats = select_evidence(self.headings_map, self.content_store, 0.5, 0, context_window=1)
+        self.assertEqual(self.selected_indices(selected), [0, 1])
+        self.assertEqual(stats["context_added"], 1)
+
+    def test_budget_caps_selected_tokens(self):
+        headings_map = {"Methods": [(0.9, global_idx) for global_idx in range(6)]}
+        selected, stats = select_evidence(headings_map, self.content_store, 0.5, 250, context_window=0)
+        self.assertEqual(len(self.selected_indices(selected)), 2)
+        self.assertEqual(stats["over_budget"], 4)
+        self.assertLessEqual(stats["selected_tokens"], 250)
+
+    def test_min_pieces_kept_regardless_of_threshold_and_budget(self):
+        selected, _stats = select_evidence(self.headings_map, self.content_store, 0.95, 10, context_window=0, min_pieces=2)
+        self.assertEqual(self.selected_indices(selected), [0, 1])
+
+
+class TestFileLeaseQueue(unittest.TestCase):
+    def setUp(self):
+        self.queue_dir = tempfile.mkdtemp()
+        self.worker_a = FileLeaseQueue(self.queue_dir, "worker_a", lease_ttl_seconds=2, heartbeat_interval_seconds=1)
+        self.worker_b = FileLeaseQueue(self.queue_dir, "worker_b", lease_ttl_seconds=2, heartbeat_interval_seconds=1)
+
+    def test_leased_document_is_not_claimed_twice(self):
+        self.assertEqual(self.worker_a.claim_next(["paper_a.docx"]), "paper_a.docx")
+        self.assertIsNone(self.worker_b.claim_next(["paper_a.docx"]))
+        self.worker_a.complete("paper_a.docx")
+        self.assertIsNone(self.worker_b.claim_next(["paper_a.docx"]))
+        self.assertFalse(self.worker_b.has_pending(["paper_a.docx"]))
+
+    def test_expired_lease_is_taken_over(self):
+        self.assertTrue(self.worker_a.try_claim("paper_a.docx"))
+        expired = time.time() - 10
+        os.utime(os.path.join(self.queue_dir, "leases", "paper_a.docx.lease"), (expired, expired))
+        self.assertTrue(self.worker_b.try_claim("paper_a.docx"))
+
+
+class TestSectionSkipRules(unittest.TestCase):
+    def setUp(self):
+        document = docx.Document()
+        for text, style in [("Methods", "Heading 1"), ("Twelve children took part.", None),
+                            ("Acknowledgements", "Heading 2"), ("We thank our funders.", None),
+                            ("Results", "Heading 2"), ("Scores improved.", None),
+                            ("7. Bibliography", "Heading 1"), ("Smith, J. (2020). A paper.", None)]:
+            document.add_paragraph(text, style=style)
+        self.doc_path = os.path.join(tempfile.mkdtemp(), "skip_rules.docx")
+        document.save(self.doc_path)
+
+    def test_skip_and_stop_rules(self):
+        parsed_document = parse_document(self.doc_path, SECTION_SKIP_RULES)
+        self.assertEqual(list(parsed_document.content_store), ["Twelve children took part.", "Scores improved."])
+        self.assertEqual([heading for heading, _start, _end in parsed_document.sections], ["Methods", "Results"])
+        self.assertEqual([(entry["rule"], entry["pieces"]) for entry in parsed_document.skipped],
+                         [("acknowledgements", 1), ("references", 1)])
+
+    def test_default_rules_only_stop_at_heading_2_references(self):
+        parsed_document = parse_document(self.doc_path)
+        self.assertEqual(len(parsed_document.content_store), 4)
+        self.assertEqual(parsed_document.skipped, [])
+
+
+class TestFallbackSegmentation(unittest.TestCase):
+    def test_headings_detected_without_styles(self):
+        body = "Children used the tutoring robot at home for four weeks while parents kept a diary of sessions."
+        raw_pieces = [{"type": "paragraph", "content": text, "style": "Normal", "bold": bold, "font_size": size}
+                      for text, bold, size in [("Abstract", False, 11), (body * 2, False, 11), ("2.1 Sample", False, 11),
+                                               (body * 2, False, 11), ("Effects on Reading", False, 14),
+                                               ("Sample characteristics", True, 11), ("Table 1.", True, 11)]]
+        self.assertEqual(detect_structural_headings(raw_pieces), 4)
+        self.assertEqual([piece["style"] for piece in raw_pieces],
+                         ["Heading 1", "Normal", "Heading 2", "Normal", "Heading 1", "Heading 2", "Normal"])
+
+    def test_oversized_section_split_into_balanced_chunks(self):
+        content_store = DocumentContentStore()
+        for i in range(10):
+            content_store.append("word " * 100, "paragraph", "Normal")
+        sections, section_parts = balance_sections([("Default Heading (Document Start)", 0, 10)], content_store, max_pieces=4)
+        self.assertEqual([end - start for _heading, start, end in sections], [3, 4, 3])
+        self.assertEqual({heading for heading, _start, _end in sections}, {"Default Heading (Document Start)"})
+        self.assertEqual(section_parts, [(1, 3), (2, 3), (3, 3)])
+        self.assertEqual(balance_sections([("Methods", 0, 10)], content_store, max_tokens=10000), ([("Methods", 0, 10)], [(1, 1)]))
+
+    def test_styled_sections_split_only_over_output_limit(self):
+        doc = docx.Document()
+        doc.add_paragraph("Methods", style="Heading 1")
+        for i in range(10):
+            doc.add_paragraph(f"Participant group {i} completed the reading assessment twice. " * 3)
+        with tempfile.TemporaryDirectory() as temp_dir:
+            file_path = os.path.join(temp_dir, "styled.docx")
+            doc.save(file_path)
+            parsed_document = parse_document(file_path, max_section_pieces=4, max_section_tokens=50)
+            self.assertEqual(parsed_document.sections, [("Methods", 0, 10)])
+            self.assertEqual(parsed_document.section_parts, [(1, 1)])
+            parsed_document = parse_document(file_path, max_section_pieces=4, max_styled_section_pieces=6)
+            self.assertEqual([heading for heading, _start, _end in parsed_document.sections], ["Methods", "Methods"])
+            self.assertEqual(parsed_document.section_parts, [(1, 2), (2, 2)])
+
+
+class TestDocumentContentStore(unittest.TestCase):
+    def test_pieces_read_from_one_buffer(self):
+        content_store = DocumentContentStore()
+        self.assertEqual(content_store.append("First paragraph.", "paragraph", "Normal"), 0)
+        self.assertEqual(content_store.append("| a | b |", "table_markdown", "Table"), 1)
+        self.assertEqual(content_store[1], "| a | b |")
+        content_store.append("Third.", "paragraph", "Normal") # Appended after the buffer was joined
+        self.assertEqual(list(content_store), ["First paragraph.", "| a | b |", "Third."])
+        self.assertEqual((len(content_store), content_store.total_characters()), (3, 31))
+        self.assertEqual(content_store.piece_type(1), "table_markdown")
+
+    def test_parsed_document_holds_text_once(self):
+        file_path = os.path.join(tempfile.mkdtemp(), "paper.docx")
+        document = docx.Document()
+        document.add_paragraph("Methods", style="Heading 1")
+        for i in range(3):
+            document.add_paragraph(f"Paragraph {i} of the methods section.")
+        document.save(file_path)
+        content_store = parse_document(file_path).content_store
+        self.assertEqual(content_store._pending_parts, []) # Joined into the buffer by the parser
+        self.assertEqual(content_store._buffer, "".join(f"Paragraph {i} of the methods section." for i in range(3)))
+
+
+class TestExtractionPlanner(unittest.TestCase):
+    def setUp(self):
+        methods = {"Methods": {"3": "Participants were 40 children aged 5 to 7. " * 5, "4": "A randomised controlled design was used. " * 5}}
+        self.tag_requests = [
+            ("demographic_info", {"n": "Sample size", "age": "Mean age"}, methods),
+            ("research_study_classification", {"design": "Study design"}, {"Methods": {"4": methods["Methods"]["4"]}}),
+            ("intervention_outcomes", {"outcome": "Outcome"}, {"Results": {"9": "Reading scores improved. " * 5}}),
+        ]
+
+    def test_overlapping_tags_share_a_call_and_evidence_is_sent_once(self):
+        groups = plan_extraction_groups(self.tag_requests, min_overlap=0.3)
+        self.assertEqual([group.tag_labels for group in groups],
+                         [["demographic_info", "research_study_classification"], ["intervention_outcomes"]])
+        self.assertEqual(set(groups[0].target_variables), {"n", "age", "design"})
+        self.assertEqual(list(groups[0].ordered_payload()["Methods"]), ["3", "4"])
+        self.assertLess(groups[0].evidence_tokens, groups[0].separate_evidence_tokens)
+
+    def test_limits_keep_tags_apart(self):
+        self.assertEqual(len(plan_extraction_groups(self.tag_requests, min_overlap=0.3, max_variables=2)), 3)
+        self.assertEqual(len(plan_extraction_groups(self.tag_requests, min_overlap=0.3, max_evidence_tokens=50)), 3)
+        self.assertEqual(len(plan_extraction_groups(self.tag_requests, min_overlap=2.0)), 3)
+
+
+class TestDocumentWatcher(unittest.TestCase):
+    def setUp(self):
+        self.input_dir = tempfile.mkdtemp()
+        self.now = time.time() + 60 # Every file written by the test has settled
+        self.watcher = DocumentWatcher(self.input_dir, lambda input_dir: sorted(os.listdir(input_dir)),
+                                       settle_seconds=5, clock=lambda: self.now)
+
+    def write(self, filename, content):
+        with open(os.path.join(self.input_dir, filename), "w") as f:
+            f.write(content)
+
+    def test_documents_are_picked_up_once_per_content(self):
+        self.write("paper_a.docx", "version 1")
+        self.assertEqual([os.path.basename(path) for path, _hash in self.watcher.poll()], ["paper_a.docx"])
+        self.write("paper_a_copy.docx", "version 1") # Same content under another name
+        self.assertEqual(self.watcher.poll(), [])
+        self.write("paper_a.docx", "version 2") # Changed content is processed again
+        self.assertEqual([os.path.basename(path) for path, _hash in self.watcher.poll()], ["paper_a.docx"])
+
+    def test_unsettled_files_wait_and_forced_jobs_bypass_seen_hashes(self):
+        self.write("paper_b.docx", "content")
+        self.now = time.time()
+        self.assertEqual(self.watcher.poll(), [])
+        self.now = time.time() + 60
+        self.assertEqual(len(self.watcher.poll()), 1)
+        self.watcher.submit(os.path.join(self.input_dir, "paper_b.docx"), force=True)
+        self.assertEqual(len(self.watcher.poll()), 1)
+
+
+class StandInModel:
+    """Local stand-in for one pool member: records calls and raises the configured error, if any."""
+    def __init__(self, name, error=None):
+        self.name = name
+        self.error = error
+        self.calls = 0
+
+    def generate_content(self, contents, **kwargs):
+        self.calls += 1
+        if self.error is not None:
+            raise self.error
+        return self.name
+
+
+class TestEndpointPool(unittest.TestCase):
+    def setUp(self):
+        self.now = 0.0
+        self.models = {"us-central1": StandInModel("us-central1"), "europe-west4": StandInModel("europe-west4")}
+        self.pool = EndpointPool(
+            [ModelEndpoint("project_a", "us-central1", "gemini", weight=3),
+             ModelEndpoint("project_b", "europe-west4", "gemini", weight=1)],
+            lambda project, location, model_name: self.models[location],
+            cooldown_seconds=30, rng=random.Random(0), clock=lambda: self.now)
+
+    def test_weighted_routing(self):
+        responses = [self.pool.generate_content(["prompt"]) for _ in range(400)]
+        self.assertGreater(responses.count("us-central1"), responses.count("europe-west4") * 2)
+
+    def test_failover_and_cooldown_on_rate_limit(self):
+        self.models["us-central1"].error = google_exceptions.ResourceExhausted("quota")
+        self.assertEqual([self.pool.generate_content(["prompt"]) for _ in range(20)], ["europe-west4"] * 20)
+        self.assertEqual(self.models["us-central1"].calls, 1) # Not retried while cooling down
+        self.models["us-central1"].error = None
+        self.now += 31
+        self.assertIn("us-central1", [self.pool.generate_content(["prompt"]) for _ in range(20)])
+
+    def test_error_raised_when_every_endpoint_is_unavailable(self):
+        for model in self.models.values():
+            model.error = google_exceptions.ServiceUnavailable("overloaded")
+        with self.assertRaises(google_exceptions.ServiceUnavailable):
+            self.pool.generate_content(["prompt"])
+
+    def test_requests_per_minute_quota(self):
+        self.pool.endpoints[0].requests_per_minute = 5
+        responses = [self.pool.generate_content(["prompt"]) for _ in range(20)]
+        self.assertEqual(responses.count("us-central1"), 5)
+
+    def test_sdk_initialised_from_first_endpoint(self):
+        endpoints = [{"project": "project_b", "location": "europe-west4"}, {"project": "project_a", "location": "us-central1"}]
+        with mock.patch.object(ai_data_extractor, "MODEL_ENDPOINTS", endpoints), \
+             mock.patch.object(ai_data_extractor.vertexai, "init") as vertexai_init, \
+             mock.patch.object(ai_data_extractor, "vertex_model_factory", return_value=lambda *args: StandInModel("any")):
+            ai_data_extractor.build_endpoint_pool()
+            vertexai_init.assert_called_once_with(project="project_b", location="europe-west4")
+            vertexai_init.reset_mock()
+            ai_data_extractor.build_endpoint_pool(lambda *args: StandInModel("any"))
+            vertexai_init.assert_not_called() # Local stand-ins need no SDK defaults
+
+
+class TestHedgedCaller(unittest.TestCase):
+    def setUp(self):
+        self.release = threading.Event() # Hung stand-in calls return once this is set
+        self.caller = HedgedCaller(enable_hedging=True, hedge_percentile=0.5, min_samples=3,
+                                   usage_tokens_fn=lambda response: response["tokens"])
+
+    def tearDown(self):
+        self.release.set()
+
+    def hung_call(self):
+        self.release.wait(10)
+        return {"tokens": 7}
+
+    def wait_for(self, condition):
+        for _ in range(200):
+            if condition():
+                return
+            time.sleep(0.01)
+        self.fail("Condition not reached")
+
+    def test_deadline_exceeded_does_not_starve_later_calls(self):
+        caller = HedgedCaller(usage_tokens_fn=lambda response: response["tokens"])
+        for _ in range(20): # More hung calls than the former 16-thread pool
+            with self.assertRaises(CallDeadlineExceeded):
+                caller.call(self.hung_call, "extraction", deadline_seconds=0.01)
+        self.assertEqual(caller.telemetry["deadline_exceeded"], 20)
+        self.assertEqual(caller.telemetry["abandoned_in_flight"], 20)
+        self.assertEqual(caller.call(lambda: {"tokens": 1}, "extraction", deadline_seconds=1), {"tokens": 1})
+
+        self.release.set()
+        self.wait_for(lambda: caller.telemetry["abandoned_in_flight"] == 0)
+        self.assertEqual(caller.telemetry["hedge_wasted_calls"], 20)
+        self.assertEqual(caller.telemetry["hedge_wasted_tokens"], 140)
+
+    def test_errors_raised_when_every_attempt_fails(self):
+        def failing_call():
+            raise ValueError("bad request")
+        with self.assertRaises(ValueError):
+            self.caller.call(failing_call, "extraction", deadline_seconds=1)
+        self.assertEqual(self.caller.telemetry["deadline_exceeded"], 0)
+
+    def test_hedge_wins_and_loser_is_accounted(self):
+        for _ in range(3):
+            self.caller.latency_tracker.add("classification", 0.01)
+        attempts = []
+
+        def first_hangs():
+            attempts.append(1)
+            if len(attempts) == 1:
+                return self.hung_call()
+            return {"tokens": 5}
+
+        self.assertEqual(self.caller.call(first_hangs, "classification", deadline_seconds=2), {"tokens": 5})
+        self.assertEqual(self.caller.telemetry["hedges_issued"], 1)
+        self.assertEqual(self.caller.telemetry["hedges_won"], 1)
+        self.assertEqual(self.caller.telemetry["hedge_wasted_calls"], 0) # The original call is still running
+
+        self.release.set()
+        self.wait_for(lambda: self.caller.telemetry["hedge_wasted_calls"] == 1)
+        self.assertEqual(self.caller.telemetry["hedge_wasted_tokens"], 7)
+        self.assertEqual(self.caller.telemetry["abandoned_in_flight"], 0)
+
+    def test_discarded_responses_are_billed(self):
+        run_budget = RunBudget(token_budget=20)
+        caller = HedgedCaller(discarded_response_fn=lambda response: run_budget.add_usage(response, discarded=True))
+        usage = SimpleNamespace(prompt_token_count=10, total_token_count=15, candidates_token_count=5)
+
+        def hung_response():
+            self.release.wait(10)
+            return SimpleNamespace(usage_metadata=usage)
+        with self.assertRaises(CallDeadlineExceeded):
+            caller.call(hung_response, "extraction", deadline_seconds=0.01)
+        self.assertIsNone(run_budget.exhausted())
+        self.release.set()
+        self.wait_for(lambda: run_budget.discarded_tokens == 15)
+        run_budget.add_usage(SimpleNamespace(usage_metadata=usage))
+        self.assertEqual((run_budget.input_tokens, run_budget.output_tokens), (20, 10))
+        self.assertIsNotNone(run_budget.exhausted())
+        self.assertIn("including 15 tokens of discarded", run_budget.summary())
+
+    def test_no_hedge_without_enough_latency_samples(self):
+        self.assertEqual(self.caller.call(lambda: {"tokens": 2}, "classification", deadline_seconds=1), {"tokens": 2})
+        self.assertEqual(self.caller.telemetry["hedges_issued"], 0)
+
+
+class TestStageProfiler(unittest.TestCase):
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+
+    def test_disabled_stage_is_a_no_op(self):
+        profiler = StageProfiler()
+        with profiler.stage("parse", "paper.docx"):
+            sum(range(1000))
+        self.assertIs(profiler.stage("parse"), profiler.stage("extraction")) # The shared no-op context
+        self.assertEqual(profiler.summary(), "")
+
+    def test_enabled_stage_is_recorded_and_dumped(self):
+        profiler = StageProfiler()
+        profiler.enable(self.output_dir)
+        with profiler.stage("parse", "paper.docx"):
+            sorted(str(i) for i in range(1000))
+        with profiler.stage("parse", "other.docx"):
+            sum(range(1000))
+        self.assertEqual(profiler._stage_runs, {"parse": 2})
+        self.assertTrue(os.path.exists(os.path.join(self.output_dir, "paper.docx.parse.pstats")))
+        self.assertTrue(os.path.exists(os.path.join(self.output_dir, "other.docx.parse.tracemalloc")))
+        self.assertIn("== parse:", profiler.summary())
+
+    def test_nested_stage_is_part_of_the_enclosing_one(self):
+        profiler = StageProfiler(enabled=True)
+        with profiler.stage("extraction", "paper.docx"):
+            with profiler.stage("classification", "paper.docx"):
+                sum(range(1000))
+        self.assertEqual(profiler._stage_runs, {"extraction": 1})
+        with profiler.stage("classification", "paper.docx"): # Profiled again once the enclosing stage ended
+            pass
+        self.assertEqual(profiler._stage_runs, {"extraction": 1, "classification": 1})
+
+
+class TestDeadLetterQueue(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.input_dir = os.path.join(self.tmp_dir, "input")
+        os.makedirs(self.input_dir)
+        self.filepath = os.path.join(self.tmp_dir, "output", "dead_letter.jsonl")
+        self.queue = DeadLetterQueue(self.filepath)
+
+    def test_latest_failure_per_document(self):
+        self.queue.record("a.docx", "classification", ValueError("first"))
+        self.queue.record("b.docx", "extraction", ValueError("other"))
+        self.queue.record("a.docx", "extraction", RuntimeError("second"))
+        entries = self.queue.entries()
+        self.assertEqual([entry["filename"] for entry in entries], ["a.docx", "b.docx"])
+        self.assertEqual((entries[0]["stage"], entries[0]["error_type"], entries[0]["error"]), ("extraction", "RuntimeError", "second"))
+
+    def test_remove_appends_resolutions(self):
+        self.queue.record("a.docx", "classification", ValueError("failed"))
+        self.queue.record("b.docx", "classification", ValueError("failed"))
+        self.queue.remove(["a.docx", "never_failed.docx"])
+        self.assertEqual(self.queue.filenames(), ["b.docx"])
+        with open(self.filepath, encoding="utf-8") as f:
+            self.assertEqual(len(f.readlines()), 3) # Nothing rewritten; no resolution for a document that never failed
+        self.queue.record("a.docx", "extraction", ValueError("failed again"))
+        self.assertEqual(self.queue.filenames(), ["b.docx", "a.docx"])
+
+    def test_remove_keeps_failures_recorded_by_another_worker(self):
+        other_worker_queue = DeadLetterQueue(self.filepath)
+        self.queue.record("a.docx", "classification", ValueError("failed"))
+        other_worker_queue.record("b.docx", "extraction", ValueError("failed"))
+        self.queue.remove(["a.docx"])
+        self.assertEqual(other_worker_queue.filenames(), ["b.docx"])
+
+    def test_retry_failed_processes_dead_lettered_documents_still_in_input(self):
+        self.queue.record("a.docx", "classification", ValueError("failed"))
+        self.queue.record("gone.docx", "classification", ValueError("failed"))
+        self.queue.record("b.docx", "extraction", ValueError("failed"))
+        for filename in ("a.docx", "b.docx"):
+            docx.Document().save(os.path.join(self.input_dir, filename))
+        with mock.patch.object(ai_data_extractor, "DEAD_LETTER_FILEPATH", self.filepath), \
+             mock.patch.object(ai_data_extractor, "INPUT_DIR", self.input_dir), \
+             mock.patch.object(ai_data_extractor, "main") as main:
+            ai_data_extractor.retry_failed()
+        main.assert_called_once_with(["a.docx", "b.docx"])
+
+    def test_expected_failures_are_dead_lettered(self):
+        for error in (StageFailure("Classification failed after 3 attempts"), google_exceptions.ResourceExhausted("quota")):
+            with mock.patch.object(ai_data_extractor, "process_document", side_effect=error):
+                with self.assertRaises(DocumentProcessingError) as raised:
+                    ai_data_extractor.process_single_document("paper.docx", None)
+            self.assertEqual((raised.exception.stage, raised.exception.original_error), ("classification", error))
+
+    def test_programming_errors_propagate(self):
+        with mock.patch.object(ai_data_extractor, "process_document", side_effect=KeyError("heading")):
+            with self.assertRaises(KeyError):
+                ai_data_extractor.process_single_document("paper.docx", None)
+
+    def test_retry_failed_without_dead_lettered_documents(self):
+        with mock.patch.object(ai_data_extractor, "DEAD_LETTER_FILEPATH", self.filepath), \
+             mock.patch.object(ai_data_extractor, "main") as main:
+            ai_data_extractor.retry_failed()
+        main.assert_not_called()
+
+
+class StandInPromptCompiler:
+    """Local stand-in for PromptCompiler: one prompt component per call, sized by its payload."""
+    def __init__(self, target_variables_by_tag):
+        self.target_variables_by_tag = target_variables_by_tag
+
+    def target_variables_for_tag(self, tag_label):
+        return self.target_variables_by_tag.get(tag_label, {})
+
+    def classification_prompt(self, heading, payload_paragraphs):
+        return SimpleNamespace(components={"instructions": "classify", "content": " ".join(payload_paragraphs.values())})
+
+    def document_classification_prompt(self, section_payloads):
+        return SimpleNamespace(components={"instructions": "classify", "content": " ".join(
+            " ".join(payload.values()) for _heading, payload in section_payloads)})
+
+    def extraction_prompt(self, target_variables, payload_by_heading):
+        return SimpleNamespace(components={"instructions": "extract", "variables": " ".join(target_variables)})
+
+
+class TestRunPlanner(unittest.TestCase):
+    def setUp(self):
+        content_store = DocumentContentStore()
+        for _ in range(4):
+            content_store.append("x" * 400, "paragraph", "Normal")
+        self.parsed_document = SimpleNamespace(file_path="paper.docx", content_store=content_store,
+                                               sections=[("Methods", 0, 2), ("Results", 2, 4)])
+        self.prompt_compiler = StandInPromptCompiler({"demographics": {"n": "", "age": ""}, "design": {"design": ""},
+                                                      "outcomes": {"outcome": "", "effect": ""}, "notes": {}})
+
+    def planner(self, **kwargs):
+        return RunPlanner(self.prompt_compiler, lambda text: len(text.split()), "", ["demographics", "design", "outcomes", "notes"],
+                          evidence_token_budget=0, evidence_share_per_tag=0.5,
+                          classification_output_tokens_per_piece=10, extraction_output_tokens_per_variable=20,
+                          call_overhead_seconds=2, output_tokens_per_second=10,
+                          input_price_per_1m=1_000_000, output_price_per_1m=0, **kwargs)
+
+    def test_one_extraction_call_per_tag(self):
+        plan = self.planner().plan_document(self.parsed_document)
+        self.assertEqual((plan["classification_calls"], plan["extraction_calls"]), (2, 3)) # "notes" has no variables
+        self.assertEqual(plan["output_tokens"], 4 * 10 + 5 * 20)
+        self.assertNotIn("merged_extraction_calls", plan)
+
+    def test_merged_extraction_best_case(self):
+        planner = self.planner(merge_extraction_calls=True, merge_max_variables=3)
+        plan = planner.plan_document(self.parsed_document)
+        self.assertEqual(plan["extraction_calls"], 3)
+        self.assertEqual(plan["merged_extraction_calls"], 2) # demographics + design share a call; outcomes would exceed 3 variables
+        self.assertLess(plan["merged_extraction_input_tokens"], plan["extraction_input_tokens"])
+        self.assertIn("as few as 2 of the 3 extraction calls", planner.report([1]))
+        self.assertEqual(self.planner(merge_extraction_calls=True).plan_document(self.parsed_document)["merged_extraction_calls"], 1)
+
+    def test_wall_clock_seconds_with_workers_claiming_documents(self):
+        self.assertEqual(RunPlanner.wall_clock_seconds([10, 10, 10, 10], 1), 40)
+        self.assertEqual(RunPlanner.wall_clock_seconds([10, 10, 10, 10], 2), 20)
+        self.assertEqual(RunPlanner.wall_clock_seconds([30, 10, 10, 10], 2), 30) # The long document bounds the run
+        self.assertEqual(RunPlanner.wall_clock_seconds([10, 10], 8), 10)
+        self.assertEqual(RunPlanner.wall_clock_seconds([10, 10], 0), 20) # At least one worker
+
+    def test_report_is_capped_by_quotas(self):
+        planner = self.planner()
+        for _ in range(10):
+            planner.plan_document(self.parsed_document) # 5 calls each
+        plan_seconds = planner.document_plans[0]["seconds"]
+        self.assertIn(f"Time at concurrency 10: ~{plan_seconds / 60:.1f} minutes\n", planner.report([10]) + "\n")
+        self.assertIn("Time at concurrency 10: ~5.0 minutes (limited by requests-per-minute quota)",
+                      planner.report([10], requests_per_minute=10))
+        total_tokens = sum(plan["input_tokens"] + plan["output_tokens"] for plan in planner.document_plans)
+        self.assertIn(f"Time at concurrency 10: ~{total_tokens / 100:.1f} minutes (limited by tokens-per-minute quota)",
+                      planner.report([10], requests_per_minute=10, tokens_per_minute=100))
+
+
+def result_row(filename, variable, extracted_value, **fields):
+    return dict({"filename": filename, "variable": variable, "extracted_value": extracted_value, "confidence": 0.9,
+                 "indices": [1], "justification": "", "relevant_paragraphs_or_tables": ""}, **fields)
+
+
+class TestResultsStore(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.store = ResultsStore(os.path.join(self.tmp_dir, "results.sqlite"))
+        self.store.start_run("run-1", "run", "gemini", "signature-a")
+        self.store.start_run("run-2", "run", "gemini", "signature-b")
+
+    def tearDown(self):
+        self.store.close()
+
+    def test_upsert_replaces_document_rows_in_a_run(self):
+        self.store.upsert_document("run-1", "hash-a", "a.docx", [result_row("a.docx", "n", 10), result_row("a.docx", "age", 40)], "gemini")
+        self.store.upsert_document("run-1", "hash-a", "a.docx", [result_row("a.docx", "n", 12)], "gemini", input_tokens=5)
+        rows = self.store.rows("run-1")
+        self.assertEqual([(row["variable"], row["extracted_value"]) for row in rows], [("n", "12")]) # "age" is not kept
+        self.assertEqual(rows[0]["indices"], [1])
+        self.assertEqual(self.store.runs()[0]["documents"], 1)
+
+    def test_rows_without_run_are_the_latest_result_per_document(self):
+        self.store.upsert_document("run-1", "hash-a", "a.docx", [result_row("a.docx", "n", 10)], "gemini")
+        self.store.upsert_document("run-1", "hash-b", "b.docx", [result_row("b.docx", "n", 20)], "gemini")
+        self.store.upsert_document("run-2", "hash-a", "a_renamed.docx", [result_row("a_renamed.docx", "n", 11)], "gemini")
+        rows = self.store.rows(None)
+        self.assertEqual([(row["filename"], row["extracted_value"], row["run_id"]) for row in rows],
+                         [("a_renamed.docx", "11", "run-2"), ("b.docx", "20", "run-1")])
+
+    def test_document_hashes_by_codebook_signature(self):
+        self.store.upsert_document("run-1", "hash-a", "a.docx", [result_row("a.docx", "n", 10)], "gemini")
+        self.store.upsert_document("run-2", "hash-b", "b.docx", [result_row("b.docx", "n", 20)], "gemini")
+        self.assertEqual(self.store.document_hashes(), {"hash-a", "hash-b"})
+        self.assertEqual(self.store.document_hashes("signature-b"), {"hash-b"})
+        self.assertEqual(self.store.document_hashes("signature-c"), set())
+
+    def test_merge_hashes_document_content_not_filename(self):
+        input_dir = os.path.join(self.tmp_dir, "input")
+        shard_dir = os.path.join(self.tmp_dir, "shards")
+        os.makedirs(input_dir)
+        docx.Document().save(os.path.join(input_dir, "a.docx"))
+        append_shard_rows(os.path.join(shard_dir, "shard_w1.jsonl"),
+                          [result_row("a.docx", "n", 10), result_row("gone.docx", "n", 20),
+                           result_row("c.docx", "n", 30, document_hash="hash-c")])
+        db_path = os.path.join(self.tmp_dir, "merged.sqlite")
+        with mock.patch.object(ai_data_extractor, "INPUT_DIR", input_dir), \
+             mock.patch.object(ai_data_extractor, "OUTPUT_DIR", self.tmp_dir), \
+             mock.patch.object(ai_data_extractor, "ENABLE_RESULTS_STORE", True), \
+             mock.patch.object(ai_data_extractor, "RESULTS_DB_FILEPATH", db_path), \
+             mock.patch.object(ai_data_extractor, "RESULTS_PARQUET_DIR", ""), \
+             mock.patch.object(ai_data_extractor, "save_results") as save_results:
+            ai_data_extractor.merge_shards(shard_dir)
+        self.assertEqual(len(save_results.call_args[0][0]), 3) # The workbook keeps every row
+        merged_store = ResultsStore(db_path)
+        self.assertEqual(merged_store.document_hashes(), {file_sha256(os.path.join(input_dir, "a.docx")), "hash-c"})
+        merged_store.close()
+
+
+class TestStreamingResultsWriter(unittest.TestCase):
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+
+    def document_rows(self, filename, count, text=""):
+        return [result_row(filename, f"variable_{i}", i, relevant_paragraphs_or_tables=text) for i in range(count)]
+
+    def read_csv(self, path):
+        with open(path, newline="", encoding="utf-8") as f:
+            return list(csv.reader(f))[1:]
+
+    def test_rollover_by_rows_at_document_boundaries(self):
+        writer = StreamingResultsWriter(self.output_dir, "results", "csv", max_rows_per_part=3, max_characters_per_part=0)
+        for filename in ("a.docx", "b.docx", "c.docx"):
+            writer.write_document(self.document_rows(filename, 2))
+        paths = writer.close("_COMPLETE")
+        self.assertEqual([os.path.basename(path) for path in paths], ["results_COMPLETE_part001.csv", "results_COMPLETE_part002.csv"])
+        # A part only rolls over between documents, so the first part exceeds the limit rather than splitting b.docx
+        self.assertEqual([row[0] for row in self.read_csv(paths[0])], ["a.docx"] * 2 + ["b.docx"] * 2)
+        self.assertEqual([row[0] for row in self.read_csv(paths[1])], ["c.docx"] * 2)
+        self.assertEqual((writer.rows_written, writer.documents_written), (6, 3))
+
+    def test_rollover_by_characters(self):
+        writer = StreamingResultsWriter(self.output_dir, "results", "csv", max_rows_per_part=0, max_characters_per_part=500)
+        writer.write_document(self.document_rows("a.docx", 1, "x" * 600))
+        writer.write_document(self.document_rows("b.docx", 1, "short"))
+        writer.write_document(self.document_rows("c.docx", 1, "short"))
+        paths = writer.close()
+        self.assertEqual(len(paths), 2)
+        self.assertEqual([row[0] for row in self.read_csv(paths[1])], ["b.docx", "c.docx"])
+
+    def test_single_part_has_no_part_number(self):
+        writer = StreamingResultsWriter(self.output_dir, "results", "xlsx")
+        writer.write_document(self.document_rows("a.docx", 2))
+        paths = writer.close("_USER_INTERRUPTED_PARTIAL")
+        self.assertEqual(paths, [os.path.join(self.output_dir, "results_USER_INTERRUPTED_PARTIAL.xlsx")])
+        self.assertEqual(sorted(os.listdir(self.output_dir)), ["results_USER_INTERRUPTED_PARTIAL.xlsx"])
+
+    def test_content_sheet_references_pieces_by_index(self):
+        writer = StreamingResultsWriter(self.output_dir, "results", "xlsx", content_sheet=True)
+        rows = [result_row("a.docx", "n", 10, indices=[3, 1], relevant_paragraphs_or_tables="full text"),
+                result_row("a.docx", "age", 40, indices=[3], relevant_paragraphs_or_tables="full text")]
+        writer.write_document(rows, {3: "Third piece", 1: "First piece"})
+        workbook = openpyxl.load_workbook(writer.close()[0], read_only=True)
+        results = list(workbook["results"].iter_rows(values_only=True))
+        column = results[0].index("relevant_paragraphs_or_tables")
+        self.assertEqual([row[column] for row in results[1:]], ["Index 3, Index 1", "Index 3"])
+        self.assertEqual(list(workbook["content"].iter_rows(values_only=True))[1:],
+                         [("a.docx", 1, "First piece"), ("a.docx", 3, "Third piece")])
+        workbook.close()
+
+    def test_csv_content_sheet_is_a_separate_file(self):
+        writer = StreamingResultsWriter(self.output_dir, "results", "csv", content_sheet=True)
+        writer.write_document([result_row("a.docx", "n", 10, indices=[2])], {2: "Second piece"})
+        paths = writer.close("_COMPLETE")
+        self.assertEqual([os.path.basename(path) for path in paths], ["results_COMPLETE.csv", "results_COMPLETE_content.csv"])
+        self.assertEqual(self.read_csv(paths[1]), [["a.docx", "2", "Second piece"]])
+
+    def test_excel_safe_truncates_and_removes_illegal_characters(self):
+        self.assertEqual(_excel_safe("a\x00b\x1fc"), "abc")
+        truncated = _excel_safe("x" * (EXCEL_MAX_CELL_CHARACTERS + 10))
+        self.assertEqual(len(truncated), EXCEL_MAX_CELL_CHARACTERS)
+        self.assertTrue(truncated.endswith(" [truncated]"))
+        self.assertEqual(_excel_safe("x" * EXCEL_MAX_CELL_CHARACTERS), "x" * EXCEL_MAX_CELL_CHARACTERS)
+        self.assertEqual(_excel_safe(0.5), 0.5)
+
+
+class StandInClassifierClient:
+    """Local stand-in for ParagraphClassifierClient.classify_document: records the payloads, returns a fixed response."""
+    def __init__(self, response):
+        self.response = response
+        self.section_payloads = None
+
+    def classify_document(self, document_name, section_payloads):
+        self.section_payloads = section_payloads
+        return self.response
+
+
+class TestWholeDocumentClassification(unittest.TestCase):
+    def setUp(self):
+        self.content_store = DocumentContentStore()
+        for i in range(6):
+            self.content_store.append(f"Content piece {i}.", "paragraph", "Normal")
+        self.sections = [("Methods", 0, 2), ("Results", 2, 5), ("Discussion", 5, 6)]
+        self.label = list(PARAGRAPH_TAG_DESCRIPTIONS)[0]
+
+    def test_split_classifications_by_section(self):
+        classifications = {"0": [["a", 0.9]], "3": [["b", 0.8]], "4": [], "5": [["c", 0.7]], "17": [["d", 0.5]], "x": [["e", 0.5]]}
+        self.assertEqual(split_classifications_by_section(classifications, self.sections),
+                         [{"0": [["a", 0.9]]}, {"3": [["b", 0.8]], "4": []},
+                          {"5": [["c", 0.7]], "17": [["d", 0.5]], "x": [["e", 0.5]]}]) # Unknown keys go to the last section
+
+    def test_split_classifications_with_gaps_between_sections(self):
+        sections = [("Methods", 0, 2), ("Results", 4, 6)] # Pieces 2 and 3 were skipped by a section rule
+        self.assertEqual(split_classifications_by_section({"1": [], "2": [], "4": []}, sections), [{"1": []}, {"2": [], "4": []}])
+
+    def test_fallback_reason(self):
+        with mock.patch.object(ai_data_extractor, "WHOLE_DOCUMENT_MAX_INPUT_TOKENS", 1000), \
+             mock.patch.object(ai_data_extractor, "GENERATION_CONFIGURATION", {"max_output_tokens": 1000}), \
+             mock.patch.object(ai_data_extractor, "PLAN_CLASSIFICATION_OUTPUT_TOKENS_PER_PIECE", 100):
+            self.assertEqual(whole_document_fallback_reason(self.content_store), "")
+            self.content_store.append("x" * 8000, "paragraph", "Normal") # ~2000 tokens
+            self.assertIn("WHOLE_DOCUMENT_MAX_INPUT_TOKENS", whole_document_fallback_reason(self.content_store))
+        with mock.patch.object(ai_data_extractor, "WHOLE_DOCUMENT_MAX_INPUT_TOKENS", 10000), \
+             mock.patch.object(ai_data_extractor, "GENERATION_CONFIGURATION", {"max_output_tokens": 500}), \
+             mock.patch.object(ai_data_extractor, "PLAN_CLASSIFICATION_OUTPUT_TOKENS_PER_PIECE", 100):
+            self.assertIn("max_output_tokens (500)", whole_document_fallback_reason(self.content_store))
+
+    def test_classify_document_sections_with_stub_response(self):
+        client = StandInClassifierClient({"1": [[self.label, 0.9]], "3": [[self.label, 0.6], ["not_a_label", 0.5]]})
+        classified_paragraphs_data = {self.label: {}}
+        section_warnings = list(classify_document_sections(self.content_store, client, classified_paragraphs_data,
+                                                           self.sections, None, "paper.docx"))
+        self.assertEqual(section_warnings, [("Methods", 0), ("Results", 1), ("Discussion", 0)])
+        self.assertEqual([heading for heading, _payload in client.section_payloads], ["Methods", "Results", "Discussion"])
+        self.assertEqual(client.section_payloads[1][1], {"2": "Content piece 2.", "3": "Content piece 3.", "4": "Content piece 4."})
+        self.assertEqual(classified_paragraphs_data[self.label], {"Methods": [(0.9, 1)], "Results": [(0.6, 3)]})
+
+
+class TestPromptCompiler(unittest.TestCase):
+    def setUp(self):
+        self.compiler = PromptCompiler(
+            {"demographic_info": ["Sample size", "age"], "design": ["Study design"]},
+            {"n": {"description": "Sample size", "examples": ["N = 40"], "notes_questions": ""},
+             "age": {"description": "Mean age", "examples": [], "notes_questions": "Report in years"}},
+            {"demographic_info": ["n", "age", "missing_variable"]})
+
+    def test_classification_prompt_components(self):
+        prompt = self.compiler.classification_prompt("Methods", {"3": "Forty children took part.", "4": "Ähnlich."})
+        self.assertEqual(list(prompt.components), ["instructions", "codebook", "content"])
+        self.assertEqual(prompt.components["instructions"], CLASSIFICATION_INSTRUCTIONS)
+        self.assertTrue(prompt.components["codebook"].startswith("VALID LABEL NAMES: [demographic_info, design]"))
+        self.assertIn("- **demographic_info**: Sample size; age", prompt.components["codebook"])
+        self.assertEqual(prompt.components["content"],
+                         'SECTION TO CLASSIFY:\n{"heading":"Methods","paragraphs":{"3":"Forty children took part.","4":"Ähnlich."}}\n')
+        self.assertEqual(prompt.text, "".join(prompt.components.values()))
+        # Static components are the same objects for every section, so consecutive prompts share their prefix
+        self.assertIs(self.compiler.classification_prompt("Results", {}).components["codebook"], prompt.components["codebook"])
+
+    def test_document_classification_prompt_keeps_section_order(self):
+        prompt = self.compiler.document_classification_prompt([("Methods", {"0": "a"}), ("Results", {"1": "b"})])
+        content = json.loads(prompt.components["content"][len("DOCUMENT TO CLASSIFY:\n"):])
+        self.assertEqual(content, {"sections": [{"heading": "Methods", "paragraphs": {"0": "a"}},
+                                                {"heading": "Results", "paragraphs": {"1": "b"}}]})
+
+    def test_extraction_prompt_components(self):
+        target_vars = self.compiler.target_variables_for_tag("demographic_info")
+        self.assertEqual(list(target_vars), ["n", "age"]) # Cluster variables without a definition are left out
+        self.assertEqual(self.compiler.target_variables_for_tag("design"), {})
+        prompt = self.compiler.extraction_prompt(target_vars, {"Methods": {"3": "Forty children took part."}})
+        self.assertEqual(prompt.components["instructions"], EXTRACTION_INSTRUCTIONS)
+        definitions = json.loads(prompt.components["codebook"].split("\n")[1])
+        self.assertEqual(definitions, {"n": {"description": "Sample size", "examples": ["N = 40"]},
+                                       "age": {"description": "Mean age", "notes_questions": "Report in years"}})
+        self.assertIn("REQUIRED OUTPUT KEYS: [n, age]", prompt.components["codebook"])
+        self.assertEqual(prompt.components["content"], 'RELEVANT CONTENT:\n{"Methods":{"3":"Forty children took part."}}\n')
+        self.assertIs(self.compiler.extraction_prompt(target_vars, {}).components["codebook"], prompt.components["codebook"])
+
+
+class TestTokenLedger(unittest.TestCase):
+    def setUp(self):
+        self.counted_texts = []
+
+        def count_tokens(text):
+            self.counted_texts.append(text)
+            return len(text.split())
+        self.ledger = TokenLedger(count_tokens, system_instruction="You are a research assistant.")
+        self.prompt = SimpleNamespace(components={"instructions": "Classify every piece.", "codebook": "label one two",
+                                                  "content": "x" * 400})
+
+    def response(self, prompt_tokens, output_tokens):
+        return SimpleNamespace(usage_metadata=SimpleNamespace(prompt_token_count=prompt_tokens, candidates_token_count=output_tokens))
+
+    def test_per_component_accounting(self):
+        call_counts = self.ledger.record("classification", self.prompt, self.response(100, 20))
+        self.assertEqual(call_counts, {"system": 5, "instructions": 3, "codebook": 3, "content": 89, "output": 20})
+        self.ledger.record("classification", self.prompt, self.response(50, 10))
+        self.ledger.record("extraction", self.prompt, None) # No usage metadata: content is estimated from its length
+        self.assertEqual(self.ledger.totals["classification"],
+                         {"calls": 2, "system": 10, "instructions": 6, "codebook": 6, "content": 128, "output": 30})
+        self.assertEqual(self.ledger.totals["extraction"]["content"], 100)
+        self.assertEqual((self.ledger.input_tokens(), self.ledger.output_tokens()), (150 + 111, 30))
+        self.assertIn("classification: 2 calls, 150 input tokens", self.ledger.summary())
+
+    def test_static_components_are_counted_once(self):
+        for _ in range(3):
+            self.ledger.record("classification", self.prompt, self.response(100, 20))
+        self.assertEqual(len(self.counted_texts), 3) # System instruction, instructions and codebook
+
+    def test_counting_failure_falls_back_to_estimate(self):
+        def failing_count(text):
+            raise RuntimeError("count_tokens unavailable")
+        ledger = TokenLedger(failing_count, system_instruction="s" * 40)
+        self.assertEqual(ledger.system_instruction_tokens, 10)
+
+    def test_disabled_ledger_records_nothing(self):
+        ledger = TokenLedger(lambda text: 1 / 0, system_instruction="unused", enabled=False)
+        self.assertEqual(ledger.record("classification", self.prompt, self.response(100, 20)), {})
+        self.assertEqual(ledger.summary(), "Token accounting: no calls recorded.")
+
+
+class StandInExecutor:
+    """Local stand-in for the parser process pool: runs submissions immediately, failing those for failing_paths."""
+    def __init__(self, failing_paths=()):
+        self.failing_paths = set(failing_paths)
+        self.submitted = []
+        self.shut_down = False
+
+    def submit(self, fn, file_path, **kwargs):
+        self.submitted.append(file_path)
+        future = Future()
+        if file_path in self.failing_paths:
+            future.set_exception(RuntimeError("parser process died"))
+        else:
+            future.set_result(fn(file_path, **kwargs))
+        return future
+
+    def shutdown(self, wait=True, cancel_futures=False):
+        self.shut_down = True
+
+
+class TestParsePrefetcher(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.file_paths = []
+        for i in range(5):
+            document = docx.Document()
+            document.add_paragraph(f"Paragraph of document {i}.")
+            self.file_paths.append(os.path.join(self.tmp_dir, f"paper_{i}.docx"))
+            document.save(self.file_paths[-1])
+
+    def first_pieces(self, prefetched):
+        return [(os.path.basename(file_path), parsed_document.content_store[0]) for file_path, parsed_document in prefetched]
+
+    def test_in_process_parsing_without_workers(self):
+        missing_path = os.path.join(self.tmp_dir, "missing.docx")
+        with ParsePrefetcher(self.file_paths[:2] + [missing_path], max_workers=0) as prefetcher:
+            self.assertIsNone(prefetcher._executor)
+            prefetched = list(prefetcher)
+        self.assertEqual(self.first_pieces(prefetched[:2]), [("paper_0.docx", "Paragraph of document 0."),
+                                                             ("paper_1.docx", "Paragraph of document 1.")])
+        self.assertIn("Error opening document", prefetched[2][1].error) # Failures are reported, not raised
+
+    def test_process_pool_keeps_order(self):
+        with ParsePrefetcher(self.file_paths[:2], max_workers=2, prefetch_window=2) as prefetcher:
+            self.assertEqual(prefetcher._executor._mp_context.get_start_method(), "spawn") # Never forked after gRPC init
+            prefetched = list(prefetcher)
+        self.assertEqual(self.first_pieces(prefetched), [("paper_0.docx", "Paragraph of document 0."),
+                                                         ("paper_1.docx", "Paragraph of document 1.")])
+
+    def test_prefetch_window_bounds_documents_in_flight(self):
+        executor = StandInExecutor()
+        with ParsePrefetcher(self.file_paths, max_workers=0, prefetch_window=2) as prefetcher:
+            prefetcher._executor = executor
+            for yielded, (file_path, _parsed_document) in enumerate(prefetcher):
+                self.assertLessEqual(len(executor.submitted) - yielded, 2)
+                self.assertEqual(file_path, self.file_paths[yielded])
+        self.assertEqual(executor.submitted, self.file_paths)
+
+    def test_shared_pool_is_not_shut_down(self):
+        executor = StandInExecutor()
+        for batch in (self.file_paths[:2], self.file_paths[2:4]):
+            with ParsePrefetcher(batch, max_workers=2, executor=executor) as prefetcher:
+                self.assertIs(prefetcher._executor, executor)
+                list(prefetcher)
+        self.assertEqual(executor.submitted, self.file_paths[:4])
+        self.assertFalse(executor.shut_down)
+
+    def test_failed_worker_falls_back_to_in_process_parsing(self):
+        executor = StandInExecutor(failing_paths=[self.file_paths[1]])
+        with ParsePrefetcher(self.file_paths[:3], max_workers=0, prefetch_window=2) as prefetcher:
+            prefetcher._executor = executor
+            prefetched = list(prefetcher)
+        self.assertEqual([parsed_document.content_store[0] for _file_path, parsed_document in prefetched],
+                         [f"Paragraph of document {i}." for i in range(3)])
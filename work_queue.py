@@ -0,0 +1,233 @@
+# work_queue.py
+import os
+import json
+import time
+import uuid
+import socket
+import threading
+
+
+def default_worker_id() -> str:
+    """Host name plus process id, unique across machines sharing the queue directory."""
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+def _marker_name(filename: str, suffix: str) -> str:
+    return f"{filename}{suffix}"
+
+
+class FileLeaseQueue:
+    """
+    A work queue over a shared filesystem. Each document is claimed by creating a lease file atomically
+    (O_CREAT | O_EXCL), kept alive by a heartbeat thread that refreshes the lease's modification time,
+    and finished by writing a done marker. A lease whose heartbeat is older than lease_ttl_seconds
+    belongs to a dead worker and can be taken over by another worker.
+
+    Layout under queue_dir:
+        leases/<filename>.lease   JSON {"worker_id", "claimed_at"}; mtime = last heartbeat
+        done/<filename>.done      JSON {"worker_id", "completed_at"}
+        failed/<filename>.failed  JSON {"worker_id", "failed_at", "stage", "error"}
+    """
+
+    def __init__(self, queue_dir: str, worker_id: str, lease_ttl_seconds: float = 600,
+                 heartbeat_interval_seconds: float = 60):
+        """
+        Args:
+            queue_dir (str): Directory on the shared filesystem holding leases and markers.
+            worker_id (str): Unique id of this worker (e.g., default_worker_id()).
+            lease_ttl_seconds (float): Age after which a lease without heartbeat is considered expired.
+            heartbeat_interval_seconds (float): How often held leases are refreshed (must be well below the TTL).
+        """
+        if heartbeat_interval_seconds >= lease_ttl_seconds:
+            raise ValueError("heartbeat_interval_seconds must be smaller than lease_ttl_seconds.")
+        self.queue_dir = queue_dir
+        self.worker_id = worker_id
+        self.lease_ttl_seconds = lease_ttl_seconds
+        self.heartbeat_interval_seconds = heartbeat_interval_seconds
+
+        self.lease_dir = os.path.join(queue_dir, "leases")
+        self.done_dir = os.path.join(queue_dir, "done")
+        self.failed_dir = os.path.join(queue_dir, "failed")
+        for directory in (self.lease_dir, self.done_dir, self.failed_dir):
+            os.makedirs(directory, exist_ok=True)
+
+        self._held_leases = set()
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._heartbeat_thread = None
+
+    def _lease_path(self, filename: str) -> str:
+        return os.path.join(self.lease_dir, _marker_name(filename, ".lease"))
+
+    def _done_path(self, filename: str) -> str:
+        return os.path.join(self.done_dir, _marker_name(filename, ".done"))
+
+    def _failed_path(self, filename: str) -> str:
+        return os.path.join(self.failed_dir, _marker_name(filename, ".failed"))
+
+    def is_finished(self, filename: str) -> bool:
+        return os.path.exists(self._done_path(filename)) or os.path.exists(self._failed_path(filename))
+
+    def _try_create_lease(self, filename: str) -> bool:
+        try:
+            fd = os.open(self._lease_path(filename), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump({"worker_id": self.worker_id, "claimed_at": time.time()}, f)
+        return True
+
+    def _break_expired_lease(self, filename: str) -> bool:
+        """Removes the lease of filename if its heartbeat expired. Only one of several racing workers succeeds."""
+        lease_path = self._lease_path(filename)
+        try:
+            with open(lease_path, "r", encoding="utf-8") as f:
+                observed_lease = f.read()
+            age = time.time() - os.path.getmtime(lease_path)
+        except FileNotFoundError:
+            return True # Released in the meantime
+        if age <= self.lease_ttl_seconds:
+            return False
+        # rename() is atomic: exactly one worker moves the stale lease out of the way
+        stale_path = f"{lease_path}.stale-{uuid.uuid4().hex}"
+        try:
+            os.rename(lease_path, stale_path)
+        except FileNotFoundError:
+            return False # Another worker broke it first and may already hold a new lease
+        with open(stale_path, "r", encoding="utf-8") as f:
+            moved_lease = f.read()
+        if moved_lease != observed_lease or time.time() - os.path.getmtime(stale_path) <= self.lease_ttl_seconds:
+            # Another worker broke the stale lease and claimed the document in between; give its fresh lease back
+            try:
+                os.link(stale_path, lease_path)
+            except FileExistsError:
+                pass
+            os.remove(stale_path)
+            return False
+        print(f"Lease on '{filename}' expired ({age:.0f}s without heartbeat). Taking it over.")
+        os.remove(stale_path)
+        return True
+
+    def try_claim(self, filename: str) -> bool:
+        """Attempts to claim one document. Returns True if this worker now holds its lease."""
+        if self.is_finished(filename):
+            return False
+        claimed = self._try_create_lease(filename)
+        if not claimed and self._break_expired_lease(filename):
+            claimed = self._try_create_lease(filename)
+        if claimed and self.is_finished(filename):
+            # Finished between the check and the claim
+            self._remove_lease(filename)
+            return False
+        if claimed:
+            with self._lock:
+                self._held_leases.add(filename)
+        return claimed
+
+    def claim_next(self, filenames: list[str]):
+        """Claims the first unfinished, unleased document from filenames. Returns its name, or None if none is available."""
+        for filename in filenames:
+            if self.try_claim(filename):
+                return filename
+        return None
+
+    def has_pending(self, filenames: list[str]) -> bool:
+        """True if any document is not finished yet (including documents currently leased by other workers)."""
+        return any(not self.is_finished(filename) for filename in filenames)
+
+    def _remove_lease(self, filename: str):
+        with self._lock:
+            self._held_leases.discard(filename)
+        try:
+            os.remove(self._lease_path(filename))
+        except FileNotFoundError:
+            pass
+
+    def _write_marker(self, path: str, data: dict):
+        tmp_path = f"{path}.{self.worker_id}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+
+    def complete(self, filename: str):
+        """Marks a document as done and releases its lease."""
+        self._write_marker(self._done_path(filename), {"worker_id": self.worker_id, "completed_at": time.time()})
+        self._remove_lease(filename)
+
+    def fail(self, filename: str, stage: str, error: str):
+        """Marks a document as failed (so other workers do not retry it) and releases its lease."""
+        self._write_marker(self._failed_path(filename), {
+            "worker_id": self.worker_id, "failed_at": time.time(), "stage": stage, "error": error})
+        self._remove_lease(filename)
+
+    def release(self, filename: str):
+        """Gives a claimed document back to the queue without finishing it (e.g., on user interrupt)."""
+        self._remove_lease(filename)
+
+    def _heartbeat_loop(self):
+        while not self._stop_event.wait(self.heartbeat_interval_seconds):
+            with self._lock:
+                held_leases = list(self._held_leases)
+            for filename in held_leases:
+                try:
+                    os.utime(self._lease_path(filename))
+                except FileNotFoundError:
+                    print(f"Warning: Lease on '{filename}' disappeared (taken over after expiry?).")
+
+    def start_heartbeat(self):
+        if self._heartbeat_thread is None:
+            self._stop_event.clear()
+            self._heartbeat_thread = threading.Thread(target=self._heartbeat_loop, name="lease-heartbeat", daemon=True)
+            self._heartbeat_thread.start()
+
+    def stop_heartbeat(self):
+        if self._heartbeat_thread is not None:
+            self._stop_event.set()
+            self._heartbeat_thread.join()
+            self._heartbeat_thread = None
+
+
+def append_shard_rows(shard_filepath: str, rows: list[dict]):
+    """Appends one document's result rows to a worker's shard file (JSON Lines), flushed to disk immediately."""
+    directory = os.path.dirname(shard_filepath)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(shard_filepath, "a", encoding="utf-8") as f:
+        for row in rows:
+            f.write(json.dumps(row, ensure_ascii=False) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def read_shard_rows(shard_dir: str) -> list[dict]:
+    """
+    Reads all shard files in shard_dir and returns their rows. If a document was processed more than once
+    (e.g., a lease was taken over from a worker that later finished anyway), only the rows of its most
+    recent completion are kept.
+    """
+    rows_by_document = {} # {filename: (completed_at, [rows])}
+    if not os.path.isdir(shard_dir):
+        return []
+    for shard_filename in sorted(os.listdir(shard_dir)):
+        if not shard_filename.endswith(".jsonl"):
+            continue
+        with open(os.path.join(shard_dir, shard_filename), "r", encoding="utf-8") as f:
+            for line_number, line in enumerate(f, start=1):
+                if not line.strip():
+                    continue
+                try:
+                    row = json.loads(line)
+                except json.JSONDecodeError:
+                    print(f"Warning: Skipping unreadable line {line_number} in shard {shard_filename} (partial write?).")
+                    continue
+                document_key = row.get("filename")
+                completed_at = row.get("completed_at", 0)
+                previous = rows_by_document.get(document_key)
+                if previous is None or completed_at > previous[0]:
+                    rows_by_document[document_key] = (completed_at, [row])
+                elif completed_at == previous[0]:
+                    previous[1].append(row)
+    merged_rows = []
+    for document_key in sorted(rows_by_document, key=str):
+        merged_rows.extend(rows_by_document[document_key][1])
+    return merged_rows